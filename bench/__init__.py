@@ -0,0 +1 @@
+'''Offline benchmarks and the stand-in Discord objects they run against.'''
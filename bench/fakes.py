@@ -0,0 +1,301 @@
+'''Stand-in Discord objects for driving the real cogs without a server.
+
+Only the attributes and coroutines the cogs actually use are implemented.
+Every method that would be a REST call in discord.py goes through
+`FakeHTTP.call`, which counts it by route and sleeps for a configurable
+simulated round trip. Given limits, it also rejects calls over them the way
+Discord would, per route and channel or guild and globally.
+'''
+
+import asyncio
+from collections import Counter, deque
+import datetime
+import heapq
+import itertools
+import random
+
+import discord
+
+_snowflakes = itertools.count(700000000000000000)
+
+
+def snowflake():
+    return next(_snowflakes)
+
+
+class RateLimited(Exception):
+    '''raised by FakeHTTP in place of a 429 response'''
+
+    status = 429
+
+
+class FakeHTTP:
+
+    def __init__(self, latency=0.0, jitter=0.0, limits=None, global_limit=None, slack=0.002):
+        '''`limits` maps a route to (requests, per_seconds), enforced per (route, major)'''
+        self.latency = latency
+        self.jitter = jitter
+        self.limits = limits or {}
+        self.global_limit = global_limit
+        # calls a little closer together than the limit allows are let through, as clocks differ
+        self.slack = slack
+        self.calls = Counter()
+        self._windows = {}  # (route, major), or None for global -> times of recent calls
+
+    async def call(self, route, major=None):
+        now = asyncio.get_event_loop().time()
+        checks = [(None, self.global_limit), ((route, major), self.limits.get(route))]
+        for key, limit in checks:
+            if limit is not None:
+                window = self._windows.setdefault(key, deque())
+                while window and window[0] <= now - limit[1] + self.slack:
+                    window.popleft()
+                if len(window) >= limit[0]:
+                    self.calls['429'] += 1
+                    raise RateLimited(route)
+        for key, limit in checks:
+            if limit is not None:
+                self._windows[key].append(now)
+        self.calls[route] += 1
+        if self.latency:
+            await asyncio.sleep(max(0.0, random.gauss(self.latency, self.jitter)))
+
+
+class FakeRole:
+
+    def __init__(self, guild, name, position):
+        self.id = snowflake()
+        self.guild = guild
+        self.name = name
+        self.position = position
+
+    # ordered like discord.Role: by position, then ID
+    def __lt__(self, other):
+        return (self.position, self.id) < (other.position, other.id)
+
+    def __gt__(self, other):
+        return other < self
+
+    def __repr__(self):
+        return '<FakeRole {}>'.format(self.name)
+
+
+class FakeUser:
+
+    def __init__(self, name, user_id=None, bot=False):
+        self.id = snowflake() if user_id is None else user_id
+        self.name = name
+        self.bot = bot
+
+    @property
+    def mention(self):
+        return '<@{}>'.format(self.id)
+
+
+class FakeMember(FakeUser):
+
+    def __init__(self, guild, name, nick=None, roles=(), status=discord.Status.offline, bot=False, member_id=None):
+        super().__init__(name, member_id, bot)
+        self.guild = guild
+        self.nick = nick
+        self.status = status
+        self.roles = [guild.default_role] + sorted(roles)
+
+    @property
+    def top_role(self):
+        return self.roles[-1]
+
+    @property
+    def display_name(self):
+        return self.nick or self.name
+
+    def copy(self, **changes):
+        '''a snapshot like the before/after pair discord.py passes to on_member_update'''
+        other = object.__new__(FakeMember)
+        other.__dict__.update(self.__dict__)
+        other.roles = list(self.roles)
+        other.__dict__.update(changes)
+        return other
+
+    async def edit(self, roles=None, **fields):
+        await self.guild.http.call('member_edit', self.guild.id)
+        if roles is not None:
+            self.roles = [self.guild.default_role] + sorted(r for r in roles if r is not self.guild.default_role)
+
+    async def add_roles(self, *roles):
+        await self.edit(roles=self.roles[1:] + [r for r in roles if r not in self.roles])
+
+    async def remove_roles(self, *roles):
+        await self.edit(roles=[r for r in self.roles[1:] if r not in roles])
+
+
+class FakeGuild:
+
+    def __init__(self, http, role_names=(), guild_id=None):
+        self.id = snowflake() if guild_id is None else guild_id
+        self.http = http
+        self.default_role = FakeRole(self, '@everyone', 0)
+        self.roles = [self.default_role]
+        self.members = {}
+        self.text_channels = []
+        for name in role_names:
+            self.add_role(name)
+
+    def add_role(self, name):
+        role = FakeRole(self, name, len(self.roles))
+        self.roles.append(role)
+        return role
+
+    def role(self, name):
+        return next(r for r in self.roles if r.name == name)
+
+    def add_member(self, name, **kwargs):
+        member = FakeMember(self, name, **kwargs)
+        self.members[member.id] = member
+        return member
+
+    def get_member(self, member_id):
+        return self.members.get(member_id)
+
+    async def query_members(self, query=None, *, limit=5, user_ids=None, presences=False, cache=True):
+        # a gateway request rather than REST, but counted with the calls all the same
+        await self.http.call('query_members', self.id)
+        return [self.members[user_id] for user_id in user_ids if user_id in self.members][:limit]
+
+
+class FakeMessage:
+
+    def __init__(self, channel, author, content, embed=None):
+        self.id = snowflake()
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.content = content
+        self.embed = embed
+        self.reactions = []
+        # commands.Context copies this from the message it's built from
+        self._state = None
+
+    async def edit(self, content=None, **fields):
+        await self.channel.guild.http.call('message_edit', self.channel.id)
+        if content is not None:
+            self.content = content
+
+    async def add_reaction(self, emoji):
+        await self.channel.guild.http.call('add_reaction', self.channel.id)
+        self.reactions.append(emoji)
+
+
+class FakeReaction:
+
+    def __init__(self, message, emoji):
+        self.message = message
+        self.emoji = emoji
+
+    async def remove(self, user):
+        await self.message.channel.guild.http.call('remove_reaction', self.message.channel.id)
+
+
+class FakeChannel:
+
+    def __init__(self, guild, name, bot_user):
+        self.id = snowflake()
+        self.guild = guild
+        self.name = name
+        self.bot_user = bot_user
+        self.sent = []
+        self.on_send = []
+        guild.text_channels.append(self)
+
+    async def send(self, content=None, embed=None, **fields):
+        await self.guild.http.call('send', self.id)
+        msg = FakeMessage(self, self.bot_user, content, embed)
+        self.sent.append(msg)
+        for hook in self.on_send:
+            hook(msg)
+        return msg
+
+
+class FakeContext:
+
+    def __init__(self, channel, author, content=''):
+        self.channel = channel
+        self.guild = channel.guild
+        self.author = author
+        self.message = FakeMessage(channel, author, content)
+
+    async def send(self, content=None, **fields):
+        return await self.channel.send(content, **fields)
+
+
+class FakeBot:
+    '''just enough of commands.Bot for cogs to be constructed and run'''
+
+    def __init__(self, http, loop=None):
+        self.http = http
+        self.loop = loop or asyncio.get_event_loop()
+        self.user = FakeUser('SPARCbot', bot=True)
+        self.guilds = []
+
+    def get_guild(self, guild_id):
+        return next((g for g in self.guilds if g.id == guild_id), None)
+
+    async def fetch_user(self, user_id):
+        await self.http.call('fetch_user')
+        return FakeUser('user{}'.format(user_id % 10000), user_id)
+
+
+class FakeClock:
+    '''virtual time for ReminderScheduler: it only moves when `advance` is awaited'''
+
+    def __init__(self, now):
+        self.current = now
+        self.sleepers = []  # (deadline, n, future)
+        self._n = itertools.count()
+
+    def now(self):
+        return self.current
+
+    def sleep(self, seconds):
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.sleepers, (self.current + datetime.timedelta(seconds=seconds), next(self._n), future))
+        return future
+
+    def waiting(self):
+        '''whether anything is asleep on this clock'''
+        return any(not future.done() for deadline, n, future in self.sleepers)
+
+    async def settle(self, max_steps=100000):
+        '''let the loop run until something is asleep on this clock again'''
+        await asyncio.sleep(0)
+        for _ in range(max_steps):
+            if self.waiting():
+                return
+            await asyncio.sleep(0)
+        raise RuntimeError('nothing went back to sleep on the clock')
+
+    async def advance(self):
+        '''jump to the earliest sleeper's deadline and wake it'''
+        while self.sleepers:
+            deadline, n, future = heapq.heappop(self.sleepers)
+            if not future.done():
+                self.current = max(self.current, deadline)
+                future.set_result(None)
+                break
+        await self.settle()
+
+
+def make_guild(http, config, n_members, online_fraction=0.5):
+    '''a guild with the config's roles and `n_members` members, some holding category roles'''
+    names = [config['novice_role'], config['student_role'], config['staff_role'],
+             config['admin_role'], config['everything_role']]
+    names += [cat['role'] for cat in config['categories'].values()]
+    guild = FakeGuild(http, names)
+    categories = [guild.role(cat['role']) for cat in config['categories'].values()]
+    novice = guild.role(config['novice_role'])
+    student = guild.role(config['student_role'])
+    for i in range(n_members):
+        roles = [novice] if i % 3 == 0 else [student] + random.sample(categories, random.randint(0, 2))
+        status = discord.Status.online if random.random() < online_fraction else discord.Status.offline
+        guild.add_member('member{}'.format(i), nick='nick{}'.format(i) if i % 2 else None, roles=roles, status=status)
+    return guild
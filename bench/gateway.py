@@ -0,0 +1,244 @@
+'''Memory and time-to-ready of the gateway settings, per 10k simulated members.
+
+Run from the repository root:
+
+    python -m bench.gateway [--members 10000 50000] [--online 0.3] [--lookups 500] [--out results.json]
+
+Each run feeds discord.py's real ConnectionState, built with the options
+the bot would get from the config's `gateway` section, a READY and a
+GUILD_CREATE for one large guild whose members are `--online` online. A
+stand-in websocket answers member requests with GUILD_MEMBERS_CHUNK
+payloads, 1000 members each, as Discord does. Payloads are JSON-encoded up
+front and decoded as they're delivered, so decoding counts towards the
+bot's cost but network time doesn't.
+
+Two modes are compared:
+
+    full  the `gateway` section's intents with discord.py's own choices for
+          them: every member cached and the guild chunked at startup
+    lean  the `gateway` section as configured
+
+Reported per mode and size: time from READY until discord.py dispatches
+on_ready (less its guild_ready_timeout wait for more guilds, which is the
+same in every mode), the growth in resident memory by then, members
+cached, and the cost of resolving `--lookups` random members' names the
+way bet tables do: from the cache, else gateway member queries of up to 100
+IDs. `unresolved` counts names that could only be shown as IDs. Every run
+is a fresh process, so one mode's memory can't flatter another's.
+'''
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+GUILD_ID = 400000000000000000
+BOT_ID = 500000000000000000
+FIRST_MEMBER_ID = 600000000000000000
+CHUNK_SIZE = 1000
+GUILD_READY_TIMEOUT = 0.01
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        # no procfs: fall back to the peak, which only grows
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def member_payload(i, role_ids):
+    return {
+        'user': {'id': str(FIRST_MEMBER_ID + i), 'username': 'member{}'.format(i),
+                 'discriminator': '{:04d}'.format(i % 10000), 'avatar': None},
+        'nick': 'nick{}'.format(i) if i % 2 else None,
+        'roles': [role_ids[i % len(role_ids)]] if i % 3 else [],
+        'joined_at': '2020-07-01T12:00:00.000000+00:00',
+        'deaf': False,
+        'mute': False,
+    }
+
+
+def presence_payload(i):
+    return {'user': {'id': str(FIRST_MEMBER_ID + i)}, 'status': 'online', 'activities': [],
+            'client_status': {'desktop': 'online'}}
+
+
+class Payloads:
+    '''the gateway's side of one guild of `n_members`, encoded as Discord would send it'''
+
+    def __init__(self, config, n_members, online):
+        self.n_members = n_members
+        names = [config['novice_role'], config['student_role'], config['staff_role'],
+                 config['admin_role'], config['everything_role']]
+        names += [cat['role'] for cat in config['categories'].values()]
+        roles = [{'id': str(GUILD_ID), 'name': '@everyone', 'position': 0, 'permissions': '0'}]
+        roles += [{'id': str(GUILD_ID + i + 1), 'name': name, 'position': i + 1, 'permissions': '0'}
+                  for i, name in enumerate(names)]
+        self.role_ids = [role['id'] for role in roles[1:]]
+        self.online = set(random.sample(range(n_members), int(n_members * online)))
+        self.ready = json.dumps({
+            'v': 8, 'session_id': 'bench',
+            'user': {'id': str(BOT_ID), 'username': 'SPARCbot', 'discriminator': '0000', 'avatar': None, 'bot': True},
+            'guilds': [{'id': str(GUILD_ID), 'unavailable': True}],
+        })
+        # a large guild's GUILD_CREATE only lists the members who are online
+        online_ids = sorted(self.online)
+        self.guild_create = json.dumps({
+            'id': str(GUILD_ID), 'name': 'SPARC', 'owner_id': str(BOT_ID), 'large': True,
+            'member_count': n_members, 'roles': roles, 'channels': [], 'emojis': [], 'voice_states': [],
+            'members': [member_payload(i, self.role_ids) for i in online_ids],
+            'presences': [presence_payload(i) for i in online_ids],
+        })
+        # each chunk's member list, to be wrapped per request
+        self.chunks = [json.dumps([member_payload(i, self.role_ids) for i in range(start, min(start + CHUNK_SIZE, n_members))])
+                       for start in range(0, n_members, CHUNK_SIZE)]
+
+    def chunk(self, members, nonce, index=0, count=1):
+        return '{{"guild_id": "{}", "nonce": {}, "chunk_index": {}, "chunk_count": {}, "members": {}}}'.format(
+            GUILD_ID, json.dumps(nonce), index, count, members)
+
+
+class FakeWebSocket:
+    '''answers REQUEST_GUILD_MEMBERS with chunks, each delivered on a later loop iteration'''
+
+    def __init__(self, state, payloads):
+        self.state = state
+        self.payloads = payloads
+        self.requests = 0
+        self.queries = 0
+
+    async def request_chunks(self, guild_id, query=None, *, limit, user_ids=None, presences=False, nonce=None):
+        if user_ids is None:
+            self.requests += 1
+            chunks = [self.payloads.chunk(members, nonce, i, len(self.payloads.chunks))
+                      for i, members in enumerate(self.payloads.chunks)]
+        else:
+            self.queries += 1
+            found = [user_id - FIRST_MEMBER_ID for user_id in user_ids
+                     if 0 <= user_id - FIRST_MEMBER_ID < self.payloads.n_members]
+            chunks = [self.payloads.chunk(json.dumps([member_payload(i, self.payloads.role_ids) for i in found]), nonce)]
+        asyncio.ensure_future(self.deliver(chunks))
+
+    async def deliver(self, chunks):
+        for raw in chunks:
+            await asyncio.sleep(0)
+            self.state.parse_guild_members_chunk(json.loads(raw))
+
+
+async def run_child(mode, n_members, online, lookups):
+    from discord.state import ConnectionState
+    from common import config, fetch_members, gateway_options
+    from name_cache import NameCache
+
+    gateway = dict(config['gateway'])
+    if mode == 'full':
+        gateway.update(member_cache=None, chunk_guilds_at_startup=True)
+    options = gateway_options(gateway)
+    payloads = Payloads(config, n_members, online)
+
+    ready = asyncio.Event()
+
+    def dispatch(event, *args, **kwargs):
+        if event == 'ready':
+            ready.set()
+
+    gc.collect()
+    rss_before = rss_bytes()
+    start = time.perf_counter()
+    state = ConnectionState(dispatch=dispatch, handlers={}, hooks={}, syncer=None, http=None,
+                            loop=asyncio.get_event_loop(), guild_ready_timeout=GUILD_READY_TIMEOUT, **options)
+    state.is_bot = True
+    ws = FakeWebSocket(state, payloads)
+    state._get_websocket = lambda guild_id=None, *, shard_id=None: ws
+    state.parse_ready(json.loads(payloads.ready))
+    state.parse_guild_create(json.loads(payloads.guild_create))
+    await ready.wait()
+    ready_s = time.perf_counter() - start - GUILD_READY_TIMEOUT
+    gc.collect()
+    rss_after = rss_bytes()
+    guild = state._get_guild(GUILD_ID)
+    cached = len(guild.members)
+
+    async def unavailable(user_id):
+        raise LookupError(user_id)
+
+    names = NameCache(unavailable, fetch_members if gateway['query_members'] else None)
+    ids = [FIRST_MEMBER_ID + i for i in random.sample(range(n_members), min(lookups, n_members))]
+    start = time.perf_counter()
+    unresolved = 0
+    for i in range(0, len(ids), 10):
+        # a bet table's worth at a time
+        resolved = await names.resolve_many(guild, ids[i:i + 10])
+        unresolved += sum(name == str(user_id) for user_id, name in resolved.items())
+    lookup_s = time.perf_counter() - start
+
+    return {
+        'mode': mode,
+        'members': n_members,
+        'cached_members': cached,
+        'ready_ms': ready_s * 1000,
+        'rss_mib': (rss_after - rss_before) / 2 ** 20,
+        'chunk_requests': ws.requests,
+        'lookups': len(ids),
+        'lookup_ms': lookup_s * 1000,
+        'member_queries': ws.queries,
+        'unresolved': unresolved,
+    }
+
+
+def run_one(mode, n_members, args):
+    '''one measurement in a fresh interpreter'''
+    out = subprocess.run([sys.executable, '-m', 'bench.gateway', '--child', mode, '--members', str(n_members),
+                          '--online', str(args.online), '--lookups', str(args.lookups), '--seed', str(args.seed)],
+                         cwd=REPO, check=True, stdout=subprocess.PIPE, universal_newlines=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--members', type=int, nargs='+', default=[10000, 50000])
+    parser.add_argument('--online', type=float, default=0.3, help='fraction of members online')
+    parser.add_argument('--lookups', type=int, default=500, help='member names to resolve after ready')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write the results as JSON here')
+    parser.add_argument('--child', choices=['full', 'lean'], help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    if args.child:
+        os.chdir(REPO)
+        sys.path.insert(0, REPO)
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        print(json.dumps(loop.run_until_complete(run_child(args.child, args.members[0], args.online, args.lookups))))
+        return 0
+
+    results = []
+    print('{:<5} {:>8} {:>8} {:>10} {:>9} {:>12} {:>11} {:>12} {:>8}'.format(
+        'mode', 'members', 'cached', 'ready_ms', 'rss_mib', 'ms/10k', 'MiB/10k', 'lookup_ms', 'queries'))
+    for n in args.members:
+        for mode in ('full', 'lean'):
+            r = run_one(mode, n, args)
+            results.append(r)
+            per = n / 10000
+            print('{:<5} {:>8} {:>8} {:>10.1f} {:>9.1f} {:>12.1f} {:>11.2f} {:>12.1f} {:>8}'.format(
+                mode, n, r['cached_members'], r['ready_ms'], r['rss_mib'], r['ready_ms'] / per,
+                r['rss_mib'] / per, r['lookup_ms'], r['member_queries']))
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,392 @@
+'''Replay a recording of gateway events (see gateway_recorder) against the real cogs.
+
+Run from the repository root:
+
+    python -m bench.replay recording.jsonl.gz [--speed 1|10|max] [--latency 0.05]
+                           [--limits] [--cogs welcome,bets,calendar] [--drain 30] [--out results.json]
+    python -m bench.replay --synthesize kickoff.jsonl.gz [--members 300] [--minutes 10]
+
+Events go to the same listeners and command processing the live bot uses,
+through a real commands.Bot whose cogs (plus Admin) run against the
+stand-ins in bench.fakes. `--speed 10` replays ten times faster than
+recorded; `max` hands each event over as soon as the previous one has been
+dispatched. Timeouts inside the cogs (tutorial reactions, $schedule idling)
+still run in real time.
+
+Reported: events per second, handler lag (from when an event was due until
+all of its handlers had finished) per event type and per command, handler
+errors, and outbound REST calls by route. With `--limits` the stand-in HTTP
+layer enforces the config's rate limits and the REST scheduler budgets for
+them, as in production.
+
+`--synthesize` writes a made-up kickoff-morning recording (newcomers coming
+online and going through $hello and $tutorial, presence flips, $bet spam and
+$viewbets) for trying the replayer without a recording from a live server.
+'''
+
+import argparse
+import asyncio
+from collections import Counter, defaultdict
+import datetime
+import gzip
+import json
+import os
+import random
+import sys
+import tempfile
+
+from bench.run import REPO, FakeCalendarClient, percentile
+
+SPEEDS = {'1': 1.0, '10': 10.0, 'max': None}
+
+
+def read_recording(path):
+    '''yield (seconds, record), with time carrying on across the sessions in one file'''
+    offset = last = 0.0
+    with gzip.open(path, 'rt') as f:
+        try:
+            for line in f:
+                record = json.loads(line)
+                if record['e'] == 'start':
+                    offset = last
+                    continue
+                last = offset + record['t']
+                yield last, record
+        except (EOFError, ValueError):
+            # the bot was stopped mid-write; everything before that is still good
+            pass
+
+
+def lag_summary(lags):
+    lags = sorted(lags)
+    return {
+        'n': len(lags),
+        'p50_ms': percentile(lags, 0.5) * 1000,
+        'p90_ms': percentile(lags, 0.9) * 1000,
+        'p99_ms': percentile(lags, 0.99) * 1000,
+        'max_ms': (lags[-1] if lags else 0.0) * 1000,
+    }
+
+
+class Replay:
+
+    def __init__(self, common, cogs, fakes, args, workdir):
+        import discord
+        self.discord = discord
+        self.common = common
+        self.fakes = fakes
+        self.args = args
+        config = common.config
+        rest = config['rest']
+        if args.limits:
+            self.http = fakes.FakeHTTP(args.latency, args.latency / 4,
+                                       limits={route: tuple(budget) for route, budget in rest['budgets'].items()},
+                                       global_limit=tuple(rest['global_budget']))
+            common.rest.configure(rest['global_budget'], rest['budgets'], rest['default_budget'],
+                                  rest['background_share'])
+        else:
+            self.http = fakes.FakeHTTP(args.latency, args.latency / 4)
+            common.rest.configure()
+        # Google's quotas aren't Discord's, so Calendar calls are counted apart and never limited
+        self.calendar_http = fakes.FakeHTTP(args.latency, args.latency / 4)
+        self.fake_bot = fakes.FakeBot(self.http)
+        common.names.fetch_user = lambda user_id: common.rest.call(
+            'fetch_user', lambda: self.fake_bot.fetch_user(user_id), key=user_id)
+
+        # events are dispatched through the real Bot, but it never logs in, so
+        # give it the user that get_context compares message authors against
+        self.bot = common.bot
+        self.bot._connection.user = self.fake_bot.user
+        self.bot.add_listener(self.on_command_error, 'on_command_error')
+
+        config.raw['bet_store'] = dict(config.raw['bet_store'], directory=os.path.join(workdir, 'bets'),
+                                       legacy_snapshot_file=None, legacy_journal_file=None, legacy_file=None)
+        config.raw['presence'] = dict(config.raw['presence'], snapshot_file=os.path.join(workdir, 'presence.bin'))
+        config.raw.setdefault('google_api_auth', {'calendar_id': 'replay', 'token_file': os.devnull})
+        self.cogs = []
+        for name in args.cogs:
+            cog = cogs.cog_class(name)(self.fake_bot)
+            if name == 'calendar':
+                cog.client.close()
+                cog.client = cog.events.client = FakeCalendarClient(self.calendar_http, 50)
+            self.bot.add_cog(cog)
+            self.cogs.append(cog)
+        from cogs.admin import Admin
+        self.bot.add_cog(Admin(self.fake_bot))
+
+        self.guilds = {}          # recorded guild ID -> FakeGuild
+        self.channels = {}        # recorded channel ID -> FakeChannel
+        self.messages = {}        # recorded message ID -> FakeMessage, for people's messages
+        self.bot_messages = {}    # recorded message ID -> (channel ID, n) for the bot's nth message there
+        self.bot_counts = Counter()  # channel ID -> bot messages recorded there so far
+        self.lags = defaultdict(list)  # event type or command -> seconds
+        self.errors = Counter()   # event type or command -> handler exceptions
+        self.skipped = 0          # reactions to messages the recording never showed
+
+    def close(self):
+        for cog in self.cogs:
+            self.bot.remove_cog(type(cog).__name__)
+        self.bot.remove_cog('Admin')
+        self.common.role_queue.close()
+
+    async def on_command_error(self, ctx, error):
+        self.errors['command:' + ctx.invoked_with if ctx.invoked_with else 'message'] += 1
+
+    # building stand-ins for what the recording mentions
+
+    def guild(self, guild_id):
+        guild = self.guilds.get(guild_id)
+        if guild is None:
+            config = self.common.config
+            names = [config['novice_role'], config['student_role'], config['staff_role'],
+                     config['admin_role'], config['everything_role']]
+            names += [cat['role'] for cat in config['categories'].values()]
+            guild = self.guilds[guild_id] = self.fakes.FakeGuild(self.http, names, guild_id)
+            # somewhere for reminders to go
+            self.fakes.FakeChannel(guild, config['bot_channel'], self.fake_bot.user)
+            self.fake_bot.guilds.append(guild)
+        return guild
+
+    def channel(self, guild, channel_id):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = self.fakes.FakeChannel(guild, 'replay', self.fake_bot.user)
+            channel.id = channel_id
+        return channel
+
+    def roles(self, guild, names):
+        roles = []
+        for name in names:
+            role = next((r for r in guild.roles if r.name == name), None)
+            roles.append(role if role is not None else guild.add_role(name))
+        return roles
+
+    def member(self, guild, user_id, role_names=None):
+        member = guild.get_member(user_id)
+        if member is None:
+            member = guild.add_member('user{}'.format(user_id % 10000), member_id=user_id,
+                                      roles=self.roles(guild, role_names or ()))
+        return member
+
+    def snapshot(self, member, state):
+        status, nick, role_names = state
+        return member.copy(status=self.discord.Status(status), nick=nick,
+                           roles=[member.guild.default_role] + sorted(self.roles(member.guild, role_names)))
+
+    def reaction_target(self, record):
+        msg = self.messages.get(record['m'])
+        if msg is not None:
+            return msg
+        channel = self.channels.get(record['c'])
+        if channel is None or not channel.sent:
+            return None
+        # the same message the bot sent live if this replay has sent as many, else its latest
+        channel_id, n = self.bot_messages.get(record['m'], (record['c'], len(channel.sent) - 1))
+        return channel.sent[min(n, len(channel.sent) - 1)]
+
+    def build(self, record):
+        '''the (event type, handler coroutine) for a record, or None if there's nothing to run'''
+        guild = self.guild(record['g'])
+        if record['e'] == 'member_update':
+            member = self.member(guild, record['u'], record['b'][2])
+            before, after = self.snapshot(member, record['b']), self.snapshot(member, record['a'])
+            guild.members[member.id] = after
+            return 'member_update', self.dispatch('on_member_update', before, after)
+        if record['e'] == 'message':
+            if record.get('me'):
+                self.bot_messages[record['m']] = (record['c'], self.bot_counts[record['c']])
+                self.bot_counts[record['c']] += 1
+                return None
+            member = self.member(guild, record['u'], record.get('ro'))
+            msg = self.fakes.FakeMessage(self.channel(guild, record['c']), member, record['x'])
+            self.messages[record['m']] = msg
+            prefix = self.common.config['command_prefix']
+            kind = 'command:' + record['x'][len(prefix):].split(' ', 1)[0] if record['x'].startswith(prefix) else 'message'
+            return kind, self.dispatch('on_message', msg, process_commands=True)
+        if record['e'] == 'reaction_add':
+            target = self.reaction_target(record)
+            if target is None:
+                self.skipped += 1
+                return None
+            user = self.member(guild, record['u'])
+            return 'reaction_add', self.dispatch('on_reaction_add', self.fakes.FakeReaction(target, record['r']), user)
+        return None
+
+    async def dispatch(self, event, *args, process_commands=False):
+        '''run every listener for `event` (and commands, for messages) as the bot would; returns handler exceptions'''
+        handlers = [listener(*args) for listener in self.bot.extra_events.get(event, [])]
+        if process_commands:
+            handlers.append(self.bot.process_commands(args[0]))
+        results = await asyncio.gather(*handlers, return_exceptions=True)
+        return sum(1 for r in results if isinstance(r, Exception))
+
+    async def handle(self, kind, due, handler):
+        loop = asyncio.get_event_loop()
+        errors = await handler
+        self.lags[kind].append(loop.time() - due)
+        if errors:
+            self.errors[kind] += errors
+
+    async def run(self, events, speed, drain):
+        loop = asyncio.get_event_loop()
+        start = loop.time()
+        tasks = []
+        n = 0
+        for t, record in events:
+            if speed is None:
+                # let what's been dispatched so far run, as between two gateway frames
+                await asyncio.sleep(0)
+                due = loop.time()
+            else:
+                due = start + t / speed
+                if due > loop.time():
+                    await asyncio.sleep(due - loop.time())
+            built = self.build(record)
+            if built is None:
+                continue
+            n += 1
+            tasks.append(loop.create_task(self.handle(built[0], due, built[1])))
+        dispatched = loop.time() - start
+        done, unfinished = await asyncio.wait(tasks, timeout=drain) if tasks else (set(), set())
+        for task in unfinished:
+            task.cancel()
+        wall = loop.time() - start
+        return {
+            'events': n,
+            'dispatch_s': dispatched,
+            'wall_s': wall,
+            'events_per_s': n / dispatched if dispatched else 0.0,
+            # still running after the drain period, e.g. a $tutorial nobody finished
+            'unfinished': len(unfinished),
+            'skipped_reactions': self.skipped,
+            'lag': {kind: lag_summary(lags) for kind, lags in self.lags.items()},
+            'errors': dict(self.errors),
+            'rest_calls': dict(self.http.calls + self.calendar_http.calls),
+            'rest': self.common.rest.stats(),
+            'role_queue': self.common.role_queue.stats(),
+            'outbox': self.common.outbox.stats(),
+        }
+
+
+def synthesize(path, config, n_members, minutes, seed=0):
+    '''write a made-up kickoff-morning recording in gateway_recorder's format'''
+    rng = random.Random(seed)
+    prefix = config['command_prefix']
+    guild_id, lobby = 1, 10
+    categories = list(config['categories'])
+    novices = set(rng.sample(range(n_members), n_members // 3))
+    records = []
+
+    def member_id(i):
+        return 1000 + i
+
+    def roles(i):
+        if i in novices:
+            return [config['novice_role']]
+        return [config['student_role']] + [config['categories'][c]['role'] for c in rng.sample(categories, 2)]
+
+    def message(t, i, channel, text):
+        records.append({'t': t, 'e': 'message', 'g': guild_id, 'c': channel, 'u': member_id(i),
+                        'm': len(records) + 10 ** 6, 'x': text, 'ro': roles(i)})
+
+    def react(t, i, channel):
+        # m=0 isn't a message the recording saw, so the replayer picks the bot's latest in the channel
+        records.append({'t': t, 'e': 'reaction_add', 'g': guild_id, 'c': channel, 'm': 0,
+                        'u': member_id(i), 'r': '👍'})
+
+    span = minutes * 60.0
+    online = set()
+    for i in range(n_members):
+        # everyone comes online at some point in the morning, and some flip a few more times
+        for _ in range(1 + rng.randint(0, 4)):
+            t = rng.uniform(0, span)
+            going = 'offline' if i in online and rng.random() < 0.5 else 'online'
+            (online.add if going == 'online' else online.discard)(i)
+            before = ['online' if going == 'offline' else 'offline', None, roles(i)]
+            records.append({'t': t, 'e': 'member_update', 'g': guild_id, 'u': member_id(i),
+                            'b': before, 'a': [going, None, before[2]]})
+        t = rng.uniform(0, span * 0.8)
+        if i in novices:
+            # newcomers get a channel each, so their 👍s land on their own tutorial
+            channel = 100 + i
+            message(t, i, channel, prefix + 'hello')
+            message(t + rng.uniform(2, 10), i, channel, prefix + 'tutorial')
+            step = t + 10
+            for _ in range(len(categories) + 1):
+                step += rng.uniform(3, 15)
+                react(step, i, channel)
+        else:
+            for _ in range(rng.randint(0, 4)):
+                t += rng.uniform(1, 30)
+                message(t, i, lobby, prefix + 'bet {} sparkbucks that {} happens'.format(
+                    rng.randint(1, 100), rng.choice(['rain', 'a talk overruns', 'the game ends'])))
+            if rng.random() < 0.5:
+                message(t + rng.uniform(1, 30), i, lobby, prefix + 'viewbets 10')
+    records.sort(key=lambda r: r['t'])
+    with gzip.open(path, 'wt') as f:
+        f.write(json.dumps({'e': 'start', 'prefix': prefix, 't': 0,
+                            'at': datetime.datetime.utcnow().isoformat() + 'Z'}) + '\n')
+        for record in records:
+            record['t'] = round(record['t'], 3)
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+    return len(records)
+
+
+def print_report(report):
+    print('{} events in {:.1f}s ({:.1f}/s), {:.1f}s until handlers finished, {} unfinished'.format(
+        report['events'], report['dispatch_s'], report['events_per_s'], report['wall_s'], report['unfinished']))
+    for kind, lag in sorted(report['lag'].items(), key=lambda item: -item[1]['n']):
+        print('  {:<22} n={:<6} lag p50={:8.2f}ms p90={:8.2f}ms p99={:8.2f}ms  errors={}'.format(
+            kind, lag['n'], lag['p50_ms'], lag['p90_ms'], lag['p99_ms'], report['errors'].get(kind, 0)))
+    print('  REST calls: {}'.format(', '.join('{} {}'.format(n, route)
+                                              for route, n in sorted(report['rest_calls'].items()))))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('recording', nargs='?', help='gzip\'d JSON-lines recording to replay')
+    parser.add_argument('--speed', choices=sorted(SPEEDS), default='1')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated REST round trip, seconds')
+    parser.add_argument('--limits', action='store_true', help='enforce and budget for the config\'s rate limits')
+    parser.add_argument('--cogs', default='welcome,bets,calendar', help='cogs to load besides Admin')
+    parser.add_argument('--drain', type=float, default=30.0, help='seconds to let handlers finish after the last event')
+    parser.add_argument('--out', help='write the report as JSON here')
+    parser.add_argument('--synthesize', metavar='PATH', help='write a made-up kickoff-morning recording and exit')
+    parser.add_argument('--members', type=int, default=300)
+    parser.add_argument('--minutes', type=float, default=10.0)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    args.cogs = [name for name in args.cogs.split(',') if name]
+    random.seed(args.seed)
+
+    # the bot's modules read their config relative to the working directory
+    path = os.path.abspath(args.synthesize or args.recording or parser.error('give a recording or --synthesize'))
+    out = os.path.abspath(args.out) if args.out else None
+    os.chdir(REPO)
+    sys.path.insert(0, REPO)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    import cogs
+    import common
+    from bench import fakes
+
+    if args.synthesize:
+        n = synthesize(path, common.config, args.members, args.minutes, args.seed)
+        print('wrote {} events to {}'.format(n, path))
+        return 0
+
+    with tempfile.TemporaryDirectory() as workdir:
+        replay = Replay(common, cogs, fakes, args, workdir)
+        try:
+            report = loop.run_until_complete(replay.run(read_recording(path), SPEEDS[args.speed], args.drain))
+        finally:
+            replay.close()
+    print_report(report)
+    if out:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
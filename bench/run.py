@@ -0,0 +1,970 @@
+'''Offline benchmarks for the cogs' hot paths.
+
+Drives the real Welcome, Bets and Calendar cogs against the stand-ins in
+bench.fakes and reports latency percentiles, throughput and simulated REST
+calls per scenario. Run from the repository root:
+
+    python -m bench.run [--latency 0.05] [--quick] [--out results.json]
+                        [--baseline previous.json] [--tolerance 0.25]
+
+With --baseline, any scenario whose p50 latency grew (or throughput fell)
+by more than the tolerance is reported and the exit status is 1.
+'''
+
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# statement vocabulary: a few common words and a long tail of rarer ones
+WORDS = ['the', 'will', 'camp', 'talk', 'game'] + ['word{}'.format(i) for i in range(5000)]
+
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+
+def summarize(latencies, wall, calls):
+    latencies = sorted(latencies)
+    return {
+        'n': len(latencies),
+        'p50_ms': percentile(latencies, 0.5) * 1000,
+        'p90_ms': percentile(latencies, 0.9) * 1000,
+        'p99_ms': percentile(latencies, 0.99) * 1000,
+        'max_ms': (latencies[-1] if latencies else 0.0) * 1000,
+        'throughput_per_s': len(latencies) / wall if wall else 0.0,
+        'rest_calls': dict(calls),
+    }
+
+
+def invoke(cog, command, *args):
+    '''call a cog's command directly, as the bot would after parsing arguments'''
+    return getattr(cog, command).callback(cog, *args)
+
+
+async def measure(http, make_call, n, concurrency=1, between=None):
+    '''await `make_call(i)` n times, at most `concurrency` at once'''
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+    before = http.calls.copy()
+
+    async def one(i):
+        async with semaphore:
+            if between is not None:
+                between(i)
+            start = time.perf_counter()
+            await make_call(i)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(n)))
+    wall = time.perf_counter() - start
+    return summarize(latencies, wall, http.calls - before)
+
+
+def check_indexes(store):
+    '''raise if any of the ledger's indexes disagrees with a linear scan of its bets'''
+    from bet_search import tokenize
+    scanned = {'by_bidder': {}, 'by_seller': {}, 'by_status': {}, 'postings': {}}
+    for bet_id in sorted(store.bets):
+        bet = store.bets[bet_id]
+        for index, field in (('by_bidder', 'bidder'), ('by_seller', 'seller'), ('by_status', 'status')):
+            if field in bet:
+                scanned[index].setdefault(bet[field], []).append(bet_id)
+        for word in tokenize(bet['statement']):
+            scanned['postings'].setdefault(word, []).append(bet_id)
+    for index, expected in scanned.items():
+        actual = store.statements.postings if index == 'postings' else getattr(store, index)
+        if actual != expected:
+            wrong = sorted(set(actual) ^ set(expected)) or [k for k in expected if actual[k] != expected[k]]
+            raise RuntimeError('{} disagrees with a scan for {}'.format(index, wrong[:5]))
+    newest = sorted(store.bets, reverse=True)
+    for status in [None] + list(scanned['by_status']):
+        expected = [i for i in newest if status is None or store.bets[i]['status'] == status][:20]
+        found = store.live_before(store.current_bet_id + 1, 20, status and [status])
+        if [bet['bet_id'] for bet in found] != expected:
+            raise RuntimeError('live_before({!r}) disagrees with a scan'.format(status))
+    if store.statements.documents != len(store.bets):
+        raise RuntimeError('statement index counts {} bets, not {}'.format(store.statements.documents, len(store.bets)))
+
+
+async def watch_loop(stalls):
+    '''append how long each 1 ms sleep actually took, until cancelled'''
+    loop = asyncio.get_event_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(0.001)
+        stalls.append(loop.time() - start)
+
+
+class Bench:
+
+    def __init__(self, common, cogs, fakes, args, workdir):
+        self.common = common
+        self.cogs = cogs
+        self.fakes = fakes
+        self.args = args
+        self.workdir = workdir
+        self.http = fakes.FakeHTTP(args.latency, args.latency / 4)
+        self.bot = fakes.FakeBot(self.http)
+        self.guild = fakes.make_guild(self.http, self.common.config, args.members)
+        self.bot.guilds.append(self.guild)
+        self.channel = fakes.FakeChannel(self.guild, self.common.config['bot_channel'], self.bot.user)
+        self.members = list(self.guild.members.values())
+        # module-level helpers were built around the real client
+        self.common.names.fetch_user = lambda user_id: self.common.rest.call(
+            'fetch_user', lambda: self.bot.fetch_user(user_id), key=user_id)
+        # scenarios measure the bot's own cost, so only `contention` applies Discord's limits
+        self.common.rest.configure()
+        self.common.role_queue.rate_per_second = args.role_rate
+        self.common.role_queue.burst = args.role_rate
+
+    def ctx(self, author=None, content=''):
+        return self.fakes.FakeContext(self.channel, author or random.choice(self.members), content)
+
+    def configure(self, section, **values):
+        self.common.config.raw[section] = dict(self.common.config.raw[section], **values)
+
+    # bets
+
+    def make_bets_cog(self, n_bets):
+        '''a Bets cog whose ledger for the guild is a fresh snapshot of `n_bets` bets among its members'''
+        path = os.path.join(self.workdir, 'bets_{}'.format(n_bets))
+        snapshot = {'current_bet_id': n_bets, 'bets': []}
+        statuses = ['open'] * 3 + ['standing', 'pending'] * 2 + ['resolved'] * 5
+        for bet_id in range(1, n_bets + 1):
+            bet = {
+                'bet_id': bet_id,
+                'bidder': random.choice(self.members).id,
+                'status': random.choice(statuses),
+                'statement': '{} sparkbucks that {} comes true'.format(
+                    random.randint(1, 100), ' '.join(random.choice(WORDS) for _ in range(random.randint(2, 8)))),
+            }
+            if bet['status'] in ('pending', 'resolved'):
+                bet['seller'] = random.choice(self.members).id
+            snapshot['bets'].append(bet)
+        # no journal or archive left over from an earlier scenario of the same size
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+        with open(os.path.join(path, '{}.snapshot.json'.format(self.guild.id)), 'w') as f:
+            json.dump(snapshot, f)
+        self.configure('bet_store', directory=path, legacy_snapshot_file=None, legacy_journal_file=None,
+                       legacy_file=None, flush_seconds=0.05)
+        return self.cogs.cog_class('bets')(self.bot)
+
+    async def archive_in_rounds(self, store, rounds):
+        '''archive the ledger's resolved bets as `rounds` segments whose ID ranges all overlap'''
+        ids = list(store.by_status.get('resolved', ()))
+        random.shuffle(ids)
+        for bet_id in ids:
+            store.update(bet_id, status='pending')
+        store.archive_min = 0
+        archived = 0
+        for i in range(rounds):
+            for bet_id in ids[i::rounds]:
+                store.update(bet_id, status='resolved')
+            archived += await store.archive_resolved()
+        return archived
+
+    async def bench_viewbets(self, n_bets):
+        cog = self.make_bets_cog(n_bets)
+        store = await cog.ledgers.get(self.guild.id)
+        ids = list(store.bets)
+        labels = [None, 'open', 'pending', 'resolved']
+
+        def touch_ledger(i):
+            # a ledger change between calls, so every call renders from scratch
+            store.update(random.choice(ids), statement='touched {}'.format(i))
+
+        try:
+            return await measure(self.http, lambda i: invoke(cog, 'viewbets', self.ctx(), 10, labels[i % len(labels)]),
+                                 self.args.iterations, between=touch_ledger)
+        finally:
+            cog.cog_unload()
+
+    async def bench_ledger_open(self, n_bets):
+        '''the first use of a guild's ledger, which loads it, while the loop is timed
+
+        `max_stall_ms` is the longest the loop went without running a task
+        that wakes every millisecond. The ledger loads on an executor thread,
+        so this should stay far below the load itself; what's left is mostly
+        the JSON parser holding the GIL.
+
+        The resolved bets were archived, in segments whose ID ranges overlap,
+        but as after a crash the archiving never reached the journal, so
+        every load also has to find each of them in the archive and drop it
+        from the live ledger.
+        '''
+        # written once; each call is a fresh cog opening the same files
+        cog = self.make_bets_cog(n_bets)
+        store = await cog.ledgers.get(self.guild.id)
+        store.compact_every = float('inf')
+        archived = await self.archive_in_rounds(store, 8)
+        cog.cog_unload()
+        with open(store.journal_file, 'r') as f:
+            records = [line for line in f if json.loads(line)['op'] != 'archive']
+        with open(store.journal_file, 'w') as f:
+            f.writelines(records)
+
+        async def open_ledger(i):
+            cog = self.cogs.cog_class('bets')(self.bot)
+            try:
+                stores = await asyncio.gather(*(cog.ledgers.get(self.guild.id) for _ in range(self.args.concurrency)))
+                if len(stores[0]) != n_bets - archived:
+                    raise RuntimeError('{} live bets after loading, expected {}'.format(len(stores[0]), n_bets - archived))
+            finally:
+                cog.cog_unload()
+
+        stalls = []
+        ticker = asyncio.ensure_future(watch_loop(stalls))
+        try:
+            result = await measure(self.http, open_ledger, 5)
+        finally:
+            ticker.cancel()
+        result['max_stall_ms'] = max(stalls, default=0.0) * 1000
+        result['archived'] = archived
+        return result
+
+    async def bench_viewarchived(self, n_bets):
+        '''$view of archived bets and $viewbets of resolved ones, from an archive of 8 overlapping segments
+
+        Each call reads a different segment than the last, and the cache
+        holds fewer than 8, so most calls decompress one. That happens on an
+        executor thread: `max_stall_ms`, measured as for ledger_open, should
+        stay well below the time a segment takes to read.
+        '''
+        cog = self.make_bets_cog(n_bets)
+        store = await cog.ledgers.get(self.guild.id)
+        await self.archive_in_rounds(store, 8)
+        segments = store.archive.segments
+        # a page of resolved bets that starts in segment i's newest bets, skipping those of the live ledger
+        cursors = [segment['ids'][-1] + 1 for segment in segments]
+
+        async def call(i):
+            segment = segments[i % len(segments)]
+            if i % 2:
+                bet_id = random.choice(segment['ids'])
+                await invoke(cog, 'view', self.ctx(), str(bet_id))
+                if '**bet_id**: {}\n'.format(bet_id) not in self.channel.sent[-1].content:
+                    raise RuntimeError('$view {} showed {!r}'.format(bet_id, self.channel.sent[-1].content))
+            else:
+                bets = await store.latest_before(cursors[i % len(segments)], 10, ['resolved'])
+                if not bets:
+                    raise RuntimeError('no archived bets before {}'.format(cursors[i % len(segments)]))
+
+        stalls = []
+        ticker = asyncio.ensure_future(watch_loop(stalls))
+        try:
+            result = await measure(self.http, call, self.args.iterations)
+        finally:
+            ticker.cancel()
+            cog.cog_unload()
+        result['max_stall_ms'] = max(stalls, default=0.0) * 1000
+        return result
+
+    async def bench_searchbets(self, n_bets):
+        cog = self.make_bets_cog(n_bets)
+        labels = [None, 'open', 'resolved']
+        queries = [' '.join(random.sample(WORDS, random.randint(1, 3))) for _ in range(self.args.iterations)]
+        store = await cog.ledgers.get(self.guild.id)
+
+        def touch_ledger(i):
+            store.create(random.choice(self.members).id, 'will {} happen'.format(random.choice(WORDS)))
+
+        try:
+            return await measure(self.http, lambda i: invoke(cog, 'searchbets', self.ctx(), *queries[i].split(),
+                                                             *([labels[i % 3]] if labels[i % 3] else [])),
+                                 self.args.iterations, between=touch_ledger)
+        finally:
+            cog.cog_unload()
+
+    async def bench_ledger_ops(self, n_ops):
+        '''random creates, takes, resolves, edits, deletes and failed transactions on one ledger
+
+        Afterwards every index is checked against a scan of the bets, both
+        in memory and after reloading the ledger from its files; any
+        mismatch fails the scenario.
+        '''
+        from bet_store import BetStateError, BetStore
+        cog = self.make_bets_cog(1000)
+        store = await cog.ledgers.get(self.guild.id)
+
+        def statement():
+            return '{} sparkbucks that {}'.format(random.randint(1, 100), ' '.join(random.sample(WORDS, 3)))
+
+        def pick(status):
+            ids = store.by_status.get(status)
+            return random.choice(ids) if ids else None
+
+        async def op(i):
+            kind = random.randrange(6)
+            if kind == 0 or not store.bets:
+                store.create(random.choice(self.members).id, statement(), random.choice(['open', 'standing']))
+            elif kind == 1 and pick('open'):
+                store.transition(pick('open'), ('open', 'standing'), seller=random.choice(self.members).id, status='pending')
+            elif kind == 2 and pick('pending'):
+                store.transition(pick('pending'), ('pending',), status='resolved')
+            elif kind == 3:
+                store.update(random.choice(list(store.bets)), statement=statement())
+            elif kind == 4:
+                store.delete(random.choice(list(store.bets)))
+            elif pick('resolved'):
+                # the create must be rolled back along with the failed transition
+                try:
+                    with store.transaction():
+                        store.create(random.choice(self.members).id, statement())
+                        store.transition(pick('resolved'), ('open',), status='pending')
+                except BetStateError:
+                    pass
+
+        try:
+            result = await measure(self.http, op, n_ops)
+            check_indexes(store)
+            await store.flush()
+            check_indexes(BetStore(store.snapshot_file, store.journal_file))
+        finally:
+            cog.cog_unload()
+        return result
+
+    async def bench_contention(self, n_background):
+        '''$viewbets while `n_background` background sends to other channels are queued
+
+        Discord's limits from the config are enforced by the stand-in HTTP
+        layer and budgeted by the REST scheduler, so the background sends
+        take several seconds of global budget to drain; the replies should
+        get ahead of them. Any call the stand-in rejects counts as a 429.
+        '''
+        from rest_scheduler import BACKGROUND
+        budgets = self.common.config['rest']
+        http = self.fakes.FakeHTTP(self.args.latency, self.args.latency / 4,
+                                   limits={route: tuple(budget) for route, budget in budgets['budgets'].items()},
+                                   global_limit=tuple(budgets['global_budget']))
+        self.common.rest.configure(budgets['global_budget'], budgets['budgets'], budgets['default_budget'],
+                                   budgets['background_share'])
+        self.guild.http = self.bot.http = http
+        cog = self.make_bets_cog(1000)
+        try:
+            channels = [self.fakes.FakeChannel(self.guild, 'busy{}'.format(i), self.bot.user) for i in range(n_background)]
+            start = time.perf_counter()
+            background = [self.common.send_now(channel, 'reminder', BACKGROUND) for channel in channels]
+            # each reply in its own channel, so only the global budget is shared with the background sends
+            replies = [self.fakes.FakeChannel(self.guild, 'reply{}'.format(i), self.bot.user)
+                       for i in range(self.args.iterations)]
+            result = await measure(http, lambda i: invoke(cog, 'viewbets', self.fakes.FakeContext(
+                replies[i], random.choice(self.members)), 10), self.args.iterations)
+            await asyncio.gather(*background)
+            result['background_drain_s'] = time.perf_counter() - start
+            result['rest'] = self.common.rest.stats()
+            if http.calls['429']:
+                raise RuntimeError('{} calls were rate limited'.format(http.calls['429']))
+        finally:
+            cog.cog_unload()
+            self.guild.http = self.bot.http = self.http
+            self.common.rest.configure()
+        return result
+
+    async def bench_imout(self, n_bets):
+        cog = self.make_bets_cog(n_bets)
+        store = await cog.ledgers.get(self.guild.id)
+        bidders = [m for m in self.members if store.latest_by_bidder(m.id, ('open', 'standing'))]
+        n = min(self.args.iterations, len(bidders))
+        try:
+            return await measure(self.http, lambda i: invoke(cog, 'imout', self.ctx(bidders[i])), n, self.args.concurrency)
+        finally:
+            cog.cog_unload()
+
+    async def bench_races(self, n_calls):
+        '''$take, $resolve and $imout racing each other over the same few bets
+
+        A small group of members offer bets to each other and all act on
+        them at once. Every change the commands make to the ledger is
+        recorded. The scenario fails if a bet was claimed, resolved or
+        removed twice, changed after it was removed, or ends up in a state
+        those changes don't explain, or if an index disagrees with a scan.
+        '''
+        cog = self.make_bets_cog(1000)
+        store = await cog.ledgers.get(self.guild.id)
+        group = random.sample(self.members, 8)
+        hot = [store.create(random.choice(group).id, 'race {}'.format(i), random.choice(['open', 'standing']))['bet_id']
+               for i in range(50)]
+        initial = {bet_id: dict(store[bet_id]) for bet_id in hot}
+        changes = []
+        commit = store._commit
+
+        def record(record):
+            changes.extend(record['records'] if record['op'] == 'txn' else [record])
+            commit(record)
+        store._commit = record
+
+        async def call(i):
+            command = random.choice(['take', 'take', 'resolve', 'imout'])
+            bet_id = random.choice(hot)
+            try:
+                if command == 'imout':
+                    await invoke(cog, command, self.ctx(random.choice(group)))
+                else:
+                    await invoke(cog, command, self.ctx(random.choice(group)), str(bet_id))
+            except Exception:
+                # acting on a bet someone else removed is refused; anything else is a bug
+                if bet_id in store:
+                    raise
+
+        try:
+            result = await measure(self.http, call, n_calls, self.args.concurrency * 5)
+            claimed, resolved, removed, reoffered = {}, set(), set(), 0
+            for change in changes:
+                if change['op'] == 'create':
+                    reoffered += 1
+                    continue
+                bet_id = change['bet_id']
+                if bet_id in removed:
+                    raise RuntimeError('bet {} changed after it was removed'.format(bet_id))
+                if change['op'] == 'delete':
+                    if bet_id in claimed:
+                        raise RuntimeError('bet {} was removed after being claimed'.format(bet_id))
+                    removed.add(bet_id)
+                elif change['fields'].get('status') == 'pending':
+                    if bet_id in claimed:
+                        raise RuntimeError('bet {} was claimed twice'.format(bet_id))
+                    claimed[bet_id] = change['fields']['seller']
+                elif change['fields'].get('status') == 'resolved':
+                    if bet_id not in claimed or bet_id in resolved:
+                        raise RuntimeError('bet {} was resolved without being claimed once'.format(bet_id))
+                    resolved.add(bet_id)
+            if reoffered != sum(initial[bet_id]['status'] == 'standing' for bet_id in claimed):
+                raise RuntimeError('{} standing bets re-offered for {} claims'.format(reoffered, len(claimed)))
+            for bet_id, bet in initial.items():
+                if bet_id in removed:
+                    expected = None
+                elif bet_id in claimed:
+                    expected = dict(bet, seller=claimed[bet_id], status='resolved' if bet_id in resolved else 'pending')
+                else:
+                    expected = bet
+                if store.get(bet_id) != expected:
+                    raise RuntimeError('bet {} is {}, expected {}'.format(bet_id, store.get(bet_id), expected))
+            check_indexes(store)
+            result.update(claimed=len(claimed), resolved=len(resolved), removed=len(removed))
+        finally:
+            store._commit = commit
+            cog.cog_unload()
+        return result
+
+    async def bench_exportbets(self, n_bets, rounds=1):
+        '''$exportbets of a whole ledger whose resolved bets have been archived in `rounds` segments
+
+        Reports the peak memory traced during the exports as `peak_kib`,
+        which should stay flat as the ledger grows, and how many times a
+        segment was decompressed as `segment_reads`, which must be once per
+        segment per export however the segments' ID ranges overlap.
+        '''
+        import tracemalloc
+        cog = self.make_bets_cog(n_bets)
+        store = await cog.ledgers.get(self.guild.id)
+        await self.archive_in_rounds(store, rounds)
+        expected = 'Exported {} bets'.format(len(store) + len(store.archive))
+        admin = self.guild.add_member('exporter', roles=[self.guild.role(self.common.config['admin_role'])])
+        reads = []
+        for name in ('_load', 'iter_segment'):
+            read = getattr(store.archive, name)
+            setattr(store.archive, name, lambda segment, read=read: reads.append(segment['file']) or read(segment))
+        # gzip'd, so the 100k ledger still fits under the upload limit
+        formats = ['csv.gz', 'jsonl.gz']
+        n = min(self.args.iterations, 5)
+        tracemalloc.start()
+        try:
+            result = await measure(self.http, lambda i: invoke(cog, 'exportbets', self.ctx(admin), 'all', formats[i % 2]), n)
+            result['peak_kib'] = tracemalloc.get_traced_memory()[1] / 1024
+            if self.channel.sent[-1].content != expected:
+                raise RuntimeError('{!r}, expected {!r}'.format(self.channel.sent[-1].content, expected))
+        finally:
+            tracemalloc.stop()
+            cog.cog_unload()
+        result['segment_reads'] = len(reads)
+        if len(reads) != n * len(store.archive.segments):
+            raise RuntimeError('{} segment reads for {} exports of {} segments'.format(
+                len(reads), n, len(store.archive.segments)))
+        return result
+
+    # welcome
+
+    def make_welcome_cog(self):
+        self.configure('presence', snapshot_file=os.path.join(self.workdir, 'presence.bin'))
+        return self.cogs.cog_class('welcome')(self.bot)
+
+    async def bench_presence(self):
+        '''presence flips fired as fast as the handler accepts them
+
+        Also reports PresenceTracker.memory_bytes: `tracker_kib` for the
+        cog's tracker afterwards, and `tracker_kib_per_100k` for a tracker
+        of 100k members once merged, next to `dict_kib_per_100k` for the
+        same members kept as a dict of datetimes, as before the tracker.
+        '''
+        import discord
+        from presence import PresenceTracker
+        cog = self.make_welcome_cog()
+        n = self.args.presence_events
+        events = []
+        for i in range(n):
+            member = random.choice(self.members)
+            going_online = member.status is not discord.Status.online
+            after = member.copy(status=discord.Status.online if going_online else discord.Status.offline)
+            events.append((member.copy(), after))
+            member.status = after.status
+        before = self.http.calls.copy()
+        try:
+            result = await measure(self.http, lambda i: cog.on_member_update(*events[i]), n)
+            # let the role queue drain so the edits it sends are counted too
+            while self.common.role_queue.depth:
+                await asyncio.sleep(0.01)
+        finally:
+            cog.cog_unload()
+        result['rest_calls'] = dict(self.http.calls - before)
+        result['role_queue'] = self.common.role_queue.stats()
+        result['tracker_kib'] = cog.presence.memory_bytes() / 1024
+
+        tracker = PresenceTracker(os.path.join(self.workdir, 'presence_100k.bin'), 3600)
+        now = time.time()
+        member_ids = random.sample(range(10 ** 17, 10 ** 18), 100000)
+        for member_id in member_ids:
+            tracker.mark_offline(member_id, now)
+        tracker.snapshot()  # merges everything into the arrays
+        result['tracker_kib_per_100k'] = tracker.memory_bytes() / 1024
+        seens = {member_id: datetime.datetime.now() for member_id in member_ids}
+        result['dict_kib_per_100k'] = (sys.getsizeof(seens) + sum(
+            sys.getsizeof(k) + sys.getsizeof(v) for k, v in seens.items())) / 1024
+        return result
+
+    async def bench_tutorial(self, sessions):
+        '''`sessions` newcomers going through $tutorial at once, each reacting after a short think time'''
+        self.configure('timeouts', tutorial_react_seconds=30, tutorial_cancel_seconds=30)
+        cog = self.make_welcome_cog()
+        newcomers = [self.guild.add_member('newcomer{}'.format(i), roles=[self.guild.role(self.common.config['novice_role'])])
+                     for i in range(sessions)]
+        channels = []
+        for member in newcomers:
+            channel = self.fakes.FakeChannel(self.guild, 'tutorial', self.bot.user)
+            channels.append(channel)
+
+        async def react_until_done(channel, member, done):
+            while not done.is_set():
+                await asyncio.sleep(self.args.think_time)
+                if channel.sent:
+                    await self.common.reactions.dispatch(self.fakes.FakeReaction(channel.sent[-1], '👍'), member)
+
+        async def run(i):
+            done = asyncio.Event()
+            ctx = self.fakes.FakeContext(channels[i], newcomers[i], '$tutorial')
+            reacting = asyncio.ensure_future(react_until_done(channels[i], newcomers[i], done))
+            try:
+                await invoke(cog, 'tutorial', ctx)
+            finally:
+                done.set()
+                await reacting
+
+        try:
+            return await measure(self.http, run, sessions, concurrency=sessions)
+        finally:
+            cog.cog_unload()
+
+    # calendar
+
+    def make_calendar_cog(self, client):
+        self.common.config.raw.setdefault('google_api_auth', {'calendar_id': 'bench', 'token_file': os.devnull})
+        cog = self.cogs.cog_class('calendar')(self.bot)
+        cog.client.close()
+        cog.client = client
+        cog.events.client = client
+        return cog
+
+    async def bench_upcoming(self, n_events):
+        cog = self.make_calendar_cog(FakeCalendarClient(self.http, n_events))
+        # reminders have their own scenario
+        cog.reminder_task.cancel()
+        try:
+            return await measure(self.http, lambda i: invoke(cog, 'upcoming', self.ctx()), self.args.iterations)
+        finally:
+            cog.cog_unload()
+
+    async def bench_calendar_sync(self, n_events):
+        '''EventCache.sync through the real CalendarClient, over HTTP to FakeCalendarServer
+
+        The client is pointed at the stand-in with the `calendar.api_endpoint`
+        setting and loads a saved token, so only the network is fake. Between
+        syncs a few events are added, moved or cancelled; every 20th sync finds
+        its token expired (an HTTP 410) and starts over with a full listing.
+        Each sync must leave the cache matching the calendar, and an
+        incremental one must only have been sent what changed.
+        '''
+        import pickle
+        from google.oauth2.credentials import Credentials
+        calendar = FakeCalendarServer(n_events, page_size=50)
+        token_file = os.path.join(self.workdir, 'calendar_token.pickle')
+        with open(token_file, 'wb') as f:
+            # no expiry, so it stays valid and is never refreshed
+            pickle.dump(Credentials(token='bench'), f)
+        auth = self.common.config.raw.get('google_api_auth')
+        self.common.config.raw['google_api_auth'] = dict(auth or {}, calendar_id='bench', token_file=token_file)
+        self.configure('calendar', api_endpoint=calendar.start())
+        cog = self.cogs.cog_class('calendar')(self.bot)
+        cog.reminder_task.cancel()
+        full_syncs = 0
+
+        async def sync(i):
+            nonlocal full_syncs
+            changed = calendar.change(random.randint(1, 5)) if i else 0
+            if i and i % 20 == 0:
+                calendar.expire_tokens()
+            sent = calendar.sent
+            await cog.events.sync()
+            if calendar.full_listings > full_syncs:
+                full_syncs = calendar.full_listings
+            elif calendar.sent - sent != changed:
+                raise RuntimeError('an incremental sync was sent {} events for {} changes'.format(calendar.sent - sent, changed))
+            if set(cog.events.events) != calendar.live():
+                raise RuntimeError('the cache disagrees with the calendar after sync {}'.format(i))
+
+        try:
+            result = await measure(self.http, sync, self.args.iterations)
+        finally:
+            cog.cog_unload()
+            calendar.close()
+            self.configure('calendar', api_endpoint=None)
+            if auth is None:
+                del self.common.config.raw['google_api_auth']
+            else:
+                self.common.config.raw['google_api_auth'] = auth
+        if calendar.gone != (self.args.iterations - 1) // 20:
+            raise RuntimeError('{} expired sync tokens were refused, expected {}'.format(
+                calendar.gone, (self.args.iterations - 1) // 20))
+        result.update(requests=calendar.requests, full_syncs=full_syncs, expired=calendar.gone, events_sent=calendar.sent)
+        return result
+
+    async def bench_reminders(self, n_events):
+        '''run the reminder scheduler in virtual time over `n_events` events, some back to back
+
+        Latencies are how long after its reminder time each event's reminder
+        went out, in virtual time. Halfway through, an event is added with
+        $schedule and must get its reminder too.
+        '''
+        now = datetime.datetime.now(datetime.timezone.utc).replace(second=0, microsecond=0)
+        clock = self.fakes.FakeClock(now)
+        minutes = [-60]
+        for _ in range(n_events - 1):
+            minutes.append(minutes[-1] + random.choice([0, 2, 30, 90]))
+        client = FakeCalendarClient(self.http, n_events, now, minutes)
+        cog = self.make_calendar_cog(client)
+        cog.reminders.clock = clock
+        lead = cog.reminders.lead
+        latencies = []
+        reminded = []
+        post = cog.reminders.post
+
+        async def post_and_measure(entries):
+            for start, end, event in entries:
+                latencies.append(max(0.0, (clock.now() - (start - lead)).total_seconds()))
+                reminded.append(event['id'])
+            await post(entries)
+        cog.reminders.post = post_and_measure
+
+        before = self.http.calls.copy()
+        wall = time.perf_counter()
+        try:
+            await clock.settle()
+            end = now + datetime.timedelta(minutes=minutes[-1])
+            scheduled = False
+            while clock.now() < end:
+                if not scheduled and clock.now() >= now + datetime.timedelta(minutes=minutes[-1] / 2):
+                    await self.schedule_event(cog, clock.now() + datetime.timedelta(hours=1))
+                    scheduled = True
+                await clock.advance()
+            wall = time.perf_counter() - wall
+        finally:
+            cog.cog_unload()
+        expected = sum(1 for m in minutes if m > 0) + 1
+        if sorted(set(reminded)) != sorted(reminded) or len(reminded) != expected:
+            raise RuntimeError('expected {} reminders, posted {} ({} distinct)'.format(
+                expected, len(reminded), len(set(reminded))))
+        result = summarize(latencies, wall, self.http.calls - before)
+        result['batches'] = cog.reminders.batches
+        return result
+
+    async def schedule_event(self, cog, start):
+        '''add an event through the $schedule wizard'''
+        author = self.members[0]
+        ctx = self.ctx(author)
+        await invoke(cog, 'schedule', ctx)
+        for answer in ['bench event', start.strftime('%Y-%m-%d'), start.strftime('%H:%M'),
+                       (start + datetime.timedelta(minutes=50)).strftime('%H:%M'), 'added mid-run']:
+            await cog.on_message(self.fakes.FakeMessage(self.channel, author, answer))
+
+
+class FakeCalendarClient:
+    '''answers events().list and events().insert like the Calendar API would, with one sync token'''
+
+    def __init__(self, http, n_events, now=None, minutes=None):
+        '''events start `minutes` (default every 30, from an hour ago) after `now`'''
+        self.http = http
+        now = now or datetime.datetime.now(datetime.timezone.utc)
+        minutes = minutes or [30 * i - 60 for i in range(n_events)]
+        self.items = []
+        for i, offset in enumerate(minutes):
+            start = now + datetime.timedelta(minutes=offset)
+            self.items.append({
+                'id': 'event{}'.format(i), 'summary': 'event {}'.format(i),
+                'start': {'dateTime': start.isoformat()},
+                'end': {'dateTime': (start + datetime.timedelta(minutes=50)).isoformat()},
+            })
+
+    async def execute(self, make_request):
+        await self.http.call('calendar')
+        return make_request(self).execute()
+
+    def events(self):
+        return self
+
+    def list(self, syncToken=None, **params):
+        return _Done({'items': [] if syncToken else self.items, 'nextSyncToken': 'token'})
+
+    def insert(self, calendarId, body):
+        # the bot sends local times; the bench keeps everything in UTC
+        event = {
+            'id': 'event{}'.format(len(self.items)), 'summary': body['summary'],
+            'start': {'dateTime': body['start']['dateTime'] + '+00:00'},
+            'end': {'dateTime': body['end']['dateTime'] + '+00:00'},
+            'htmlLink': 'https://calendar.example/event{}'.format(len(self.items)),
+        }
+        self.items.append(event)
+        return _Done(event)
+
+    def close(self):
+        pass
+
+
+class FakeCalendarServer:
+    '''a local HTTP stand-in for the Calendar API's events list, for CalendarClient's `api_endpoint`
+
+    GET {url}calendars/<id>/events pages its results `page_size` at a time and
+    ends with a sync token; given one, it only lists what changed since,
+    cancelled events included. Once `expire_tokens` has been called, earlier
+    tokens are refused with an HTTP 410, as Google does. It serves from its
+    own thread, so the client's discovery document, request building, auth
+    header and HTTP error handling all run for real.
+    '''
+
+    def __init__(self, n_events, page_size=250):
+        self.page_size = page_size
+        self.now = datetime.datetime.now(datetime.timezone.utc)
+        self.items = {}  # event id -> (change number, event)
+        self.changes = 0
+        self.epoch = 0
+        self.requests = 0
+        self.full_listings = 0
+        self.gone = 0
+        self.sent = 0  # events returned by incremental listings
+        for i in range(n_events):
+            self.put({'id': 'event{}'.format(i), 'summary': 'event {}'.format(i)}, 30 * i - 60)
+        self.server = None
+
+    def start(self):
+        '''start serving; returns the URL to use as `api_endpoint`'''
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+        import threading
+        from urllib.parse import parse_qs, urlsplit
+        calendar = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                url = urlsplit(self.path)
+                if not (url.path.startswith('/calendars/') and url.path.endswith('/events')):
+                    self.send_error(404)
+                    return
+                status, body = calendar.list({k: v[0] for k, v in parse_qs(url.query).items()})
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=UTF-8')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+
+    def close(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def put(self, event, minutes):
+        start = self.now + datetime.timedelta(minutes=minutes)
+        event.update(status='confirmed', start={'dateTime': start.isoformat()},
+                     end={'dateTime': (start + datetime.timedelta(minutes=50)).isoformat()})
+        self.changes += 1
+        self.items[event['id']] = (self.changes, event)
+
+    def change(self, n):
+        '''add, move or cancel `n` different events; returns n'''
+        for event_id in random.sample(sorted(self.live()), n - 1) + ['event{}'.format(len(self.items))]:
+            event = dict(self.items[event_id][1]) if event_id in self.items else {'id': event_id, 'summary': event_id}
+            if event_id in self.items and random.random() < 0.3:
+                self.changes += 1
+                self.items[event_id] = (self.changes, dict(event, status='cancelled'))
+            else:
+                self.put(event, random.randint(0, 60 * 24 * 7))
+        return n
+
+    def live(self):
+        return {event['id'] for n, event in self.items.values() if event['status'] != 'cancelled'}
+
+    def expire_tokens(self):
+        self.epoch += 1
+
+    def list(self, params):
+        '''(HTTP status, JSON body) for an events list request'''
+        self.requests += 1
+        sync_token = params.get('syncToken')
+        if sync_token is not None:
+            epoch, since = map(int, sync_token.split(':'))
+            if epoch != self.epoch:
+                self.gone += 1
+                return 410, {'error': {'code': 410, 'message': 'Sync token is no longer valid, a full sync is required.',
+                                       'errors': [{'domain': 'global', 'reason': 'fullSyncRequired'}]}}
+            items = [event for n, event in sorted(self.items.values(), key=lambda item: item[0]) if n > since]
+        else:
+            if 'pageToken' not in params:
+                self.full_listings += 1
+            since = datetime.datetime.fromisoformat(params['timeMin'].rstrip('Z')).replace(tzinfo=datetime.timezone.utc)
+            items = [event for n, event in sorted(self.items.values(), key=lambda item: item[0])
+                     if event['status'] != 'cancelled' and datetime.datetime.fromisoformat(event['end']['dateTime']) > since]
+        offset = int(params.get('pageToken', 0))
+        page = {'kind': 'calendar#events', 'items': items[offset:offset + self.page_size]}
+        if sync_token is not None:
+            self.sent += len(page['items'])
+        if offset + self.page_size < len(items):
+            page['nextPageToken'] = str(offset + self.page_size)
+        else:
+            page['nextSyncToken'] = '{}:{}'.format(self.epoch, self.changes)
+        return 200, page
+
+
+class _Done:
+
+    def __init__(self, result):
+        self.result = result
+
+    def execute(self):
+        return self.result
+
+
+async def run_all(bench, args):
+    sizes = [1000, 10000] if args.quick else [1000, 10000, 100000]
+    scenarios = []
+    for n in sizes:
+        scenarios.append(('ledger_open@{}'.format(n), lambda n=n: bench.bench_ledger_open(n)))
+        scenarios.append(('viewbets@{}'.format(n), lambda n=n: bench.bench_viewbets(n)))
+        scenarios.append(('imout@{}'.format(n), lambda n=n: bench.bench_imout(n)))
+        scenarios.append(('searchbets@{}'.format(n), lambda n=n: bench.bench_searchbets(n)))
+        scenarios.append(('exportbets@{}'.format(n), lambda n=n: bench.bench_exportbets(n)))
+    scenarios.append(('exportbets@10000/8', lambda: bench.bench_exportbets(10000, 8)))
+    scenarios.append(('viewarchived@10000/8', lambda: bench.bench_viewarchived(10000)))
+    scenarios.append(('ledger_ops', lambda: bench.bench_ledger_ops(2000)))
+    scenarios.append(('races', lambda: bench.bench_races(2000)))
+    scenarios.append(('contention', lambda: bench.bench_contention(200)))
+    scenarios.append(('on_member_update', bench.bench_presence))
+    for n in ([20] if args.quick else [20, 200]):
+        scenarios.append(('tutorial x{}'.format(n), lambda n=n: bench.bench_tutorial(n)))
+    scenarios.append(('upcoming', lambda: bench.bench_upcoming(200)))
+    scenarios.append(('calendar_sync', lambda: bench.bench_calendar_sync(500)))
+    scenarios.append(('reminders', lambda: bench.bench_reminders(500)))
+
+    results = {}
+    for name, scenario in scenarios:
+        results[name] = await scenario()
+        r = results[name]
+        print('{:<22} n={:<6} p50={:8.2f}ms p90={:8.2f}ms p99={:8.2f}ms {:10.1f}/s  rest={}'.format(
+            name, r['n'], r['p50_ms'], r['p90_ms'], r['p99_ms'], r['throughput_per_s'], sum(r['rest_calls'].values())))
+    bench.common.role_queue.close()
+    return results
+
+
+def compare(results, baseline, tolerance):
+    regressions = []
+    for name, r in results.items():
+        old = baseline.get('results', {}).get(name)
+        if old is None:
+            continue
+        if old['p50_ms'] and r['p50_ms'] > old['p50_ms'] * (1 + tolerance):
+            regressions.append('{}: p50 {:.2f}ms -> {:.2f}ms'.format(name, old['p50_ms'], r['p50_ms']))
+        if old['throughput_per_s'] and r['throughput_per_s'] < old['throughput_per_s'] / (1 + tolerance):
+            regressions.append('{}: throughput {:.1f}/s -> {:.1f}/s'.format(
+                name, old['throughput_per_s'], r['throughput_per_s']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated REST round trip, seconds')
+    parser.add_argument('--iterations', type=int, default=100, help='calls per command scenario')
+    parser.add_argument('--concurrency', type=int, default=10, help='concurrent callers where it applies')
+    parser.add_argument('--members', type=int, default=2000, help='members in the stand-in guild')
+    parser.add_argument('--presence-events', type=int, default=5000)
+    parser.add_argument('--role-rate', type=float, default=50.0, help='role edits per second allowed')
+    parser.add_argument('--think-time', type=float, default=0.01, help='seconds before a newcomer reacts')
+    parser.add_argument('--quick', action='store_true', help='skip the largest sizes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help='write results as JSON here')
+    parser.add_argument('--baseline', help='JSON from an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+    random.seed(args.seed)
+
+    # the bot module reads its config relative to the working directory
+    os.chdir(REPO)
+    sys.path.insert(0, REPO)
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    import cogs
+    import common
+    from bench import fakes
+
+    with tempfile.TemporaryDirectory() as workdir:
+        bench = Bench(common, cogs, fakes, args, workdir)
+        results = loop.run_until_complete(run_all(bench, args))
+
+    report = {
+        'meta': {'time': datetime.datetime.utcnow().isoformat() + 'Z',
+                 'args': {k: v for k, v in vars(args).items() if k not in ('out', 'baseline')}},
+        'results': results,
+    }
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for line in regressions:
+            print('REGRESSION', line)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
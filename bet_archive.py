@@ -0,0 +1,151 @@
+'''Immutable, gzip-compressed segments of resolved bets, read on demand.
+
+BetStore periodically moves its resolved bets into a new segment, one JSON
+bet per line in ID order, and drops them from the live snapshot. Segments
+never change once written. A small index file lists each segment's file,
+first and last bet ID, size and the IDs of every bet in it, so a lookup
+only opens the one segment that holds the bet (and a miss opens none), plus
+each user's totals over all archived bets so BetTotals doesn't need to read
+the segments on startup. Indexes written before the IDs were kept get them
+filled in, reading each segment once, the first time they're loaded.
+
+Reading a segment decompresses and parses all of it, so `get` and
+`latest_before` are coroutines that do it on an executor thread. Decompressed
+segments are kept in a small LRU cache, since paging through resolved bets
+reads the same segment repeatedly.
+'''
+
+import asyncio
+from bisect import bisect_left
+from collections import OrderedDict
+import gzip
+import heapq
+import json
+import os
+
+from bet_totals import sparkbucks
+from id_lists import contains
+
+
+class BetArchive:
+
+    def __init__(self, prefix, cached_segments=4):
+        self.prefix = prefix
+        self.index_file = prefix + '.index.json'
+        self.cached_segments = cached_segments
+        self.segments = []  # {'file', 'first', 'last', 'count', 'ids'}, oldest first
+        self.totals = {}    # user id -> [offered, taken, sparkbucks] over archived bets
+        self._cache = OrderedDict()  # segment file -> {bet id: bet}
+        self._loading = {}  # segment file -> future of its bets, while being read
+        if os.path.exists(self.index_file):
+            with open(self.index_file, 'r') as f:
+                index = json.load(f)
+            self.segments = index['segments']
+            self.totals = {int(user_id): totals for user_id, totals in index['totals'].items()}
+            missing = [segment for segment in self.segments if 'ids' not in segment]
+            for segment in missing:
+                segment['ids'] = list(self._load(segment))
+            if missing:
+                self._write_index(self.segments, self.totals)
+
+    def __len__(self):
+        return sum(segment['count'] for segment in self.segments)
+
+    async def get(self, bet_id):
+        '''an archived bet, or None'''
+        for segment in reversed(self.segments):
+            if contains(segment['ids'], bet_id):
+                return (await self._read(segment))[bet_id]
+        return None
+
+    def __contains__(self, bet_id):
+        return any(contains(segment['ids'], bet_id) for segment in self.segments)
+
+    async def latest_before(self, bet_id, n):
+        '''up to `n` archived bets older than `bet_id`, newest first
+
+        The IDs are picked from the index, so only segments holding one of
+        them are opened.
+        '''
+        found = []  # (bet id, segment)
+        for segment in self.segments:
+            ids = segment['ids']
+            i = bisect_left(ids, bet_id)
+            found.extend((found_id, segment) for found_id in ids[max(0, i - n):i])
+        found = heapq.nlargest(n, found, key=lambda f: f[0])
+        segments = {segment['file']: segment for found_id, segment in found}
+        bets = {name: await self._read(segment) for name, segment in segments.items()}
+        return [bets[segment['file']][found_id] for found_id, segment in found]
+
+    def iter_segment(self, segment):
+        '''yield a segment's bets in ID order, decompressing as it goes rather than through the cache'''
+        path = os.path.join(os.path.dirname(self.prefix), segment['file'])
+        with gzip.open(path, 'rt') as f:
+            yield from map(json.loads, f)
+
+    def write(self, bets):
+        '''write `bets` as a new segment and update the index; returns the totals they add
+
+        Runs in an executor thread. In-memory state is only swapped at the
+        end, so readers on the loop see either the old archive or the new one.
+        '''
+        bets = sorted(bets, key=lambda bet: bet['bet_id'])
+        n = len(self.segments)
+        name = '{}.{:05d}.jsonl.gz'.format(os.path.basename(self.prefix), n)
+        path = os.path.join(os.path.dirname(self.prefix), name)
+        with gzip.open(path, 'wt') as f:
+            for bet in bets:
+                f.write(json.dumps(bet) + '\n')
+        with open(path, 'rb') as f:
+            os.fsync(f.fileno())
+
+        added = {}
+        for bet in bets:
+            amount = sparkbucks(bet['statement'])
+            for user_id, role in ((bet['bidder'], 0), (bet.get('seller'), 1)):
+                if user_id is not None:
+                    user = added.setdefault(user_id, [0, 0, 0.0])
+                    user[role] += 1
+                    user[2] += amount
+        totals = {user_id: list(user) for user_id, user in self.totals.items()}
+        for user_id, (offered, taken, amount) in added.items():
+            user = totals.setdefault(user_id, [0, 0, 0.0])
+            user[0] += offered
+            user[1] += taken
+            user[2] += amount
+        ids = [bet['bet_id'] for bet in bets]
+        segments = self.segments + [{'file': name, 'first': ids[0], 'last': ids[-1], 'count': len(ids), 'ids': ids}]
+
+        self._write_index(segments, totals)
+        self.segments, self.totals = segments, totals
+        return added
+
+    def _write_index(self, segments, totals):
+        tmp_file = self.index_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'segments': segments, 'totals': totals}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.index_file)
+
+    def _load(self, segment):
+        '''a segment's bets by ID, in ID order, straight from its file'''
+        path = os.path.join(os.path.dirname(self.prefix), segment['file'])
+        with gzip.open(path, 'rt') as f:
+            return OrderedDict((bet['bet_id'], bet) for bet in map(json.loads, f))
+
+    async def _read(self, segment):
+        name = segment['file']
+        bets = self._cache.get(name)
+        if bets is not None:
+            self._cache.move_to_end(name)
+            return bets
+        loading = self._loading.get(name)
+        if loading is None:
+            # readers that miss on the same segment at once share one load
+            loading = self._loading[name] = asyncio.get_event_loop().run_in_executor(None, self._load, segment)
+            loading.add_done_callback(lambda future: self._loading.pop(name, None))
+        bets = self._cache[name] = await asyncio.shield(loading)
+        while len(self._cache) > self.cached_segments:
+            self._cache.popitem(last=False)
+        return bets
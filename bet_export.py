@@ -0,0 +1,127 @@
+'''Write a ledger's bets to a file, as CSV or JSON lines, a chunk at a time.
+
+`export_bets` writes the live bets first, newest first, walking them with
+BetStore.live_before so it holds no iterator into the ledger across
+awaits and bets can be offered, taken or archived while it runs. Each
+chunk is copied on the loop (bets are live dicts). Archived bets follow a
+segment at a time, in the order they were archived: each segment is
+decompressed once, as a stream, on an executor thread, never through the
+archive's cache, so a large archive is read exactly once however its
+segments' ID ranges overlap.
+
+Each chunk's names are resolved in one batch on the loop, then its rows are
+built and encoded on an executor thread into a SpooledTemporaryFile, which
+only spills to disk once it outgrows `spool_bytes`. Memory use is set by
+`chunk_size`, not by the size of the ledger, and the loop is free between
+chunks.
+'''
+
+import asyncio
+import csv
+import gzip
+import io
+from itertools import islice
+import json
+import tempfile
+
+FORMATS = ('csv', 'jsonl')
+COLUMNS = ('bet_id', 'bidder', 'bidder_name', 'seller', 'seller_name', 'status', 'statement')
+
+
+def iter_chunks(store, statuses=None, chunk_size=1000):
+    '''yield lists of copies of live bets newest first, finding each chunk afresh from where the last one ended'''
+    before = store.current_bet_id + 1
+    while True:
+        chunk = store.live_before(before, chunk_size, statuses)
+        if not chunk:
+            return
+        yield [dict(bet) for bet in chunk]
+        before = chunk[-1]['bet_id']
+
+
+def encode(rows, fmt):
+    if fmt == 'csv':
+        buf = io.StringIO()
+        csv.writer(buf).writerows(rows)
+        return buf.getvalue().encode('utf-8')
+    return ''.join(json.dumps(dict(zip(COLUMNS, row))) + '\n' for row in rows).encode('utf-8')
+
+
+class _Writer:
+    '''turns bets into rows and appends them to the spool, through gzip if asked; runs on an executor thread'''
+
+    def __init__(self, spool, fmt, compress, status_labels):
+        self.spool = spool
+        self.fmt = fmt
+        self.status_labels = status_labels
+        # GzipFile leaves a file object it was given open when it's closed
+        self.out = gzip.GzipFile(fileobj=spool, mode='wb') if compress else spool
+        if fmt == 'csv':
+            self.out.write(encode([COLUMNS], fmt))
+
+    def write(self, bets, nicks):
+        rows = []
+        for bet in bets:
+            seller = bet.get('seller')
+            rows.append((bet['bet_id'], bet['bidder'], nicks.get(bet['bidder'], str(bet['bidder'])),
+                         seller, nicks.get(seller, str(seller)) if seller is not None else None,
+                         self.status_labels.get(bet['status'], bet['status']), bet['statement']))
+        self.out.write(encode(rows, self.fmt))
+
+    def close(self):
+        if self.out is not self.spool:
+            self.out.close()
+        self.spool.seek(0)
+
+
+def readable(spool):
+    '''the spool as an io object, which discord.File needs'''
+    # before Python 3.11 SpooledTemporaryFile isn't an IOBase, but the BytesIO or file it wraps is
+    return spool if isinstance(spool, io.IOBase) else spool._file
+
+
+async def export_bets(store, resolve_names, status_labels, statuses=None, fmt='csv', compress=False,
+                      chunk_size=1000, spool_bytes=1 << 20):
+    '''write every bet in `store` with one of `statuses` (default all) to a new spooled file
+
+    Returns (file, number of bets). `resolve_names` is a coroutine function
+    taking user IDs and returning {user id: name}. The file is positioned at
+    its start, and the caller closes it.
+    '''
+    loop = asyncio.get_event_loop()
+    spool = tempfile.SpooledTemporaryFile(max_size=spool_bytes)
+    count = 0
+
+    async def write(chunk):
+        nonlocal count
+        user_ids = {bet['bidder'] for bet in chunk}
+        user_ids.update(bet['seller'] for bet in chunk if bet.get('seller') is not None)
+        nicks = await resolve_names(user_ids) or {}
+        await loop.run_in_executor(None, writer.write, chunk, nicks)
+        count += len(chunk)
+
+    try:
+        writer = _Writer(spool, fmt, compress, status_labels)
+        # resolved bets written while live, in case they're archived before the export gets there
+        written = set()
+        for chunk in iter_chunks(store, statuses, chunk_size):
+            written.update(bet['bet_id'] for bet in chunk if bet['status'] == 'resolved')
+            await write(chunk)
+        if store.archive is not None and (statuses is None or 'resolved' in statuses):
+            for segment in list(store.archive.segments):
+                bets = store.archive.iter_segment(segment)
+                try:
+                    while True:
+                        chunk = await loop.run_in_executor(None, lambda: list(islice(bets, chunk_size)))
+                        if not chunk:
+                            break
+                        chunk = [bet for bet in chunk if bet['bet_id'] not in written]
+                        if chunk:
+                            await write(chunk)
+                finally:
+                    bets.close()
+        await loop.run_in_executor(None, writer.close)
+    except BaseException:
+        spool.close()
+        raise
+    return spool, count
@@ -0,0 +1,85 @@
+'''Inverted index from words in bet statements to bet IDs.
+
+Each word maps to an ascending list of the IDs of bets whose statement
+contains it. BetStore keeps the index current from the same hooks as its
+bidder/seller/status indexes, so creates, standing-bet clones, edits and
+deletes are all reflected without ever rescanning the ledger.
+
+A query is ranked by the summed rarity (inverse document frequency) of the
+query words a statement contains, newest first among equal scores. Only the
+posting lists of the query words are read, and words found in more than
+COMMON_FRACTION of all statements ("sparkbucks", "that") are never walked
+in full: they only add to the scores of bets matched by rarer words, and
+bets matching nothing but common words follow, newest first.
+'''
+
+import heapq
+import math
+import re
+
+from id_lists import add_id, contains, remove_id
+
+COMMON_FRACTION = 0.1
+
+_WORD = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+
+def tokenize(text):
+    '''the distinct lowercased words of `text`'''
+    return set(_WORD.findall(text.lower()))
+
+
+class StatementIndex:
+
+    def __init__(self):
+        self.postings = {}  # word -> ascending bet IDs
+        self.documents = 0
+
+    def add(self, bet_id, statement):
+        self.documents += 1
+        for word in tokenize(statement):
+            add_id(self.postings, word, bet_id)
+
+    def remove(self, bet_id, statement):
+        self.documents -= 1
+        for word in tokenize(statement):
+            remove_id(self.postings, word, bet_id)
+
+    def search(self, query):
+        '''yield IDs of bets matching any word of `query`, best match first'''
+        lists = [self.postings[word] for word in tokenize(query) if word in self.postings]
+        if not lists:
+            return
+        if len(lists) == 1:
+            # every match scores the same, so this is just newest first
+            yield from reversed(lists[0])
+            return
+        limit = self.documents * COMMON_FRACTION
+        rare = [ids for ids in lists if len(ids) <= limit]
+        common = [ids for ids in lists if len(ids) > limit]
+
+        scores = {}
+        for ids in rare:
+            idf = self._idf(ids)
+            for bet_id in ids:
+                scores[bet_id] = scores.get(bet_id, 0.0) + idf
+        for ids in common:
+            idf = self._idf(ids)
+            for bet_id in scores:
+                if contains(ids, bet_id):
+                    scores[bet_id] += idf
+        # heapify is linear, and callers usually only want the first page
+        ranked = [(-score, -bet_id) for bet_id, score in scores.items()]
+        heapq.heapify(ranked)
+        while ranked:
+            yield -heapq.heappop(ranked)[1]
+
+        last = None
+        for bet_id in heapq.merge(*(reversed(ids) for ids in common), reverse=True):
+            if bet_id != last and bet_id not in scores:
+                yield bet_id
+            last = bet_id
+
+    def _idf(self, ids):
+        return math.log(1 + self.documents / len(ids))
+
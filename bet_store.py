@@ -0,0 +1,544 @@
+'''In-memory bet ledger backed by a JSON snapshot and an append-only journal.
+
+Every mutation is applied to memory immediately and queued as one journal
+record. Queued records are written and fsync'd in batches off the event loop,
+and every `compact_every` records the whole ledger is written out as a new
+snapshot and the journal is truncated. On startup the snapshot is loaded and
+the journal replayed on top of it.
+
+Bet IDs are also indexed by bidder, seller and status, each as an ascending
+list, so "newest bets matching X" walks only the matching IDs, and by the
+words of their statements (see bet_search) for `search`. Per-user counts
+and sparkbucks (see bet_totals) are kept in `totals` the same way.
+
+Status changes that depend on the current status go through `transition`
+(or `delete` with `expected`), which only applies if the bet is still in an
+expected state. Several mutations can be grouped with `transaction`, which
+journals them as one record and rolls all of them back if any fails.
+
+With an `archive_prefix`, `archive` moves resolved bets out of the live
+ledger into immutable compressed segments (see bet_archive). Archived bets
+are still returned by `lookup` and by `latest_before` for resolved bets
+(both coroutines, as segments are read off the loop), and still counted in
+`totals`, but no longer searchable or snapshotted.
+
+`BetLedgers` keeps one BetStore per guild, each with its own files, ID
+sequence, locks and flushes, opened the first time the guild uses it. The
+opening (reading the snapshot and replaying the journal) runs on an
+executor thread, so a large ledger doesn't stall the loop while it loads.
+'''
+
+import asyncio
+from bisect import bisect_left
+from contextlib import contextmanager
+import heapq
+import json
+import logging
+import os
+import threading
+import weakref
+
+from bet_archive import BetArchive
+from bet_search import StatementIndex
+from bet_totals import BetTotals
+from id_lists import add_id, remove_id
+
+log = logging.getLogger(__name__)
+
+
+class BetStateError(Exception):
+    '''a bet was not in the state a compare-and-set expected'''
+
+    def __init__(self, bet_id, status):
+        super().__init__('bet {} is {}'.format(bet_id, status))
+        self.bet_id = bet_id
+        self.status = status
+
+
+class BetStore:
+
+    def __init__(self, snapshot_file, journal_file, legacy_file=None,
+                 compact_every=1000, flush_seconds=0.5, archive_prefix=None, archive_min=500):
+        self.snapshot_file = snapshot_file
+        self.journal_file = journal_file
+        self.legacy_file = legacy_file
+        self.compact_every = compact_every
+        self.flush_seconds = flush_seconds
+        self.archive_prefix = archive_prefix
+        self.archive_min = archive_min
+
+        self.bets = {}
+        self.current_bet_id = 0
+        self.by_bidder = {}
+        self.by_seller = {}
+        self.by_status = {}
+        self.statements = StatementIndex()
+        self.totals = BetTotals()
+        # bumped on every mutation so readers can tell when cached views are stale
+        self.version = 0
+
+        self._locks = weakref.WeakValueDictionary()
+        self._txn = None
+        self._archiving = frozenset()
+
+        self._pending = []
+        self._journal_len = 0
+        self._flush_task = None
+        self._io_lock = None
+        self._writing = None  # threading.Event set when the executor's write is done
+        self.load()
+
+    # loading
+
+    def load(self):
+        '''load the snapshot (migrating the legacy log if needed) and replay the journal'''
+        self.bets = {}
+        self.current_bet_id = 0
+        self.by_bidder = {}
+        self.by_seller = {}
+        self.by_status = {}
+        self.statements = StatementIndex()
+        self.totals = BetTotals()
+        self.archive = BetArchive(self.archive_prefix) if self.archive_prefix else None
+        if os.path.exists(self.snapshot_file):
+            with open(self.snapshot_file, 'r') as f:
+                snapshot = json.load(f)
+            self.current_bet_id = snapshot['current_bet_id']
+            for bet in snapshot['bets']:
+                self._put(bet)
+        elif self.legacy_file and os.path.exists(self.legacy_file):
+            self._migrate_legacy()
+
+        self._journal_len = 0
+        if os.path.exists(self.journal_file):
+            with open(self.journal_file, 'r') as f:
+                lines = f.read().split('\n')
+            for n, line in enumerate(lines):
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # a torn final write from a crash is expected; anything else is not
+                    if n >= len(lines) - 2:
+                        log.warning('ignoring truncated record at end of %s', self.journal_file)
+                        break
+                    raise
+                self._apply(record)
+                self._journal_len += 1
+
+        if self.archive is not None:
+            self.totals.add_archived(self.archive.totals)
+            self._drop_archived()
+
+    def _drop_archived(self):
+        '''forget live bets that are already archived, after a crash between writing a segment and journaling it'''
+        last = max((segment['last'] for segment in self.archive.segments), default=0)
+        for bet_id in [i for i in self.by_status.get('resolved', ()) if i <= last]:
+            if bet_id in self.archive:
+                self._unindex(self.bets.pop(bet_id))
+
+    def _migrate_legacy(self):
+        '''one-time import of the old bet_log.json layout ("current_bet_id" plus "bet_N" keys)'''
+        with open(self.legacy_file, 'r') as f:
+            bet_log = json.load(f)
+        self.current_bet_id = bet_log.get('current_bet_id', 0)
+        for key, bet in bet_log.items():
+            if key.startswith('bet_'):
+                self._put(bet)
+        self._write_snapshot(self._snapshot_data())
+        log.info('migrated %d bets from %s to %s', len(self.bets), self.legacy_file, self.snapshot_file)
+
+    # reads
+
+    def get(self, bet_id):
+        return self.bets.get(bet_id)
+
+    def __getitem__(self, bet_id):
+        return self.bets[bet_id]
+
+    def __contains__(self, bet_id):
+        return bet_id in self.bets
+
+    def __len__(self):
+        return len(self.bets)
+
+    async def lookup(self, bet_id):
+        '''like get, but also finds archived bets'''
+        bet = self.bets.get(bet_id)
+        if bet is None and self.archive is not None:
+            bet = await self.archive.get(bet_id)
+        return bet
+
+    def live_before(self, bet_id, n, statuses=None):
+        '''up to `n` live bets older than `bet_id`, newest first, optionally only those with one of `statuses`
+
+        This keeps no position in the ledger between calls, so a caller that
+        awaits between pages can walk a ledger that's changing: it passes the
+        last bet ID it got as the next `bet_id`.
+        '''
+        if statuses is None:
+            statuses = list(self.by_status.keys())
+        ids = []
+        for status in statuses:
+            status_ids = self.by_status.get(status, ())
+            i = bisect_left(status_ids, bet_id)
+            ids.extend(status_ids[max(0, i - n):i])
+        return [self.bets[i] for i in heapq.nlargest(n, ids)]
+
+    async def latest_before(self, bet_id, n, statuses=None):
+        '''like live_before, but archived bets are included when resolved ones are asked for'''
+        bets = {bet['bet_id']: bet for bet in self.live_before(bet_id, n, statuses)}
+        if self.archive is not None and (statuses is None or 'resolved' in statuses):
+            for bet in await self.archive.latest_before(bet_id, n):
+                # a bet is briefly in both while it's being archived
+                bets.setdefault(bet['bet_id'], bet)
+        return [bets[i] for i in heapq.nlargest(n, bets)]
+
+    def latest_by_bidder(self, bidder, statuses):
+        '''the newest bet offered by `bidder` with one of `statuses`, or None'''
+        for bet_id in reversed(self.by_bidder.get(bidder, ())):
+            if self.bets[bet_id]['status'] in statuses:
+                return self.bets[bet_id]
+        return None
+
+    def search(self, query, statuses=None):
+        '''yield bets whose statements share words with `query`, best match first'''
+        for bet_id in self.statements.search(query):
+            bet = self.bets[bet_id]
+            if statuses is None or bet['status'] in statuses:
+                yield bet
+
+    # concurrency
+
+    def lock(self, bet_id):
+        '''an asyncio.Lock for one bet, alive only while someone holds or awaits it'''
+        lock = self._locks.get(bet_id)
+        if lock is None:
+            lock = self._locks[bet_id] = asyncio.Lock()
+        return lock
+
+    @contextmanager
+    def transaction(self):
+        '''group mutations into one journal record that applies all-or-nothing'''
+        if self._txn is not None:
+            # nested transactions just join the outer one
+            yield
+            return
+        self._txn = []
+        try:
+            yield
+        except BaseException:
+            txn, self._txn = self._txn, None
+            for record, undo in reversed(txn):
+                self._undo(*undo)
+            self.version += 1
+            raise
+        txn, self._txn = self._txn, None
+        if txn:
+            self._pending.append(json.dumps({'op': 'txn', 'records': [record for record, undo in txn]}))
+            self._schedule_flush()
+
+    async def archive_resolved(self):
+        '''move every resolved bet into a new archive segment, once there are archive_min of them
+
+        Returns how many were archived. The segment is written and fsync'd
+        before the bets are dropped from the live ledger, and while that
+        happens the bets can't be deleted.
+        '''
+        ids = list(self.by_status.get('resolved', ()))
+        if self.archive is None or self._archiving or len(ids) < self.archive_min:
+            return 0
+        self._archiving = frozenset(ids)
+        try:
+            bets = [dict(self.bets[bet_id]) for bet_id in ids]
+            added = await asyncio.get_event_loop().run_in_executor(None, self.archive.write, bets)
+            self._commit({'op': 'archive', 'bet_ids': ids})
+            self.totals.add_archived(added)
+        finally:
+            self._archiving = frozenset()
+        log.info('archived %d resolved bets from %s', len(ids), self.snapshot_file)
+        return len(ids)
+
+    # mutations
+
+    def create(self, bidder, statement, status='open'):
+        '''add a new bet and return it'''
+        bet = {
+            'bet_id': self.current_bet_id + 1,
+            'bidder': bidder,
+            'status': status,
+            'statement': statement
+        }
+        self._commit({'op': 'create', 'bet': bet})
+        return self.bets[bet['bet_id']]
+
+    def update(self, bet_id, **fields):
+        '''set fields on an existing bet and return it'''
+        if bet_id not in self.bets:
+            raise KeyError(bet_id)
+        if bet_id in self._archiving:
+            raise BetStateError(bet_id, 'being archived')
+        self._commit({'op': 'update', 'bet_id': bet_id, 'fields': fields})
+        return self.bets[bet_id]
+
+    def transition(self, bet_id, expected, **fields):
+        '''like update, but raise BetStateError unless the bet's status is in `expected`'''
+        bet = self.bets[bet_id]
+        if bet['status'] not in expected:
+            raise BetStateError(bet_id, bet['status'])
+        return self.update(bet_id, **fields)
+
+    def delete(self, bet_id, expected=None):
+        '''remove a bet and return it; with `expected`, only if its status is one of those'''
+        bet = self.bets[bet_id]
+        if expected is not None and bet['status'] not in expected:
+            raise BetStateError(bet_id, bet['status'])
+        if bet_id in self._archiving:
+            raise BetStateError(bet_id, 'being archived')
+        self._commit({'op': 'delete', 'bet_id': bet_id})
+        return bet
+
+    def _commit(self, record):
+        if self._txn is not None:
+            bet_id = record['bet']['bet_id'] if record['op'] == 'create' else record['bet_id']
+            before = self.bets.get(bet_id)
+            undo = (bet_id, dict(before) if before is not None else None, self.current_bet_id)
+        self._apply(record)
+        self.version += 1
+        if self._txn is not None:
+            self._txn.append((record, undo))
+        else:
+            self._pending.append(json.dumps(record))
+            self._schedule_flush()
+
+    def _undo(self, bet_id, before, current_bet_id):
+        if before is None:
+            bet = self.bets.pop(bet_id, None)
+            if bet is not None:
+                self._unindex(bet)
+        else:
+            self._put(before)
+        self.current_bet_id = current_bet_id
+
+    def _apply(self, record):
+        # replaying over a snapshot that already contains a record's effects
+        # must be harmless, so every op is idempotent
+        op = record['op']
+        if op == 'create':
+            bet = dict(record['bet'])
+            self._put(bet)
+            self.current_bet_id = max(self.current_bet_id, bet['bet_id'])
+        elif op == 'update':
+            bet = self.bets.get(record['bet_id'])
+            if bet is not None:
+                # status changes are far more common than edits, and leave the words alone
+                words = 'statement' in record['fields']
+                self._unindex(bet, words)
+                bet.update(record['fields'])
+                self._index(bet, words)
+        elif op == 'delete':
+            bet = self.bets.pop(record['bet_id'], None)
+            if bet is not None:
+                self._unindex(bet)
+        elif op == 'archive':
+            # the bets are in a segment now; totals picks them up from the archive
+            for bet_id in record['bet_ids']:
+                bet = self.bets.pop(bet_id, None)
+                if bet is not None:
+                    self._unindex(bet)
+        elif op == 'txn':
+            for r in record['records']:
+                self._apply(r)
+        else:
+            raise ValueError('unknown journal op {!r}'.format(op))
+
+    def _put(self, bet):
+        old = self.bets.get(bet['bet_id'])
+        if old is not None:
+            self._unindex(old)
+        self.bets[bet['bet_id']] = bet
+        self._index(bet)
+
+    def _index(self, bet, words=True):
+        bet_id = bet['bet_id']
+        add_id(self.by_bidder, bet['bidder'], bet_id)
+        if 'seller' in bet:
+            add_id(self.by_seller, bet['seller'], bet_id)
+        add_id(self.by_status, bet['status'], bet_id)
+        self.totals.add(bet)
+        if words:
+            self.statements.add(bet_id, bet['statement'])
+
+    def _unindex(self, bet, words=True):
+        bet_id = bet['bet_id']
+        remove_id(self.by_bidder, bet['bidder'], bet_id)
+        if 'seller' in bet:
+            remove_id(self.by_seller, bet['seller'], bet_id)
+        remove_id(self.by_status, bet['status'], bet_id)
+        self.totals.remove(bet)
+        if words:
+            self.statements.remove(bet_id, bet['statement'])
+
+    # persistence
+
+    def _snapshot_data(self):
+        return {
+            'current_bet_id': self.current_bet_id,
+            'bets': [dict(bet) for bet in self.bets.values()]
+        }
+
+    def _schedule_flush(self):
+        try:
+            loop = asyncio.get_event_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None or not loop.is_running():
+            self.close()
+        elif self._flush_task is None:
+            self._flush_task = loop.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_seconds)
+        await self.flush()
+
+    async def flush(self):
+        '''write queued journal records (and maybe a new snapshot) from an executor thread'''
+        if self._io_lock is None:
+            self._io_lock = asyncio.Lock()
+        async with self._io_lock:
+            self._flush_task = None
+            lines, snapshot = self._take_pending()
+            if lines:
+                done = self._writing = threading.Event()
+
+                def write():
+                    try:
+                        self._write(lines, snapshot)
+                    finally:
+                        done.set()
+                await asyncio.get_event_loop().run_in_executor(None, write)
+
+    def close(self):
+        '''synchronously write anything still queued; safe to call more than once'''
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        # a flush's records were taken (and handed to the executor) before
+        # ours, so they go first, and a compaction mustn't race our append
+        if self._writing is not None:
+            self._writing.wait()
+        lines, snapshot = self._take_pending()
+        if lines:
+            self._write(lines, snapshot)
+
+    def _take_pending(self):
+        # the snapshot must be copied on the loop, at the same moment the
+        # pending records are taken, so it reflects exactly those records
+        lines, self._pending = self._pending, []
+        snapshot = None
+        if lines and self._journal_len + len(lines) >= self.compact_every:
+            snapshot = self._snapshot_data()
+        return lines, snapshot
+
+    def _write(self, lines, snapshot=None):
+        with open(self.journal_file, 'a') as f:
+            f.write('\n'.join(lines) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_len += len(lines)
+        if snapshot is not None:
+            self._write_snapshot(snapshot)
+            with open(self.journal_file, 'w') as f:
+                os.fsync(f.fileno())
+            self._journal_len = 0
+
+    def _write_snapshot(self, snapshot):
+        tmp_file = self.snapshot_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump(snapshot, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.snapshot_file)
+
+
+class BetLedgers:
+
+    def __init__(self, directory, legacy_guild_id=None, legacy_snapshot_file=None,
+                 legacy_journal_file=None, legacy_file=None, **store_options):
+        self.directory = directory
+        # the single pre-partitioning ledger goes to legacy_guild_id, or else
+        # to whichever guild opens its ledger first (recorded in legacy_owner)
+        self.legacy_guild_id = legacy_guild_id
+        self.legacy_snapshot_file = legacy_snapshot_file
+        self.legacy_journal_file = legacy_journal_file
+        self.legacy_file = legacy_file
+        self.store_options = store_options
+        self.stores = {}  # guild id -> BetStore
+        self._opening = {}  # guild id -> future of a BetStore being loaded
+        # ledgers open on executor threads; only one at a time may claim and move the legacy files
+        self._legacy_lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    async def get(self, guild_id):
+        '''the guild's ledger, loading it off the loop if this is its first use'''
+        store = self.stores.get(guild_id)
+        if store is not None:
+            return store
+        opening = self._opening.get(guild_id)
+        if opening is None:
+            opening = self._opening[guild_id] = asyncio.get_event_loop().run_in_executor(None, self._open, guild_id)
+            opening.add_done_callback(lambda future: self._opened(guild_id, future))
+        # everyone who asks while it loads waits on the same load, and giving up doesn't cancel it
+        return await asyncio.shield(opening)
+
+    def _opened(self, guild_id, future):
+        del self._opening[guild_id]
+        if not future.cancelled() and future.exception() is None:
+            self.stores[guild_id] = future.result()
+
+    def __iter__(self):
+        '''(guild id, BetStore) for each ledger opened so far'''
+        return iter(self.stores.items())
+
+    def close(self):
+        for store in self.stores.values():
+            store.close()
+
+    def _open(self, guild_id):
+        snapshot_file = os.path.join(self.directory, '{}.snapshot.json'.format(guild_id))
+        journal_file = os.path.join(self.directory, '{}.journal.jsonl'.format(guild_id))
+        archive_prefix = os.path.join(self.directory, '{}.archive'.format(guild_id))
+        legacy_file = None
+        with self._legacy_lock:
+            if self._owns_legacy(guild_id):
+                if (self.legacy_snapshot_file and os.path.exists(self.legacy_snapshot_file)
+                        and not os.path.exists(snapshot_file)):
+                    os.replace(self.legacy_snapshot_file, snapshot_file)
+                    if self.legacy_journal_file and os.path.exists(self.legacy_journal_file):
+                        os.replace(self.legacy_journal_file, journal_file)
+                    log.info('moved %s into the ledger for guild %s', self.legacy_snapshot_file, guild_id)
+                legacy_file = self.legacy_file
+        return BetStore(snapshot_file, journal_file, legacy_file, archive_prefix=archive_prefix, **self.store_options)
+
+    def _owns_legacy(self, guild_id):
+        if self.legacy_guild_id is not None:
+            return guild_id == self.legacy_guild_id
+        owner_file = os.path.join(self.directory, 'legacy_owner')
+        if os.path.exists(owner_file):
+            with open(owner_file, 'r') as f:
+                return f.read().strip() == str(guild_id)
+        if not any(path and os.path.exists(path) for path in
+                   (self.legacy_snapshot_file, self.legacy_journal_file, self.legacy_file)):
+            return False
+        try:
+            # created exclusively, so even another process can't claim it too
+            fd = os.open(owner_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            with open(owner_file, 'r') as f:
+                return f.read().strip() == str(guild_id)
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(guild_id))
+        log.info('guild %s is the first to use bets, so it gets the pre-existing ledger', guild_id)
+        return True
+
@@ -0,0 +1,111 @@
+'''Per-user bet counts and sparkbucks, kept current as the ledger changes.
+
+BetStore feeds every bet it indexes or unindexes through `add`/`remove`, so
+each status transition moves a bet from one bucket to another for both its
+bidder and its seller. Nothing here ever scans the ledger.
+
+A user's totals are bet counts by status as bidder ("offered") and as
+seller ("taken"), and the sparkbucks named in those bets' statements by
+status. Users are also kept sorted by each of RANKINGS, so a top-k
+leaderboard reads k entries off the end of a list.
+'''
+
+from bisect import bisect_left, insort
+from collections import Counter
+import re
+
+# "50 sparkbucks", "2.5 sparkbuck", "10sb"
+SPARKBUCKS = re.compile(r'(\d+(?:\.\d+)?)\s*(?:sparkbucks?|sb)\b', re.IGNORECASE)
+
+# bets a user is in, and sparkbucks riding on bets that have been taken
+RANKINGS = ('bets', 'sparkbucks')
+
+
+def sparkbucks(statement):
+    '''the first sparkbucks amount in a statement, or 0'''
+    match = SPARKBUCKS.search(statement)
+    return float(match.group(1)) if match else 0.0
+
+
+class UserTotals:
+
+    __slots__ = ('offered', 'taken', 'sparkbucks')
+
+    def __init__(self):
+        self.offered = Counter()     # status -> bets as bidder
+        self.taken = Counter()       # status -> bets as seller
+        self.sparkbucks = Counter()  # status -> sparkbucks in those bets
+
+    def __bool__(self):
+        return bool(self.offered or self.taken)
+
+    def scores(self):
+        return (sum(self.offered.values()) + sum(self.taken.values()),
+                self.sparkbucks['pending'] + self.sparkbucks['resolved'])
+
+
+class BetTotals:
+
+    def __init__(self):
+        self.users = {}  # user id -> UserTotals
+        self.ranked = {ranking: [] for ranking in RANKINGS}  # ascending (score, user id)
+
+    def get(self, user_id):
+        return self.users.get(user_id)
+
+    def add(self, bet):
+        self._count(bet, 1)
+
+    def remove(self, bet):
+        self._count(bet, -1)
+
+    def add_archived(self, totals):
+        '''count resolved bets that live in the archive, given {user id: [offered, taken, sparkbucks]}'''
+        for user_id, (offered, taken, amount) in totals.items():
+            self._adjust(user_id, 'resolved', offered, taken, amount)
+
+    def top(self, ranking, k):
+        '''the k highest (user id, score) pairs for one of RANKINGS'''
+        return [(user_id, score) for score, user_id in reversed(self.ranked[ranking][-k:])]
+
+    def _count(self, bet, sign):
+        amount = sign * sparkbucks(bet['statement'])
+        self._adjust(bet['bidder'], bet['status'], sign, 0, amount)
+        if bet.get('seller') is not None:
+            self._adjust(bet['seller'], bet['status'], 0, sign, amount)
+
+    def _adjust(self, user_id, status, offered, taken, amount):
+        totals = self.users.get(user_id)
+        if totals is None:
+            totals = self.users[user_id] = UserTotals()
+        before = totals.scores()
+        if offered:
+            _bump(totals.offered, status, offered)
+        if taken:
+            _bump(totals.taken, status, taken)
+        if amount:
+            _bump(totals.sparkbucks, status, amount)
+        after = totals.scores()
+        for ranking, old, new in zip(RANKINGS, before, after):
+            if old != new:
+                self._rerank(self.ranked[ranking], user_id, old, new)
+        if not totals:
+            del self.users[user_id]
+
+    @staticmethod
+    def _rerank(ranked, user_id, old, new):
+        if old > 0:
+            i = bisect_left(ranked, (old, user_id))
+            if i < len(ranked) and ranked[i] == (old, user_id):
+                del ranked[i]
+        if new > 0:
+            insort(ranked, (new, user_id))
+
+
+def _bump(counter, key, delta):
+    value = counter[key] + delta
+    # sparkbucks are floats, so don't let rounding leave a phantom balance
+    if abs(value) < 1e-9:
+        del counter[key]
+    else:
+        counter[key] = value
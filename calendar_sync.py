@@ -0,0 +1,152 @@
+'''Long-lived Google Calendar client and a locally synced event cache.
+
+`CalendarClient` loads (or obtains) OAuth credentials and builds the API
+service once, refreshing the credentials only when they expire. All calls
+go through one worker thread because the underlying httplib2 connection is
+not thread-safe.
+
+`EventCache` does one bounded full listing and then keeps itself current
+with the Calendar API's sync tokens, so each later sync only transfers
+events that changed since the previous one.
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import datetime
+import logging
+from os.path import exists as file_exists
+import pickle
+
+from dateutil.parser import parse as parse_datetime
+from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from google_auth_oauthlib.flow import InstalledAppFlow
+from google.auth.transport.requests import Request
+
+from metrics import registry as metrics
+
+log = logging.getLogger(__name__)
+
+
+class CalendarClient:
+
+    def __init__(self, auth, api_endpoint=None):
+        '''`auth` is the "google_api_auth" section of the config'''
+        self.auth = auth
+        self.api_endpoint = api_endpoint
+        self.creds = None
+        self._service = None
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = asyncio.Lock()
+
+    def run(self, fun):
+        '''run a blocking call on the client's worker thread'''
+        return asyncio.get_event_loop().run_in_executor(self._executor, fun)
+
+    async def service(self):
+        '''the Calendar service, built on first use and kept for the life of the cog'''
+        async with self._lock:
+            if self.creds is None and file_exists(self.auth['token_file']):
+                self.creds = await self.run(self._load_token)
+            if not self.creds or not self.creds.valid:
+                if self.creds and self.creds.expired and self.creds.refresh_token:
+                    await self.run(lambda: self.creds.refresh(Request()))
+                else:
+                    flow = InstalledAppFlow.from_client_config(self.auth['credentials'], self.auth['scopes'])
+                    self.creds = await self.run(lambda: flow.run_local_server(port=0))
+                    # a new credentials object needs a new service to go with it
+                    self._service = None
+                await self.run(self._save_token)
+            if self._service is None:
+                options = {'api_endpoint': self.api_endpoint} if self.api_endpoint else None
+                self._service = await self.run(lambda: build(
+                    'calendar', 'v3', credentials=self.creds, cache_discovery=False, client_options=options))
+            return self._service
+
+    async def execute(self, make_request):
+        '''build a request with `make_request(service)` and execute it off the loop'''
+        service = await self.service()
+        with metrics.timer('rest', 'calendar_execute'):
+            return await self.run(lambda: make_request(service).execute())
+
+    def close(self):
+        self._executor.shutdown(wait=False)
+
+    def _load_token(self):
+        with open(self.auth['token_file'], 'rb') as token:
+            return pickle.load(token)
+
+    def _save_token(self):
+        with open(self.auth['token_file'], 'wb') as token:
+            pickle.dump(self.creds, token)
+
+
+class EventCache:
+
+    def __init__(self, client, calendar_id, sync_seconds=60, lookback_days=1):
+        self.client = client
+        self.calendar_id = calendar_id
+        self.sync_seconds = sync_seconds
+        self.lookback_days = lookback_days
+        self.events = {}  # event id -> (start, end, event) for timed events
+        self.version = 0  # bumped on every change to `events`
+        self.sync_token = None
+        self.last_sync = None
+        self._sorted = None
+        self._lock = asyncio.Lock()
+
+    async def refresh(self):
+        '''sync if the cache is older than `sync_seconds`'''
+        loop = asyncio.get_event_loop()
+        if self.last_sync is None or loop.time() - self.last_sync >= self.sync_seconds:
+            await self.sync()
+
+    async def sync(self):
+        '''fetch changes since the last sync, or everything if there is no usable sync token'''
+        async with self._lock:
+            if self.sync_token is not None:
+                try:
+                    await self._list(syncToken=self.sync_token)
+                except HttpError as e:
+                    if e.resp.status != 410:
+                        raise
+                    # the token expired server-side; start over
+                    log.info('calendar sync token expired, doing a full sync')
+                    self.sync_token = None
+            if self.sync_token is None:
+                self.events = {}
+                self._sorted = None
+                self.version += 1
+                since = datetime.datetime.utcnow() - datetime.timedelta(days=self.lookback_days)
+                await self._list(timeMin=since.isoformat() + 'Z')
+            self.last_sync = asyncio.get_event_loop().time()
+
+    async def _list(self, **params):
+        page_token = None
+        while True:
+            result = await self.client.execute(lambda service: service.events().list(
+                calendarId=self.calendar_id, singleEvents=True, pageToken=page_token, **params))
+            for event in result.get('items', []):
+                self.add(event)
+            page_token = result.get('nextPageToken')
+            if not page_token:
+                self.sync_token = result.get('nextSyncToken', self.sync_token)
+                return
+
+    def add(self, event):
+        '''apply one event resource (new, changed or cancelled) to the cache'''
+        self._sorted = None
+        self.version += 1
+        if event.get('status') == 'cancelled' or 'dateTime' not in event.get('start', {}):
+            self.events.pop(event['id'], None)
+            return
+        self.events[event['id']] = (
+            parse_datetime(event['start']['dateTime']),
+            parse_datetime(event['end']['dateTime']),
+            event)
+
+    def between(self, start, end):
+        '''timed events that haven't ended by `start` and begin before `end`, by start time'''
+        if self._sorted is None:
+            self._sorted = sorted(self.events.values(), key=lambda e: e[0])
+        return [event for s, e, event in self._sorted if e > start and s < end]
@@ -0,0 +1,36 @@
+'''The bot's cogs, one module each.
+
+A cog's module is only imported when the cog is added, at startup or with
+`$cogmod add`, so cogs that aren't in use don't cost any import time.
+'''
+
+import importlib
+import logging
+import time
+
+log = logging.getLogger(__name__)
+
+# $cogmod name -> (module, class). Admin isn't listed because it can't be removed.
+COGS = {
+    'welcome': ('cogs.welcome', 'Welcome'),
+    'calendar': ('cogs.calendar', 'Calendar'),
+    'bets': ('cogs.bets', 'Bets'),
+}
+
+
+def cog_class(name):
+    module, cls = COGS[name]
+    return getattr(importlib.import_module(module), cls)
+
+
+def add(bot, name):
+    '''import (if needed), construct and add one cog; returns it'''
+    start = time.perf_counter()
+    cog = cog_class(name)(bot)
+    bot.add_cog(cog)
+    log.info('added cog %s in %.0f ms', name, (time.perf_counter() - start) * 1000)
+    return cog
+
+
+def remove(bot, name):
+    bot.remove_cog(COGS[name][1])
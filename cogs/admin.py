@@ -0,0 +1,58 @@
+'''Admin-only commands: adding and removing cogs, reloading the config, $stats.'''
+
+import json
+
+from discord.ext import commands
+
+import cogs
+from common import CONFIG_FILE, bot, check_guild_role, config, outbox, rest, role_queue, timed_send
+from config_index import CompiledConfig
+from metrics import registry as metrics
+
+class Admin(commands.Cog):
+
+    async def cog_check(self, ctx):
+        return await check_guild_role(ctx, config['admin_role'], warn=True)
+
+    @commands.command()
+    async def cogmod(self, ctx, cmd: str, cog: str):
+        if cmd not in ['add', 'rmv']:
+            await timed_send(ctx, 'First argument must be "add" or "rmv".')
+            return
+        if cog not in cogs.COGS:
+            await timed_send(ctx, '{} is not a valid cog name.'.format(cog))
+            return
+
+        if cmd == 'add':
+            # the cog's module (and whatever it imports) is loaded here on first use
+            cogs.add(bot, cog)
+        elif cmd == 'rmv':
+            cogs.remove(bot, cog)
+
+    @commands.command(name='reload-config')
+    async def reload_config(self, ctx):
+        try:
+            # build the whole thing before swapping it in, so a bad file changes nothing
+            config.replace(CompiledConfig.load(CONFIG_FILE))
+        except (json.JSONDecodeError, KeyError, OSError) as e:
+            timed_send(ctx, 'Error reloading config. Old config unchanged.')
+            await timed_send(ctx, str(e))
+
+    @commands.command()
+    async def stats(self, ctx, kind: str = None):
+        '''latency, error and rate-limit counts per command / listener / REST call'''
+        from tabulate import tabulate
+        rows = [(k, n, count, '{:.1f}'.format(p50 * 1000), '{:.1f}'.format(p99 * 1000), errors, limited)
+                for k, n, count, p50, p99, errors, limited in metrics.summary(kind)]
+        if not rows:
+            await timed_send(ctx, 'nothing recorded yet')
+            return
+        table = tabulate(rows, headers=['kind', 'name', 'count', 'p50 ms', 'p99 ms', 'errors', '429s'])
+        queue = role_queue.stats()
+        sends = outbox.stats()
+        calls = rest.stats()
+        await timed_send(ctx, '```{}```role queue: {} waiting, {} edits for {} changes\n'
+                              'outbox: {} messages for {} lines\n'
+                              'REST: {} queued, {} sent, {} de-duplicated'.format(
+            table, queue['depth'], queue['edits'], queue['requested'], sends['messages'], sends['requested'],
+            calls['queued'], calls['sent'], calls['deduplicated']))
@@ -0,0 +1,503 @@
+'''Offering, taking, resolving and browsing bets.'''
+
+from asyncio import Lock, sleep
+from collections import OrderedDict
+import atexit
+from itertools import islice
+import logging
+
+import discord
+from discord.ext import commands
+from tabulate import tabulate
+
+from bet_export import FORMATS, export_bets, readable
+from bet_store import BetLedgers, BetStateError
+from bet_totals import RANKINGS
+from common import check_guild_role, config, get_nick_from_id, get_nicks_from_ids, names, reactions, rest, send_now, timed_send
+
+log = logging.getLogger(__name__)
+
+PREV_PAGE = '◀'
+NEXT_PAGE = '▶'
+
+def render_bet_row(bet,nicks):
+    '''one viewbets table row, given names for the bet's users'''
+    bet_row = []
+    for cname in config['bet_log_columns']:
+        #for when sellers don't exist
+        if cname not in bet:
+            val = "N/A"
+        #truncate strings that are too long
+        elif isinstance(bet[cname],str):
+            if cname == 'status':
+                val = config['bet_status'][bet[cname]]
+            else:
+                val = bet[cname][:35] + (bet[cname][35:] and '...')
+        #return nickname or id if not a nickname
+        else:
+            val = nicks.get(bet[cname],str(bet[cname]))
+        bet_row = bet_row+[val]
+    return bet_row
+
+class BetPages:
+    '''lazily rendered pages of one viewbets (or searchbets) query
+
+    Bets are pulled from the store a batch at a time, their names resolved
+    together, and rows packed into pages that fit in one Discord message. A
+    page is only rendered the first time somebody asks for it.
+
+    Nothing here iterates the store across an await: viewbets pages carry on
+    from the last bet ID shown with latest_before, and a search's ranking is
+    taken up front as IDs, skipping any bet deleted or moved to another
+    status before its turn. Pages may be shared by several commands at once,
+    so they render one at a time.
+    '''
+
+    def __init__(self,ctx,store,view,statuses,query=None):
+        self.ctx = ctx
+        self.store = store
+        self.view = view
+        self.statuses = statuses
+        self.query = query
+        if query:
+            self.ids = [bet['bet_id'] for bet in islice(store.search(query,statuses),view)]
+        else:
+            self.ids = None
+            self.before = store.current_bet_id+1
+        self.remaining = view
+        self.lock = Lock()
+        self.version = store.version
+        self.pages = []
+        self.rows = []
+        self.rendered = 0
+        self.done = False
+
+    def has_page(self,n):
+        return n < len(self.pages) or not self.done
+
+    async def page(self,n):
+        '''the text of page `n`, or None if there are fewer pages'''
+        async with self.lock:
+            while len(self.pages) <= n and not self.done:
+                await self.render_next()
+        return self.pages[n] if n < len(self.pages) else None
+
+    async def render_next(self):
+        max_chars = config['bet_pages']['max_chars']
+        page_rows = []
+        while True:
+            if not self.rows:
+                batch = await self.next_batch(min(self.remaining,config['bet_pages']['batch_size']))
+                if not batch:
+                    self.done = True
+                    break
+                nicks = await get_nicks_from_ids(self.ctx,[bet[cname] for bet in batch for cname in ('bidder','seller') if cname in bet])
+                self.rows = [render_bet_row(bet,nicks or {}) for bet in batch]
+            row = self.rows[0]
+            if page_rows and len(self.format(page_rows+[row])) > max_chars:
+                break
+            page_rows.append(self.rows.pop(0))
+            self.rendered += 1
+        if page_rows or not self.pages:
+            self.pages.append(self.format(page_rows))
+
+    async def next_batch(self,n):
+        '''up to `n` more bets from the store, as they are now'''
+        if n <= 0:
+            return []
+        if self.ids is None:
+            batch = await self.store.latest_before(self.before,n,self.statuses)
+            if batch:
+                self.before = batch[-1]['bet_id']
+        else:
+            batch = []
+            while self.ids and len(batch) < n:
+                bet = self.store.get(self.ids.pop(0))
+                if bet is not None and (self.statuses is None or bet['status'] in self.statuses):
+                    batch.append(bet)
+        self.remaining -= len(batch)
+        return batch
+
+    @staticmethod
+    def format(rows):
+        return '```'+tabulate(rows,headers=config['bet_log_columns'])+'```'
+
+class Bets(commands.Cog):
+
+
+    def __init__(self,bot):
+        self.bot = bot
+        # each guild has its own ledger, loaded the first time it's used
+        self.ledgers = BetLedgers(**config['bet_store'])
+        atexit.register(self.ledgers.close)
+        # (guild, view, statuses, query) -> BetPages, replaced once their ledger changes
+        self.bet_pages = OrderedDict()
+        # message id -> (BetPages, page number) for messages with page reactions
+        self.paged_messages = OrderedDict()
+        self.archiver = bot.loop.create_task(self.archive_bets())
+
+    def cog_unload(self):
+        self.archiver.cancel()
+        atexit.unregister(self.ledgers.close)
+        self.ledgers.close()
+        for msg_id in self.paged_messages:
+            reactions.remove(msg_id,self.turn_page)
+
+    async def cog_check(self, ctx):
+        # bets belong to a server's ledger, so there are none in DMs
+        if not ctx.guild:
+            await timed_send(ctx, config['error_messages']['no_DM'])
+            return False
+        return True
+
+    async def ledger(self,ctx):
+        return await self.ledgers.get(ctx.guild.id)
+
+    async def archive_bets(self):
+        '''periodically move resolved bets out of each open ledger into its archive'''
+        while True:
+            await sleep(config['timeouts']['bet_archive_seconds'])
+            for guild_id, store in list(self.ledgers):
+                try:
+                    await store.archive_resolved()
+                except Exception:
+                    log.exception('archiving bets for guild %s failed', guild_id)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.nick != after.nick:
+            names.invalidate(after.id, after.guild.id)
+
+    @commands.Cog.listener()
+    async def on_user_update(self, before, after):
+        if before.name != after.name:
+            names.invalidate(after.id)
+
+    async def turn_page(self, reaction, user):
+        '''routed reactions on a paged viewbets message'''
+        if reaction.message.id not in self.paged_messages:
+            return
+        pages, n = self.paged_messages[reaction.message.id]
+        if str(reaction.emoji) == NEXT_PAGE:
+            n = n + 1
+        elif str(reaction.emoji) == PREV_PAGE:
+            n = n - 1
+        else:
+            return
+        if pages.version != pages.store.version:
+            # the ledger moved on, so re-run the query rather than page through stale rows
+            pages = self.get_bet_pages(pages.ctx,pages.store,pages.view,pages.statuses,pages.query)
+        text = await pages.page(n) if n >= 0 else None
+        if text is not None:
+            self.paged_messages[reaction.message.id] = (pages,n)
+            await rest.call('message_edit', lambda: reaction.message.edit(content=text), major=reaction.message.channel.id)
+        try:
+            await rest.call('remove_reaction', lambda: reaction.remove(user), major=reaction.message.channel.id)
+        except discord.HTTPException:
+            pass
+
+    def get_bet_pages(self,ctx,store,view,statuses,query=None):
+        '''the (cached) pages for a viewbets or searchbets query on ctx's guild's ledger'''
+        key = (ctx.guild.id,view,tuple(statuses) if statuses else None,query)
+        pages = self.bet_pages.get(key)
+        if pages is None or pages.version != store.version:
+            pages = BetPages(ctx,store,view,statuses,query)
+            self.bet_pages[key] = pages
+            while len(self.bet_pages) > config['bet_pages']['cache_entries']:
+                self.bet_pages.popitem(last=False)
+        return pages
+
+    def add_new_bet(self,store,name,statement,status='open'):
+        '''add a new bet to a guild's ledger'''
+        return store.create(name,statement,status)
+
+    def check_author(self,store,ctx,bet_id: int):
+        '''checks if the person giving commands is in the bet'''
+        #check bidder and seller (if it exists)
+        try:
+            bet = store[int(bet_id)]
+            return bet['bidder'] == ctx.author.id or bet.get('seller') == ctx.author.id
+        except KeyError as e:
+            raise Exception('Couldn\'t check author')
+
+    @commands.command()
+    async def bet(self,ctx,*,statement):
+        '''<statement>: create an open bet'''
+        #share a unique bet_id
+        try:
+            #default bet is one-time
+            status = 'open'
+
+            #make an ongoing bet
+            if statement.startswith(config['bet_status']['standing']):
+                statement = statement.split(' ',1)[1]
+                status = 'standing'
+
+            #add the bet
+            bet = self.add_new_bet(await self.ledger(ctx),ctx.author.id,statement,status)
+            bet_id = bet['bet_id']
+            nick = await get_nick_from_id(ctx,ctx.author.id)
+            await timed_send(ctx, nick+' added bet '+str(bet_id)+': \"'+statement+'\"')
+        except Exception as e:
+            await timed_send(ctx, 'Hmm...that didn\'t seem to work.')
+            raise
+
+    @commands.command()
+    async def imout(self,ctx):
+        '''Cancels your most recent unclaimed offer'''
+        #find the author's newest open bet; if someone else claims it first, try the next one
+        store = await self.ledger(ctx)
+        while True:
+            bet = store.latest_by_bidder(ctx.author.id,('open','standing'))
+            if bet is None:
+                break
+            try:
+                async with store.lock(bet['bet_id']):
+                    removed = store.delete(bet['bet_id'],expected=('open','standing'))
+            except (KeyError,BetStateError):
+                continue
+
+            nick = await get_nick_from_id(ctx,ctx.author.id)
+            await timed_send(ctx,'removed bet_'+str(bet['bet_id'])+' by '+nick)
+            return
+        await timed_send(ctx, 'I couldn\'t find any of your open bets')
+
+    @commands.command()
+    async def viewbets(self,ctx,view:int = 10,status:str = None):
+        '''[num_bets] [status]: See log for open, pending, resolved or all bets'''
+        statuses = config.statuses_by_label.get(status,[]) if status else None
+
+        try:
+            #give an update
+            timed_send(ctx,'Viewing latest '+str(view)+' bets ' + ('with status `' + status +'`' if status else ''))
+
+            await self.send_bet_pages(ctx,self.get_bet_pages(ctx,await self.ledger(ctx),view,statuses))
+        except Exception as e:
+            await timed_send(ctx, 'Hmm...that didn\'t seem to work.')
+            raise
+
+    @commands.command()
+    async def searchbets(self,ctx,*terms):
+        '''<terms> [status]: find bets by words in their statements, best matches first'''
+        terms = list(terms)
+        statuses = None
+        if len(terms) > 1 and terms[-1] in config.statuses_by_label:
+            statuses = config.statuses_by_label[terms.pop()]
+        query = ' '.join(terms)
+        if not query:
+            await timed_send(ctx, 'Search for what?')
+            return
+
+        try:
+            pages = self.get_bet_pages(ctx,await self.ledger(ctx),config['bet_pages']['search_results'],statuses,query)
+            await pages.page(0)
+            if not pages.rendered:
+                await timed_send(ctx, 'No bets match `'+query+'`')
+                return
+            await self.send_bet_pages(ctx,pages)
+        except Exception as e:
+            await timed_send(ctx, 'Hmm...that didn\'t seem to work.')
+            raise
+
+    async def send_bet_pages(self,ctx,pages):
+        '''send the first page now; the rest wait for a reaction'''
+        # page turns replace the whole message, so it can't share one with other lines
+        msg = await timed_send(ctx, await pages.page(0), merge=False)
+        if pages.has_page(1):
+            self.paged_messages[msg.id] = (pages,0)
+            reactions.add(msg.id,self.turn_page)
+            while len(self.paged_messages) > config['bet_pages']['tracked_messages']:
+                reactions.remove(self.paged_messages.popitem(last=False)[0],self.turn_page)
+            for emoji in (PREV_PAGE, NEXT_PAGE):
+                await rest.call('add_reaction', lambda: msg.add_reaction(emoji), major=msg.channel.id)
+
+    @commands.command()
+    async def mybets(self,ctx):
+        '''how many bets you're in, by status, and the sparkbucks riding on them'''
+        totals = (await self.ledger(ctx)).totals.get(ctx.author.id)
+        if not totals:
+            await timed_send(ctx, 'You aren\'t in any bets yet.')
+            return
+        rows = []
+        for status,label in config['bet_status'].items():
+            if totals.offered[status] or totals.taken[status]:
+                rows.append([label,totals.offered[status],totals.taken[status],'{:g}'.format(totals.sparkbucks[status])])
+        await timed_send(ctx, '```'+tabulate(rows,headers=['status','offered','taken','sparkbucks'])+'```')
+
+    @commands.command()
+    async def leaderboard(self,ctx,ranking:str = 'sparkbucks',n:int = 10):
+        '''[bets|sparkbucks] [n]: Admin-only, who is in the most bets or has the most sparkbucks riding on taken bets'''
+        if not await check_guild_role(ctx, config['admin_role'], warn=True):
+            return
+        if ranking not in RANKINGS:
+            await timed_send(ctx, 'Rank by one of: '+', '.join(RANKINGS))
+            return
+        top = (await self.ledger(ctx)).totals.top(ranking,n)
+        if not top:
+            await timed_send(ctx, 'Nobody is in any bets yet.')
+            return
+        nicks = await get_nicks_from_ids(ctx,[user_id for user_id,score in top])
+        rows = [[i+1,nicks.get(user_id,str(user_id)),'{:g}'.format(score)] for i,(user_id,score) in enumerate(top)]
+        await timed_send(ctx, '```'+tabulate(rows,headers=['','name',ranking])+'```')
+
+    @commands.command()
+    async def exportbets(self,ctx,status:str = 'all',format:str = 'csv'):
+        '''[status|all] [csv|jsonl][.gz]: Admin-only, upload the whole ledger, archived bets included, as a file'''
+        if not await check_guild_role(ctx, config['admin_role'], warn=True):
+            return
+        if status.split('.')[0] in FORMATS:
+            # $exportbets jsonl
+            status,format = 'all',status
+        fmt,_,compress = format.partition('.')
+        if fmt not in FORMATS or compress not in ('','gz'):
+            await timed_send(ctx, 'Export as one of: '+', '.join(f+ext for f in FORMATS for ext in ('','.gz')))
+            return
+        if status == 'all':
+            statuses = None
+        elif status in config.statuses_by_label:
+            statuses = config.statuses_by_label[status]
+        else:
+            await timed_send(ctx, 'Export bets with one of: all, '+', '.join(config.statuses_by_label))
+            return
+
+        settings = config['bet_export']
+        spool,count = await export_bets(await self.ledger(ctx),lambda ids: get_nicks_from_ids(ctx,ids),config['bet_status'],
+                                        statuses,fmt,compress == 'gz',settings['chunk_size'],settings['spool_bytes'])
+        with spool:
+            if not count:
+                await timed_send(ctx, 'There are no bets to export.')
+                return
+            spool.seek(0,2)
+            size = spool.tell()
+            spool.seek(0)
+            if size > settings['max_upload_bytes']:
+                await timed_send(ctx, 'That export is {:,} bytes, too big to upload; try a status or `.gz`.'.format(size))
+                return
+            filename = 'bets-{}-{}.{}'.format(ctx.guild.id,status,format)
+            await send_now(ctx.channel,'Exported {} bets'.format(count),file=discord.File(readable(spool),filename))
+
+    @commands.command()
+    async def view(self,ctx,bet_id):
+        '''<bet_id>: view the terms for a single bet'''
+        store = await self.ledger(ctx)
+        try:
+            bet = await store.lookup(int(bet_id))
+            if bet is None:
+                raise KeyError(bet_id)
+            message = '>>> '
+            nicks = await get_nicks_from_ids(ctx,[bet[cname] for cname in ('bidder','seller') if cname in bet])
+            if nicks is None:
+                return
+
+            for cname in config['bet_log_columns']:
+                #for when sellers don't exist
+                if cname not in bet:
+                    val = "N/A"
+                #truncate strings that are too long
+                elif isinstance(bet[cname],str):
+                    val = bet[cname]
+                #return nickname or id if not a nickname
+                else:
+                    val = nicks.get(bet[cname],str(bet[cname]))
+                message = message + '**'+cname+'**: '+val+'\n'
+            await timed_send(ctx,message)
+        except KeyError as e:
+            await timed_send(ctx,'That bet doesn\'t exist!')
+            raise
+        except Exception:
+            await timed_send(ctx, 'Hmm...that didn\'t seem to work.')
+            raise
+
+    @commands.command()
+    async def take(self,ctx,bet_id):
+        '''<bet_id>: take an open bet based on id'''
+        store = await self.ledger(ctx)
+        try:
+            bet_id = int(bet_id)
+            async with store.lock(bet_id):
+                bet = store[bet_id]
+                # make it so you can't take your own bets
+                if bet['bidder'] == ctx.author.id:
+                    await timed_send(ctx,'That\'s your own bet!')
+                    return
+
+                # update bet status; claiming a standing bet and re-offering it is one step
+                standing = bet['status'] == 'standing'
+                with store.transaction():
+                    store.transition(bet_id,('open','standing'),seller=ctx.author.id,status='pending')
+
+                    # taking a standing bet creates a new bet
+                    if standing:
+                        self.add_new_bet(store,bet['bidder'],bet['statement'],'standing')
+
+            nick = await get_nick_from_id(ctx,ctx.author.id)
+            await timed_send(ctx,'Bet '+str(bet_id)+' has been claimed by '+nick+'!')
+
+        #bet has already been claimed
+        except BetStateError:
+            await timed_send(ctx,'That bet\'s not up for grabs!')
+        except KeyError as e:
+            await timed_send(ctx,'That bet doesn\'t exist!')
+            raise
+        except Exception:
+            await timed_send(ctx, 'Hmm...that didn\'t seem to work.')
+            raise
+
+    @commands.command()
+    async def resolve(self,ctx,bet_id):
+        '''<bet_id>: resolve a pending bet or delete an open bet by id'''
+        # TODO: add information to trigger the econ-bot depending on who won
+        store = await self.ledger(ctx)
+        try:
+            bet_id = int(bet_id)
+            async with store.lock(bet_id):
+                # only participants can resolve their own bets
+                if not self.check_author(store,ctx,bet_id):
+                    await timed_send(ctx,'You can\'t resolve bets you aren\'t a part of!')
+                    return
+                bet = store[bet_id]
+
+                #open bids can be annulled
+                if bet['status'] in ('open','standing'):
+                    removed = store.delete(bet_id,expected=('open','standing'))
+                    resolved = False
+
+                #pending bids get set to resolved
+                elif config['bet_status'][bet['status']] == 'pending':
+                    store.transition(bet_id,('pending',),status='resolved')
+                    resolved = True
+
+                else:
+                    return
+
+            if resolved:
+                await timed_send(ctx,'Bet '+str(bet_id)+' has been resolved. Use !give-money <@winner> <value> to settle up.')
+            else:
+                nick = await get_nick_from_id(ctx,ctx.author.id)
+                await timed_send(ctx,'removed bet '+str(bet_id)+' by '+nick)
+        except BetStateError:
+            await timed_send(ctx,'That bet\'s not up for grabs!')
+        except KeyError as e:
+            await timed_send(ctx,'That bet doesn\'t exist!')
+            raise
+        except Exception:
+            await timed_send(ctx, 'Hmm...that didn\'t seem to work.')
+            raise
+
+    @commands.command()
+    @commands.has_role('student')
+    async def killbet(self,ctx,bet_id):
+        '''Admin-only, deletes bets'''
+        store = await self.ledger(ctx)
+        try:
+            async with store.lock(int(bet_id)):
+                removed = store.delete(int(bet_id))
+
+            nick = await get_nick_from_id(ctx,ctx.author.id)
+            await timed_send(ctx,nick+' removed bet '+str(bet_id))
+        except KeyError as e:
+            await timed_send(ctx,'That bet doesn\'t exist!')
+            raise
+        except Exception as e:
+            await timed_send(ctx, 'Hmm...that didn\'t seem to work.')
+            raise
@@ -0,0 +1,182 @@
+'''Upcoming events and the $schedule wizard, backed by Google Calendar.
+
+This is the only cog that needs the Google client libraries (through
+calendar_sync), dateutil and humanize, so they are only imported once it
+is added.
+'''
+
+from asyncio import get_event_loop, sleep
+import datetime
+from enum import Enum
+
+from dateutil.parser import parse as parse_datetime
+import discord
+from discord.ext import commands
+from humanize import naturalday
+
+from calendar_sync import CalendarClient, EventCache
+from common import check_guild_role, config, send_now, timed_send
+from metrics import registry as metrics
+from reminders import ReminderScheduler
+from rest_scheduler import BACKGROUND
+
+# a reminder embed can hold at most this many events
+EMBED_FIELDS = 25
+
+class Calendar(commands.Cog):
+
+    class SchedulingProgress(Enum):
+        inactive = 0
+        title = 1
+        date = 2
+        start_time = 3
+        end_time = 4
+        description = 5
+
+    class SchedulingSession:
+        '''one staff member's progress through the $schedule wizard in one channel'''
+
+        def __init__(self, channel, start_message_id):
+            self.channel = channel
+            self.start_message_id = start_message_id
+            self.progress = Calendar.SchedulingProgress.title
+            self.scheduled = {}
+            self.touch()
+
+        def touch(self):
+            self.last_active = get_event_loop().time()
+
+    def __init__(self, bot):
+        self.bot = bot
+        self.client = CalendarClient(config['google_api_auth'], config['calendar']['api_endpoint'])
+        self.events = EventCache(self.client, config['google_api_auth']['calendar_id'],
+                                 config['calendar']['sync_seconds'], config['calendar']['lookback_days'])
+
+        # (channel id, author id) -> SchedulingSession
+        self.sessions = {}
+        self.sweeper = bot.loop.create_task(self.sweep_sessions())
+
+        self.reminders = ReminderScheduler(self.events, self.post_reminders, **config['reminders'])
+        self.reminder_task = bot.loop.create_task(self.reminders.run())
+
+    def cog_unload(self):
+        self.sweeper.cancel()
+        self.reminder_task.cancel()
+        self.client.close()
+
+    async def cog_check(self, ctx):
+        return await check_guild_role(ctx, config['staff_role'], warn=True)
+
+    @commands.command()
+    async def upcoming(self, ctx):
+        await self.events.refresh()
+        now = datetime.datetime.now(datetime.timezone.utc)
+        events = self.events.between(now, now + datetime.timedelta(days=2))
+        if len(events) == 0:
+            await timed_send(ctx, 'not much is happening')
+        else:
+            sent = timed_send(ctx, 'starting soon (24-hour times, Pacific):')
+            for event in events:
+                start = parse_datetime(event['start']['dateTime'])
+                end = parse_datetime(event['end']['dateTime'])
+                if start.date() == end.date():
+                    sent = timed_send(ctx, '{} from {} to {}: {}'.format(
+                        naturalday(start.date()),
+                        start.time().strftime('%H:%M'),
+                        end.time().strftime('%H:%M'),
+                        event['summary']))
+            await sent
+
+    async def sweep_sessions(self):
+        '''drop $schedule sessions that have been idle for too long'''
+        while True:
+            await sleep(config['timeouts']['schedule_sweep_seconds'])
+            cutoff = get_event_loop().time() - config['timeouts']['schedule_idle_seconds']
+            for key, session in list(self.sessions.items()):
+                if session.last_active < cutoff and self.sessions.get(key) is session:
+                    del self.sessions[key]
+                    try:
+                        await send_now(session.channel, '<@{}> scheduling timed out'.format(key[1]), BACKGROUND)
+                    except discord.HTTPException:
+                        pass
+
+    async def post_reminders(self, entries):
+        '''post "starting soon" embeds for (start, end, event) entries to each server's bot channel'''
+        embeds = []
+        for i in range(0, len(entries), EMBED_FIELDS):
+            embed = discord.Embed(title='Starting soon (24-hour times, Pacific)')
+            for start, end, event in entries[i:i + EMBED_FIELDS]:
+                embed.add_field(
+                    name=event.get('summary', '(untitled)'),
+                    value='{} from {} to {}'.format(naturalday(start.date()),
+                                                    start.time().strftime('%H:%M'),
+                                                    end.time().strftime('%H:%M')),
+                    inline=False)
+            embeds.append(embed)
+        for guild in self.bot.guilds:
+            channel = discord.utils.get(guild.text_channels, name=config['bot_channel'])
+            if channel is None:
+                continue
+            for embed in embeds:
+                await send_now(channel, embed=embed, priority=BACKGROUND)
+
+    @commands.Cog.listener()
+    @metrics.timed('listener')
+    async def on_message(self, msg):
+        session = self.sessions.get((msg.channel.id, msg.author.id))
+        if session is None or msg.id == session.start_message_id:
+            return
+        session.touch()
+        if msg.content.lower().strip() in ['cancel', 'quit', 'exit']:
+            del self.sessions[(msg.channel.id, msg.author.id)]
+            await send_now(msg.channel, 'scheduling cancelled')
+            return
+        try:
+            await self.advance_session(session, msg)
+        except ValueError:
+            await send_now(msg.channel, 'I couldn\'t understand that, try again (or say "cancel")')
+
+    async def advance_session(self, session, msg):
+        if session.progress == Calendar.SchedulingProgress.title:
+            session.scheduled['title'] = msg.content.strip()
+            session.progress = Calendar.SchedulingProgress.date
+            await send_now(msg.channel, 'give me a date (any reasonable format)')
+        elif session.progress == Calendar.SchedulingProgress.date:
+            session.scheduled['date'] = parse_datetime(msg.content.strip()).date()
+            session.progress = Calendar.SchedulingProgress.start_time
+            await send_now(msg.channel, 'give me a start time (any reasonable format)')
+        elif session.progress == Calendar.SchedulingProgress.start_time:
+            session.scheduled['start time'] = parse_datetime(msg.content.strip()).time()
+            session.progress = Calendar.SchedulingProgress.end_time
+            await send_now(msg.channel, 'give me a end time (any reasonable format)')
+        elif session.progress == Calendar.SchedulingProgress.end_time:
+            session.scheduled['end time'] = parse_datetime(msg.content.strip()).time()
+            session.progress = Calendar.SchedulingProgress.description
+            await send_now(msg.channel, 'give me a description')
+        elif session.progress == Calendar.SchedulingProgress.description:
+            session.scheduled['description'] = msg.content.strip()
+            session.progress = Calendar.SchedulingProgress.inactive
+            del self.sessions[(msg.channel.id, msg.author.id)]
+            request_body = {
+                "summary": session.scheduled['title'],
+                "description": session.scheduled['description'],
+                "start": {
+                    "dateTime": datetime.datetime.combine(session.scheduled['date'], session.scheduled['start time']).isoformat(),
+                    "timeZone": 'America/Los_Angeles'
+                },
+                "end": {
+                    "dateTime": datetime.datetime.combine(session.scheduled['date'], session.scheduled['end time']).isoformat(),
+                    "timeZone": 'America/Los_Angeles'
+                }
+            }
+            events_result = await self.client.execute(lambda service: service.events().insert(
+                calendarId=config['google_api_auth']['calendar_id'],
+                body=request_body))
+            self.events.add(events_result)
+            self.reminders.wake()
+            await send_now(msg.channel, 'added to calendar! {}'.format(events_result['htmlLink']))
+
+    @commands.command()
+    async def schedule(self, ctx):
+        self.sessions[(ctx.channel.id, ctx.author.id)] = Calendar.SchedulingSession(ctx.channel, ctx.message.id)
+        await timed_send(ctx, 'give me a title (including instructor names)')
@@ -0,0 +1,160 @@
+'''Greeting newcomers, the zone tutorial, and resetting roles for returning members.'''
+
+from asyncio import gather, sleep, TimeoutError
+import atexit
+from random import randint
+
+import discord
+from discord.ext import commands
+
+from common import asyncify, check_guild_role, config, reactions, rest, role_index, role_queue, timed_send
+from metrics import registry as metrics
+from presence import PresenceTracker
+
+class TutorialSession:
+    '''one member's walk through the zones; any number can run at once'''
+
+    def __init__(self, ctx):
+        self.ctx = ctx
+        self.zone = None
+
+    def check(self, reaction, user):
+        return user == self.ctx.author and str(reaction.emoji) == '👍'
+
+    async def wait_for_thumbs_up(self, sent, timeout):
+        await reactions.wait_for({m.id for m in sent}, self.check, timeout)
+
+    async def run(self):
+        ctx = self.ctx
+        for msg in [
+            'let\'s get started!',
+            'SPARC is organized into four different zones.',
+            'I\'ll walk you through them one by one, and when you\'re done checking '
+                'each one out and want to move on, just react 👍 to my message.'
+        ]:
+            timed_send(ctx, msg)
+
+        for cat in config['categories']:
+            self.zone = cat
+            # usually one merged message, but reacting to either part counts
+            sent = await gather(
+                timed_send(ctx, 'the {0} zone: {1}'.format(config['categories'][cat]['noun'], config['categories'][cat]['description'])),
+                timed_send(ctx, config['categories'][cat]['tutorial'].format(config['categories'][cat]['role']))
+            )
+            await role_queue.submit(ctx.author, add=[role_index.get(ctx.guild, config['categories'][cat]['role'])], interactive=True)
+
+            try:
+                await self.wait_for_thumbs_up(sent, config['timeouts']['tutorial_react_seconds'])
+            except TimeoutError:
+                sent = [await timed_send(ctx, '{}, are you still here? react 👍 if you are'.format(ctx.author.mention))]
+                try:
+                    await self.wait_for_thumbs_up(sent, config['timeouts']['tutorial_cancel_seconds'])
+                except TimeoutError:
+                    await timed_send(ctx, 'guess not :/')
+                    return
+
+            await role_queue.submit(ctx.author, remove=role_index.category_roles(ctx.guild, config), interactive=True)
+
+        timed_send(ctx, 'congratulations! you have completed the tutorial.')
+        await role_queue.submit(ctx.author,
+                                add=[role_index.get(ctx.guild, config['student_role'])],
+                                remove=[role_index.get(ctx.guild, config['novice_role'])],
+                                interactive=True)
+        await timed_send(ctx, 'try pinging me with "$hello"')
+
+class Welcome(commands.Cog):
+
+    def __init__(self, bot):
+        self.bot = bot
+        # member id -> TutorialSession
+        self.tutorials = {}
+        self.presence = PresenceTracker(config['presence']['snapshot_file'],
+                                        config['timeouts']['away_hours'] * 3600)
+        atexit.register(self.presence.save)
+        self.presence_saver = bot.loop.create_task(self.save_presence())
+
+    def cog_unload(self):
+        self.presence_saver.cancel()
+        atexit.unregister(self.presence.save)
+        self.presence.save()
+
+    async def save_presence(self):
+        '''periodically forget long-gone members and snapshot the rest to disk'''
+        while True:
+            await sleep(config['presence']['snapshot_seconds'])
+            self.presence.evict()
+            snapshot = self.presence.snapshot()
+            await asyncify(lambda: self.presence.write(snapshot))
+
+    @commands.Cog.listener()
+    @metrics.timed('listener')
+    async def on_member_update(self, before, after):
+        if before.status is discord.Status.online and after.status is not discord.Status.online:
+            # member might be exiting vSPARC for now
+            self.presence.mark_offline(before.id)
+        elif before.status is not discord.Status.online and after.status is discord.Status.online:
+            # member might be entering vSPARC
+            if self.presence.is_away(before.id):
+                # yup, member has not been seen online in the last hour
+                # both changes go out as (at most) one member edit, behind any interactive ones
+                remove = []
+                if role_index.get(after.guild, config['everything_role']) not in after.roles:
+                    remove = role_index.category_roles(after.guild, config)
+                add = []
+                novice_role = role_index.get(after.guild, config['novice_role'])
+                if novice_role and after.top_role < novice_role:
+                    # member is still in novice mode so make sure they have the novice role
+                    add = [novice_role]
+                role_queue.submit(after, add=add, remove=remove)
+
+    @commands.command()
+    async def tutorial(self, ctx):
+        if ctx.author.id in self.tutorials:
+            await timed_send(ctx, 'you\'re already doing the tutorial!')
+            return
+        session = self.tutorials[ctx.author.id] = TutorialSession(ctx)
+        try:
+            await session.run()
+        finally:
+            del self.tutorials[ctx.author.id]
+
+    @commands.command()
+    async def hello(self, ctx):
+        is_novice = await check_guild_role(ctx, config['novice_role'])
+        if is_novice is None:
+            return
+        elif is_novice:
+            timed_send(ctx, 'hi {}! welcome to SPARC'.format(ctx.author.mention))
+            await timed_send(ctx, 'I\'m SPARCbot and I can show you around. type "$tutorial" to begin.')
+        else:
+            timed_send(ctx, 'hi {}! what do you want to do today?'.format(ctx.author.mention))
+            timed_send(ctx, 'respond with one option: $iwantto [{}]'.format('|'.join(config['categories'].keys())))
+            await timed_send(ctx, 'or respond with $unsure')
+
+    @commands.command()
+    async def iwantto(self, ctx, role: str):
+        is_novice = await check_guild_role(ctx, config['novice_role'])
+        if is_novice is None:
+            return
+        cat_role = None
+        if role in config['categories']:
+            cat_role = role_index.get(ctx.guild, config['categories'][role]['role'])
+        if cat_role is None:
+            await timed_send(ctx, config['error_messages']['role_not_found'].format(role))
+            return
+        await role_queue.submit(ctx.author, add=[cat_role], interactive=True)
+        if is_novice:
+            timed_send(ctx, 'welcome to the {} zone!'.format(config['categories'][role]['noun']))
+            await timed_send(ctx, config['categories'][role]['description'])
+        else:
+            await sleep(0.5)
+            await rest.call('add_reaction', lambda: ctx.message.add_reaction('👍'), major=ctx.channel.id)
+            r = randint(1, 4)
+            if r == 1:
+                await timed_send(ctx, 'protip: did you know you can add roles to yourself by clicking on your name?')
+            elif r == 2:
+                await timed_send(ctx, 'protip: if you give yourself the "everything" role, you\'ll see all the categories all the time, and I\'ll never take it away from you <3')
+
+    @commands.command()
+    async def unsure(self, ctx):
+        await timed_send(ctx, 'I\'m afraid I can\'t let you do that.')
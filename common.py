@@ -0,0 +1,140 @@
+'''State and helpers shared by the bot entry point and every cog.
+
+This is deliberately light: the config, the bot object, the shared queues
+and caches, and the helpers cogs use to reply. Anything heavy belongs in
+the cog module that needs it, so it is only imported when that cog is
+added.
+'''
+
+from asyncio import get_event_loop
+import logging
+import time
+
+import discord
+from discord.ext import commands
+
+from config_index import CompiledConfig, RoleIndex
+from metrics import RateLimitLogHandler, registry as metrics
+from name_cache import NameCache
+from outbox import Outbox
+from reaction_router import ReactionRouter
+from rest_scheduler import INTERACTIVE, RestScheduler
+from role_queue import RoleQueue
+
+# discord.py retries 429s itself and only logs them, so count them from the log
+logging.getLogger('discord.http').addHandler(RateLimitLogHandler(metrics))
+
+CONFIG_FILE = 'main_config.json'
+# the auth file is only needed to actually connect, so the cogs can be imported without it.
+# reload-config updates this object in place, so `from common import config` stays current
+config = CompiledConfig.load(CONFIG_FILE, require_auth=False)
+
+def gateway_options(gateway):
+    '''commands.Bot keyword arguments for the config's `gateway` section; null entries keep discord.py's defaults'''
+    options = {'max_messages': gateway['max_messages']}
+    if gateway['intents'] is not None:
+        options['intents'] = discord.Intents.none()
+        for name in gateway['intents']:
+            setattr(options['intents'], name, True)
+    if gateway['member_cache'] is not None:
+        options['member_cache_flags'] = discord.MemberCacheFlags.none()
+        for name in gateway['member_cache']:
+            setattr(options['member_cache_flags'], name, True)
+    if gateway['chunk_guilds_at_startup'] is not None:
+        options['chunk_guilds_at_startup'] = gateway['chunk_guilds_at_startup']
+    if gateway['query_members'] and not options.get('intents', discord.Intents.default()).members:
+        raise ValueError('gateway.query_members needs the members intent')
+    return options
+
+# gateway settings only take effect here, at startup; reload-config doesn't change them
+bot = commands.Bot(config['command_prefix'], **gateway_options(config['gateway']))
+# every REST call the cogs make goes through here (see rest_scheduler)
+rest = RestScheduler(**config['rest'])
+
+def fetch_user(user_id):
+    '''bot.fetch_user through the REST scheduler; concurrent fetches of one user share a call'''
+    return rest.call('fetch_user', lambda: bot.fetch_user(user_id), key=user_id)
+
+async def fetch_members(guild, user_ids):
+    '''whichever of (at most 100) `user_ids` are in `guild`, asked for over the gateway; they aren't added to the member cache'''
+    return await guild.query_members(user_ids=user_ids, limit=len(user_ids), cache=False)
+
+names = NameCache(fetch_user, fetch_members if config['gateway']['query_members'] else None, **config['name_cache'])
+role_queue = RoleQueue(rest, **config['role_queue'])
+outbox = Outbox(rest, **config['outbox'])
+reactions = ReactionRouter()
+bot.add_listener(reactions.dispatch, 'on_reaction_add')
+role_index = RoleIndex()
+for event in ('on_guild_role_create', 'on_guild_role_update', 'on_guild_role_delete'):
+    bot.add_listener(getattr(role_index, event), event)
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.invoked_at = time.perf_counter()
+
+@bot.after_invoke
+async def stop_command_timer(ctx):
+    name = ctx.command.qualified_name
+    metrics.observe('command', name, time.perf_counter() - ctx.invoked_at)
+    if ctx.command_failed:
+        metrics.error('command', name)
+
+# helper functions
+
+def timed_send(ctx, msg, merge=True):
+    '''queue `msg` for ctx's channel; await the result for the Message it was sent in
+
+    Lines queued close together are merged into one message (see outbox), so
+    a multi-line reply should only await its last line.
+    '''
+    #async with ctx.channel.typing():
+    #    await sleep(len(msg) * 0.06) # 0.06 seconds to 'type' each character
+    return outbox.send(ctx.channel, msg, merge)
+
+def send_now(channel, content=None, priority=INTERACTIVE, **fields):
+    '''send one message straight through the REST scheduler, skipping the outbox (embeds, wizard prompts)'''
+    return rest.call('send', lambda: channel.send(content, **fields), priority, channel.id)
+
+async def check_guild_role(ctx, role, warn=False):
+    if not ctx.guild:
+        await timed_send(ctx, config['error_messages']['no_DM'])
+        return None
+    role_inst = role_index.get(ctx.guild, role)
+    if not role_inst:
+        await timed_send(ctx, config['error_messages']['role_not_found'].format(role))
+        return None
+    if warn and role_inst not in ctx.author.roles:
+        await timed_send(ctx, config['error_messages']['need_role'].format(role))
+    return role_inst in ctx.author.roles
+
+async def asyncify(fun):
+    return await get_event_loop().run_in_executor(None, fun)
+
+def time_format(dt):
+    return dt.isoformat() + 'Z'
+
+async def get_nick_from_id(ctx,id):
+    try:
+        if not ctx.guild:
+            await timed_send(ctx, config['error_messages']['no_DM'])
+            return None
+        return await names.resolve(ctx.guild,id)
+    except Exception:
+        raise Exception('Nickname not found')
+
+async def get_nicks_from_ids(ctx,ids):
+    '''like get_nick_from_id, but resolves a whole batch of IDs in one round'''
+    try:
+        if not ctx.guild:
+            await timed_send(ctx, config['error_messages']['no_DM'])
+            return None
+        return await names.resolve_many(ctx.guild,ids)
+    except Exception:
+        raise Exception('Nickname not found')
+
+@bot.check
+async def allowed_channel(ctx):
+    #if ctx.channel.name != config['bot_channel']:
+    #    await timed_send(ctx, 'excuse me?? I only respond in #{} okay'.format(config['bot_channel']))
+    #    return False
+    return True
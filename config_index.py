@@ -0,0 +1,90 @@
+'''Precomputed lookups over the bot config and over each guild's roles.
+
+`CompiledConfig` wraps the raw config dict (so `config['key']` keeps
+working) and derives, once per load, the lookups hot paths used to rebuild
+on every call. `reload-config` builds a new one and copies it into the
+existing object in one step, since the cog modules all hold that object.
+
+`RoleIndex` maps role names to Role objects per guild. A guild's index is
+built from `guild.roles` on first use and dropped whenever one of its roles
+is created, edited or deleted, so lookups are a dict probe.
+'''
+
+import json
+import os
+
+
+class CompiledConfig:
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.category_role_names = frozenset(cat['role'] for cat in raw['categories'].values())
+        # viewbets takes the displayed status name; map it back to stored statuses
+        self.statuses_by_label = {}
+        for status, label in raw['bet_status'].items():
+            self.statuses_by_label.setdefault(label, []).append(status)
+
+    @classmethod
+    def load(cls, config_file, require_auth=True):
+        '''read the config and merge in the auth file; offline tools can do without the latter'''
+        with open(config_file, 'r') as f:
+            raw = json.load(f)
+        if require_auth or os.path.exists(raw['auth_file']):
+            with open(raw['auth_file'], 'r') as f:
+                raw.update(json.load(f))
+        return cls(raw)
+
+    def replace(self, other):
+        '''take on another config's contents, so every module holding this object sees them'''
+        self.__dict__.update(other.__dict__)
+
+    def __getitem__(self, key):
+        return self.raw[key]
+
+    def __contains__(self, key):
+        return key in self.raw
+
+    def get(self, key, default=None):
+        return self.raw.get(key, default)
+
+
+class RoleIndex:
+
+    def __init__(self):
+        self.guilds = {}  # guild id -> {role name: Role}
+        self._categories = {}  # guild id -> (config's category names, [Role])
+
+    def roles(self, guild):
+        by_name = self.guilds.get(guild.id)
+        if by_name is None:
+            by_name = self.guilds[guild.id] = {}
+            # like discord.utils.get, the lowest role wins if names collide
+            for role in guild.roles:
+                by_name.setdefault(role.name, role)
+        return by_name
+
+    def get(self, guild, name):
+        return self.roles(guild).get(name)
+
+    def category_roles(self, guild, config):
+        '''every role in `guild` that is one of the config's category roles'''
+        cached = self._categories.get(guild.id)
+        # a reloaded config gets a new category_role_names, which invalidates this
+        if cached is None or cached[0] is not config.category_role_names:
+            by_name = self.roles(guild)
+            cached = self._categories[guild.id] = (
+                config.category_role_names, [by_name[name] for name in config.category_role_names if name in by_name])
+        return cached[1]
+
+    def invalidate(self, guild):
+        self.guilds.pop(guild.id, None)
+        self._categories.pop(guild.id, None)
+
+    async def on_guild_role_create(self, role):
+        self.invalidate(role.guild)
+
+    async def on_guild_role_delete(self, role):
+        self.invalidate(role.guild)
+
+    async def on_guild_role_update(self, before, after):
+        self.invalidate(after.guild)
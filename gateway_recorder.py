@@ -0,0 +1,89 @@
+'''Record the gateway events the bot receives, to replay offline with bench.replay.
+
+Each event is one JSON line in a gzip'd file, with short keys:
+
+    t  seconds since recording started    e  member_update, message or reaction_add
+    g  guild ID    c  channel ID    u  user ID    m  message ID
+
+member_update has `b` and `a`, the member's [status, nick, role names]
+before and after. message has `x`, its text, and `ro`, the author's role
+names, or `me` if the bot sent it (the replayer needs those to find what
+later reactions were on). reaction_add has `r`, the emoji. Each recording
+session starts with a header line (`e` is "start") giving the command
+prefix, and appends to the file, so restarts don't lose earlier sessions.
+
+Commands are recorded with their text; every other message is recorded as
+empty, so a recording doesn't keep a copy of what people say on the server.
+DMs aren't recorded at all.
+'''
+
+import asyncio
+import datetime
+import gzip
+import json
+import logging
+
+log = logging.getLogger(__name__)
+
+EVENTS = ('on_member_update', 'on_message', 'on_reaction_add')
+
+
+def member_state(member):
+    # roles[0] is @everyone
+    return [str(member.status), member.nick, [role.name for role in member.roles[1:]]]
+
+
+class GatewayRecorder:
+
+    def __init__(self, bot, path, prefix):
+        self.bot = bot
+        self.path = path
+        self.prefix = prefix
+        self.file = None
+        self.started = None
+        self.recorded = 0
+
+    def start(self):
+        self.file = gzip.open(self.path, 'at')
+        self.started = asyncio.get_event_loop().time()
+        self._write({'e': 'start', 'prefix': self.prefix, 'at': datetime.datetime.utcnow().isoformat() + 'Z'})
+        for event in EVENTS:
+            self.bot.add_listener(getattr(self, event), event)
+        log.info('recording gateway events to %s', self.path)
+
+    def stop(self):
+        if self.file is None:
+            return
+        for event in EVENTS:
+            self.bot.remove_listener(getattr(self, event), event)
+        self.file.close()
+        self.file = None
+        log.info('recorded %d gateway events to %s', self.recorded, self.path)
+
+    async def on_member_update(self, before, after):
+        self._write({'e': 'member_update', 'g': after.guild.id, 'u': after.id,
+                     'b': member_state(before), 'a': member_state(after)})
+
+    async def on_message(self, msg):
+        if msg.guild is None:
+            return
+        record = {'e': 'message', 'g': msg.guild.id, 'c': msg.channel.id, 'u': msg.author.id, 'm': msg.id}
+        if msg.author.id == self.bot.user.id:
+            record['me'] = 1
+        else:
+            record['x'] = msg.content if msg.content.startswith(self.prefix) else ''
+            record['ro'] = [role.name for role in getattr(msg.author, 'roles', [None])[1:]]
+        self._write(record)
+
+    async def on_reaction_add(self, reaction, user):
+        msg = reaction.message
+        if msg.guild is None:
+            return
+        self._write({'e': 'reaction_add', 'g': msg.guild.id, 'c': msg.channel.id, 'm': msg.id,
+                     'u': user.id, 'r': str(reaction.emoji)})
+
+    def _write(self, record):
+        record['t'] = round(asyncio.get_event_loop().time() - self.started, 3)
+        self.file.write(json.dumps(record, separators=(',', ':')) + '\n')
+        if record['e'] != 'start':
+            self.recorded += 1
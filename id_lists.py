@@ -0,0 +1,34 @@
+'''Ascending lists of bet IDs keyed by something: a bidder, a status, a word.
+
+BetStore's bidder/seller/status indexes and bet_search's posting lists are
+all dicts of these, kept sorted so "newest first" is a reverse walk and
+membership is a bisect.
+'''
+
+from bisect import bisect_left, insort
+
+
+def add_id(index, key, bet_id):
+    ids = index.setdefault(key, [])
+    # new bets always have the highest ID, so this is almost always an append
+    if not ids or ids[-1] < bet_id:
+        ids.append(bet_id)
+    else:
+        insort(ids, bet_id)
+
+
+def remove_id(index, key, bet_id):
+    '''drop `bet_id` from index[key], and the key once its list is empty'''
+    ids = index.get(key)
+    if not ids:
+        return
+    i = bisect_left(ids, bet_id)
+    if i < len(ids) and ids[i] == bet_id:
+        del ids[i]
+        if not ids:
+            del index[key]
+
+
+def contains(ids, bet_id):
+    i = bisect_left(ids, bet_id)
+    return i < len(ids) and ids[i] == bet_id
@@ -0,0 +1,167 @@
+'''Latency histograms and error / rate-limit counters for commands, listeners and REST calls.
+
+Recording is a perf_counter() pair, a bisect over fixed buckets and a few
+dict updates, cheap enough to leave on. Series are keyed by (kind, name),
+e.g. ('command', 'viewbets') or ('rest', 'fetch_user'). `registry` is the
+process-wide instance; `summary()` feeds the $stats command and
+`render_prometheus()` the optional local scrape endpoint.
+'''
+
+from bisect import bisect_left
+from contextlib import contextmanager
+import functools
+import logging
+import time
+
+# 0.5ms doubling up to ~33s; anything slower lands in the +Inf bucket
+BUCKETS = tuple(0.0005 * 2 ** k for k in range(17))
+
+
+class Histogram:
+
+    __slots__ = ('counts', 'count', 'total', 'errors', 'rate_limited')
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.errors = 0
+        self.rate_limited = 0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q):
+        '''estimate by interpolating within the bucket the quantile falls in'''
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                lo = BUCKETS[i - 1] if i else 0.0
+                hi = BUCKETS[i] if i < len(BUCKETS) else BUCKETS[-1] * 2
+                return lo + (hi - lo) * (rank - seen) / n
+            seen += n
+        return BUCKETS[-1]
+
+
+class Metrics:
+
+    def __init__(self):
+        self.series = {}  # (kind, name) -> Histogram
+
+    def get(self, kind, name):
+        hist = self.series.get((kind, name))
+        if hist is None:
+            hist = self.series[(kind, name)] = Histogram()
+        return hist
+
+    def observe(self, kind, name, seconds):
+        self.get(kind, name).observe(seconds)
+
+    def error(self, kind, name):
+        self.get(kind, name).errors += 1
+
+    def rate_limit(self, kind, name):
+        self.get(kind, name).rate_limited += 1
+
+    @contextmanager
+    def timer(self, kind, name):
+        '''time the block; an exception counts as an error (and a 429 as a rate-limit hit)'''
+        hist = self.get(kind, name)
+        start = time.perf_counter()
+        try:
+            yield
+        except Exception as e:
+            _count_failure(hist, e)
+            raise
+        finally:
+            hist.observe(time.perf_counter() - start)
+
+    def timed(self, kind, name=None):
+        '''decorator for coroutine functions; the series name defaults to the function name'''
+        def decorator(fun):
+            # resolved once here and inlined, since this wraps the hottest listeners
+            hist = self.get(kind, name or fun.__name__)
+
+            @functools.wraps(fun)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await fun(*args, **kwargs)
+                except Exception as e:
+                    _count_failure(hist, e)
+                    raise
+                finally:
+                    hist.observe(time.perf_counter() - start)
+            return wrapper
+        return decorator
+
+    def wrap(self, kind, name, fun):
+        '''an instrumented version of the coroutine function `fun`'''
+        return self.timed(kind, name)(fun)
+
+    def summary(self, kind=None, limit=15):
+        '''(kind, name, count, p50 s, p99 s, errors, rate limited) rows, busiest first'''
+        rows = [(k, n, h.count, h.quantile(0.5), h.quantile(0.99), h.errors, h.rate_limited)
+                for (k, n), h in self.series.items() if kind is None or k == kind]
+        rows.sort(key=lambda r: r[2], reverse=True)
+        return rows[:limit]
+
+    def render_prometheus(self, prefix='sparcbot'):
+        lines = [
+            '# TYPE {}_latency_seconds histogram'.format(prefix),
+        ]
+        for (kind, name), hist in sorted(self.series.items()):
+            labels = 'kind="{}",name="{}"'.format(kind, name)
+            cumulative = 0
+            for bound, n in zip(BUCKETS, hist.counts):
+                cumulative += n
+                lines.append('{}_latency_seconds_bucket{{{},le="{}"}} {}'.format(prefix, labels, bound, cumulative))
+            lines.append('{}_latency_seconds_bucket{{{},le="+Inf"}} {}'.format(prefix, labels, hist.count))
+            lines.append('{}_latency_seconds_sum{{{}}} {}'.format(prefix, labels, hist.total))
+            lines.append('{}_latency_seconds_count{{{}}} {}'.format(prefix, labels, hist.count))
+        for metric, attr in (('errors_total', 'errors'), ('rate_limited_total', 'rate_limited')):
+            lines.append('# TYPE {}_{} counter'.format(prefix, metric))
+            for (kind, name), hist in sorted(self.series.items()):
+                lines.append('{}_{}{{kind="{}",name="{}"}} {}'.format(prefix, metric, kind, name, getattr(hist, attr)))
+        return '\n'.join(lines) + '\n'
+
+    async def serve(self, host, port):
+        '''serve render_prometheus() at http://host:port/metrics until cancelled'''
+        from aiohttp import web
+
+        async def handle(request):
+            return web.Response(text=self.render_prometheus(), content_type='text/plain')
+
+        app = web.Application()
+        app.router.add_get('/metrics', handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+        return runner
+
+
+def _count_failure(hist, e):
+    hist.errors += 1
+    # discord.HTTPException has .status, googleapiclient's HttpError has .resp.status
+    if getattr(e, 'status', None) == 429 or getattr(getattr(e, 'resp', None), 'status', None) == 429:
+        hist.rate_limited += 1
+
+
+class RateLimitLogHandler(logging.Handler):
+    '''counts discord.py's "being rate limited" warnings, since it retries 429s itself'''
+
+    def __init__(self, metrics):
+        super().__init__(logging.WARNING)
+        self.metrics = metrics
+
+    def emit(self, record):
+        if 'rate limited' in record.getMessage():
+            self.metrics.rate_limit('rest', 'discord')
+
+
+registry = Metrics()
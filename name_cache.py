@@ -0,0 +1,148 @@
+'''Display-name cache for rendering user IDs in bet tables.
+
+Names are cached per (guild, user) with a TTL and LRU eviction. Members the
+guild already knows about resolve locally (nick, else username). With a
+lean member cache most members aren't known, so if `fetch_members` is given,
+the misses are first asked for over the gateway, up to 100 per request,
+which uses no REST budget. Anyone still missing (usually someone who has
+left) costs a `fetch_user` REST call, so misses for a whole table are
+de-duplicated and fetched concurrently, and concurrent lookups of the same
+user share one in-flight request.
+'''
+
+import asyncio
+from collections import OrderedDict
+import time
+
+
+class NameCache:
+
+    def __init__(self, fetch_user, fetch_members=None, ttl_seconds=600, max_entries=5000):
+        '''`fetch_members(guild, user_ids)` returns whichever of (at most 100) `user_ids` are members'''
+        self.fetch_user = fetch_user
+        self.fetch_members = fetch_members
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (guild_id, user_id) -> (expires, name)
+        self._guilds_by_user = {}      # user_id -> set of guild_ids with an entry
+        self._inflight = {}            # (guild_id, user_id) -> future
+        self._queries = {}             # (guild_id, user_id) -> task asking the gateway for its batch
+
+    def get(self, guild, user_id):
+        '''the cached name, or None on a miss'''
+        key = (guild.id, user_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(key)
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    async def resolve(self, guild, user_id):
+        name = self.get(guild, user_id)
+        if name is not None:
+            return name
+        return (await self.resolve_many(guild, [user_id]))[user_id]
+
+    async def resolve_many(self, guild, user_ids):
+        '''resolve every distinct ID in `user_ids` with at most one concurrent round of lookups'''
+        names = {}
+        misses = self._known(guild, set(user_ids), names)
+        if misses and self.fetch_members is not None:
+            # join queries already asking for some of these; lookups in flight are awaited below
+            queries = {self._queries[(guild.id, user_id)] for user_id in misses if (guild.id, user_id) in self._queries}
+            new = [user_id for user_id in misses
+                   if (guild.id, user_id) not in self._queries and (guild.id, user_id) not in self._inflight]
+            if new:
+                queries.add(self._start_query(guild, new))
+            await asyncio.gather(*(asyncio.shield(query) for query in queries))
+            misses = self._known(guild, misses, names)
+        if misses:
+            resolved = await asyncio.gather(*(self._resolve_one(guild, user_id) for user_id in misses))
+            names.update(zip(misses, resolved))
+        return names
+
+    def invalidate(self, user_id, guild_id=None):
+        '''forget a user's name in one guild, or in every guild'''
+        guild_ids = self._guilds_by_user.get(user_id, ())
+        for gid in list(guild_ids) if guild_id is None else [guild_id]:
+            self._drop((gid, user_id))
+
+    def _known(self, guild, user_ids, names):
+        '''add the names found without a request to `names`; returns the IDs left over'''
+        misses = []
+        for user_id in user_ids:
+            name = self.get(guild, user_id)
+            if name is None:
+                member = guild.get_member(user_id)
+                if member is not None:
+                    name = member.nick or member.name
+                    self._store((guild.id, user_id), name)
+            if name is None:
+                misses.append(user_id)
+            else:
+                names[user_id] = name
+        return misses
+
+    async def _resolve_one(self, guild, user_id):
+        key = (guild.id, user_id)
+        future = self._inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(self._lookup(guild, user_id))
+            self._inflight[key] = future
+            future.add_done_callback(lambda f: self._inflight.pop(key, None))
+        return await asyncio.shield(future)
+
+    def _start_query(self, guild, user_ids):
+        query = asyncio.ensure_future(self._query_members(guild, user_ids))
+        keys = [(guild.id, user_id) for user_id in user_ids]
+        for key in keys:
+            self._queries[key] = query
+
+        def done(f):
+            for key in keys:
+                if self._queries.get(key) is query:
+                    del self._queries[key]
+        query.add_done_callback(done)
+        return query
+
+    async def _query_members(self, guild, user_ids):
+        batches = [user_ids[i:i + 100] for i in range(0, len(user_ids), 100)]
+        for members in await asyncio.gather(*(self.fetch_members(guild, batch) for batch in batches),
+                                            return_exceptions=True):
+            if isinstance(members, Exception):
+                # whoever is left falls back to fetch_user
+                continue
+            for member in members:
+                self._store((guild.id, member.id), member.nick or member.name)
+
+    async def _lookup(self, guild, user_id):
+        member = guild.get_member(user_id)
+        if member is not None:
+            name = member.nick or member.name
+        else:
+            try:
+                name = (await self.fetch_user(user_id)).name
+            except Exception:
+                # don't cache failures; the ID is still a usable label
+                return str(user_id)
+        self._store((guild.id, user_id), name)
+        return name
+
+    def _store(self, key, name):
+        self._entries[key] = (time.monotonic() + self.ttl_seconds, name)
+        self._entries.move_to_end(key)
+        self._guilds_by_user.setdefault(key[1], set()).add(key[0])
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+
+    def _drop(self, key):
+        if self._entries.pop(key, None) is None:
+            return
+        guild_ids = self._guilds_by_user.get(key[1])
+        if guild_ids is not None:
+            guild_ids.discard(key[0])
+            if not guild_ids:
+                del self._guilds_by_user[key[1]]
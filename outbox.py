@@ -0,0 +1,111 @@
+'''Per-channel outbound message queue that merges consecutive lines.
+
+`send` queues a line for a channel and returns a future for the Message it
+ends up in. A channel's queue is drained `window_seconds` after its first
+line arrives: consecutive lines are joined with newlines into as few
+messages as fit in `max_chars`, and sent in order, one REST call per merged
+message. Lines queued while a send is in flight go out in the next one.
+
+Callers that need the Message (to react to it, wait for reactions on it or
+edit it later) await the future. Callers that don't can drop it, as long as
+something later in the same reply is awaited, and chatty replies should do
+exactly that so their lines can merge. A line sent with `merge=False` always
+gets a message to itself, for messages that are later edited wholesale.
+
+Sends go through the REST scheduler as interactive calls, budgeted per channel.
+'''
+
+import asyncio
+from collections import deque
+import logging
+
+from rest_scheduler import INTERACTIVE
+
+log = logging.getLogger(__name__)
+
+
+class _ChannelQueue:
+
+    def __init__(self, channel):
+        self.channel = channel
+        self.lines = deque()  # (content, merge, future)
+        self.task = None
+
+
+class Outbox:
+
+    def __init__(self, rest, window_seconds=0.02, max_chars=2000):
+        self.rest = rest
+        self.window_seconds = window_seconds
+        self.max_chars = max_chars
+        self.channels = {}  # channel id -> _ChannelQueue
+
+        self.requested = 0  # lines queued
+        self.messages = 0   # messages actually sent
+
+    def send(self, channel, content, merge=True):
+        '''queue `content` for `channel`; the returned future resolves to the Message'''
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        queue = self.channels.get(channel.id)
+        if queue is None:
+            queue = self.channels[channel.id] = _ChannelQueue(channel)
+        queue.channel = channel
+        queue.lines.append((str(content), merge, future))
+        self.requested += 1
+        if queue.task is None:
+            queue.task = loop.create_task(self._drain(queue))
+        return future
+
+    def stats(self):
+        return {
+            'requested': self.requested,
+            'messages': self.messages,
+            # lines per message sent; higher means more merging
+            'coalescing_ratio': self.requested / self.messages if self.messages else 0.0,
+        }
+
+    def _take(self, queue):
+        '''pop the next run of lines that fit in one message'''
+        content, merge, future = queue.lines.popleft()
+        batch = [future]
+        if merge:
+            length = len(content)
+            while queue.lines:
+                line, line_merge, line_future = queue.lines[0]
+                if not line_merge or length + 1 + len(line) > self.max_chars:
+                    break
+                queue.lines.popleft()
+                content += '\n' + line
+                length += 1 + len(line)
+                batch.append(line_future)
+        return content, batch
+
+    async def _drain(self, queue):
+        try:
+            await asyncio.sleep(self.window_seconds)
+            while queue.lines:
+                content, batch = self._take(queue)
+                self.messages += 1
+                try:
+                    msg = await self.rest.call('send', lambda: queue.channel.send(content),
+                                               INTERACTIVE, queue.channel.id)
+                except Exception as e:
+                    log.exception('send to channel %s failed', queue.channel.id)
+                    for future in batch:
+                        if not future.done():
+                            future.set_exception(e)
+                            # already logged; awaiting callers still get it raised
+                            future.exception()
+                else:
+                    for future in batch:
+                        if not future.done():
+                            future.set_result(msg)
+        finally:
+            queue.task = None
+            if self.channels.get(queue.channel.id) is queue:
+                if queue.lines:
+                    # cancelled with lines still queued; don't leave them hanging
+                    for content, merge, future in queue.lines:
+                        future.cancel()
+                del self.channels[queue.channel.id]
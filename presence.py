@@ -0,0 +1,119 @@
+'''Compact record of when members were last seen going offline.
+
+Member IDs and epoch-second timestamps live in two parallel arrays sorted
+by ID and searched with bisect, so each tracked member costs 16 bytes
+rather than a dict entry and a `datetime` object. Members not yet in the
+arrays sit in a small dict that is merged in once it grows past
+`merge_every`. Entries older than the away window are evicted (an evicted
+member looks exactly like one who has been away that long), and the arrays
+are snapshotted to disk so a restart doesn't make everybody look away.
+'''
+
+from array import array
+from bisect import bisect_left
+import heapq
+import logging
+import os
+import sys
+import time
+
+log = logging.getLogger(__name__)
+
+
+class PresenceTracker:
+
+    def __init__(self, snapshot_file, away_seconds, merge_every=4096):
+        self.snapshot_file = snapshot_file
+        self.away_seconds = away_seconds
+        self.merge_every = merge_every
+        self.ids = array('Q')
+        self.seen = array('d')
+        self.fresh = {}  # member id -> epoch seconds, for members not in the arrays yet
+        self.load()
+
+    def __len__(self):
+        return len(self.ids) + len(self.fresh)
+
+    def _find(self, member_id):
+        i = bisect_left(self.ids, member_id)
+        return i if i < len(self.ids) and self.ids[i] == member_id else None
+
+    def mark_offline(self, member_id, when=None):
+        when = time.time() if when is None else when
+        i = self._find(member_id)
+        if i is not None:
+            self.seen[i] = when
+        else:
+            self.fresh[member_id] = when
+            if len(self.fresh) >= self.merge_every:
+                self._merge()
+
+    def last_seen(self, member_id):
+        '''epoch seconds the member was last seen going offline, or None'''
+        when = self.fresh.get(member_id)
+        if when is None:
+            i = self._find(member_id)
+            when = None if i is None else self.seen[i]
+        return when
+
+    def is_away(self, member_id, now=None):
+        '''True unless the member went offline within the away window'''
+        seen = self.last_seen(member_id)
+        now = time.time() if now is None else now
+        return seen is None or now - seen > self.away_seconds
+
+    def evict(self, now=None):
+        '''drop members who have been away longer than the window; returns how many'''
+        cutoff = (time.time() if now is None else now) - self.away_seconds
+        before = len(self)
+        self._merge(cutoff)
+        return before - len(self)
+
+    def _merge(self, cutoff=None):
+        entries = heapq.merge(zip(self.ids, self.seen), sorted(self.fresh.items()))
+        if cutoff is not None:
+            entries = ((member_id, seen) for member_id, seen in entries if seen >= cutoff)
+        ids, seen = array('Q'), array('d')
+        for member_id, when in entries:
+            ids.append(member_id)
+            seen.append(when)
+        self.ids, self.seen, self.fresh = ids, seen, {}
+
+    def memory_bytes(self):
+        '''approximate bytes held, including the not-yet-merged dict'''
+        fresh = sys.getsizeof(self.fresh) + sum(
+            sys.getsizeof(k) + sys.getsizeof(v) for k, v in self.fresh.items())
+        return (fresh
+                + self.ids.buffer_info()[1] * self.ids.itemsize
+                + self.seen.buffer_info()[1] * self.seen.itemsize)
+
+    def snapshot(self):
+        '''merged copies of the columns, taken on the loop so they can be written from a thread'''
+        self._merge()
+        return array('Q', self.ids), array('d', self.seen)
+
+    def write(self, snapshot):
+        ids, seen = snapshot
+        tmp_file = self.snapshot_file + '.tmp'
+        with open(tmp_file, 'wb') as f:
+            f.write(len(ids).to_bytes(8, 'little'))
+            ids.tofile(f)
+            seen.tofile(f)
+        os.replace(tmp_file, self.snapshot_file)
+
+    def save(self):
+        self.evict()
+        self.write(self.snapshot())
+
+    def load(self):
+        if not os.path.exists(self.snapshot_file):
+            return
+        try:
+            with open(self.snapshot_file, 'rb') as f:
+                n = int.from_bytes(f.read(8), 'little')
+                self.ids.fromfile(f, n)
+                self.seen.fromfile(f, n)
+        except (EOFError, OSError):
+            log.warning('could not read %s, starting with no presence history', self.snapshot_file)
+            self.ids, self.seen = array('Q'), array('d')
+        self.evict()
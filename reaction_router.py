@@ -0,0 +1,55 @@
+'''Reaction dispatch indexed by message ID.
+
+Instead of every waiter running its own check against every reaction on the
+server, callbacks are registered for the specific messages they care about
+and a reaction is routed with a single dict lookup. Reactions from bots
+(including our own page buttons) are never routed.
+'''
+
+import asyncio
+
+
+class ReactionRouter:
+
+    def __init__(self):
+        self.routes = {}  # message id -> list of callbacks
+
+    def add(self, message_id, callback):
+        '''call `callback(reaction, user)` (a function or coroutine function) for reactions on a message'''
+        self.routes.setdefault(message_id, []).append(callback)
+
+    def remove(self, message_id, callback=None):
+        '''stop routing a message's reactions to `callback`, or to anything'''
+        callbacks = self.routes.get(message_id)
+        if callbacks is None:
+            return
+        if callback is not None and callback in callbacks:
+            callbacks.remove(callback)
+        if callback is None or not callbacks:
+            del self.routes[message_id]
+
+    async def dispatch(self, reaction, user):
+        '''the on_reaction_add listener'''
+        callbacks = self.routes.get(reaction.message.id)
+        if not callbacks or user.bot:
+            return
+        for callback in list(callbacks):
+            result = callback(reaction, user)
+            if asyncio.iscoroutine(result):
+                await result
+
+    async def wait_for(self, message_ids, check, timeout=None):
+        '''wait for a reaction on any of `message_ids` passing `check`; raises asyncio.TimeoutError'''
+        future = asyncio.get_event_loop().create_future()
+
+        def callback(reaction, user):
+            if not future.done() and check(reaction, user):
+                future.set_result((reaction, user))
+
+        for message_id in message_ids:
+            self.add(message_id, callback)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            for message_id in message_ids:
+                self.remove(message_id, callback)
@@ -0,0 +1,118 @@
+'''Reminders posted a little before each calendar event starts.
+
+`ReminderScheduler` keeps a min-heap of (reminder time, start, event id)
+built from an EventCache and sleeps until the earliest reminder is due,
+rather than polling. Reminders that fall due within `batch_seconds` of each
+other are posted as one batch, so a block of back-to-back events makes one
+message.
+
+The heap is rebuilt whenever the cache has changed: after the scheduler's
+own periodic sync (every `resync_seconds`, to pick up events edited in
+Google Calendar directly), or right away when `wake` is called after the bot
+adds an event itself. A moved event gets a new reminder and a cancelled one
+gets none.
+
+All timing goes through `clock`, so the scheduler can be driven in virtual
+time against a stand-in calendar.
+'''
+
+import asyncio
+import datetime
+import heapq
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class Clock:
+    '''the real clock; benchmarks substitute one they control'''
+
+    def now(self):
+        return datetime.datetime.now(datetime.timezone.utc)
+
+    def sleep(self, seconds):
+        return asyncio.sleep(seconds)
+
+
+class ReminderScheduler:
+
+    def __init__(self, events, post, lead_seconds=900, batch_seconds=300, resync_seconds=600, clock=None):
+        '''`post` is a coroutine function called with each batch of (start, end, event) entries'''
+        self.events = events
+        self.post = post
+        self.lead = datetime.timedelta(seconds=lead_seconds)
+        self.batch = datetime.timedelta(seconds=batch_seconds)
+        self.resync_seconds = resync_seconds
+        self.clock = clock or Clock()
+        self.heap = []         # (reminder time, start, event id)
+        self.reminded = set()  # (event id, start) already posted
+        self.posted = 0        # reminders posted
+        self.batches = 0       # posts made
+        self._version = None   # events.version the heap was built from
+        self._last_sync = None
+        self._wake = asyncio.Event()
+
+    def wake(self):
+        '''pick up changes to the event cache now instead of at the next deadline'''
+        self._wake.set()
+
+    async def run(self):
+        while True:
+            self._wake.clear()
+            now = self.clock.now()
+            if self._last_sync is None or (now - self._last_sync).total_seconds() >= self.resync_seconds:
+                self._last_sync = now
+                try:
+                    await self.events.sync()
+                except Exception:
+                    log.exception('calendar sync for reminders failed')
+            if self.events.version != self._version:
+                self._rebuild()
+            await self._post_due()
+            await self._sleep()
+
+    def _rebuild(self):
+        now = self.clock.now()
+        # forget reminders for events that have started; they can't come due again
+        self.reminded = {(event_id, start) for event_id, start in self.reminded if start > now}
+        self.heap = [(start - self.lead, start, event_id)
+                     for event_id, (start, end, event) in self.events.events.items()
+                     if start > now and (event_id, start) not in self.reminded]
+        heapq.heapify(self.heap)
+        self._version = self.events.version
+
+    async def _post_due(self):
+        now = self.clock.now()
+        if not self.heap or self.heap[0][0] > now:
+            return
+        cutoff = now + self.batch
+        batch = []
+        while self.heap and self.heap[0][0] <= cutoff:
+            remind_at, start, event_id = heapq.heappop(self.heap)
+            entry = self.events.events.get(event_id)
+            if entry is None or entry[0] != start:
+                # cancelled or moved since the heap was built
+                continue
+            self.reminded.add((event_id, start))
+            batch.append(entry)
+        if not batch:
+            return
+        self.posted += len(batch)
+        self.batches += 1
+        try:
+            await self.post(batch)
+        except Exception:
+            log.exception('posting %d event reminders failed', len(batch))
+
+    async def _sleep(self):
+        now = self.clock.now()
+        delay = self.resync_seconds - (now - self._last_sync).total_seconds()
+        if self.heap:
+            delay = min(delay, (self.heap[0][0] - now).total_seconds())
+        sleeper = asyncio.ensure_future(self.clock.sleep(max(delay, 0)))
+        waker = asyncio.ensure_future(self._wake.wait())
+        try:
+            await asyncio.wait([sleeper, waker], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            sleeper.cancel()
+            waker.cancel()
@@ -0,0 +1,227 @@
+'''One queue in front of every outbound Discord REST call.
+
+Discord rate-limits each route, per channel for messages and reactions and
+per guild for member edits, and also globally; discord.py only finds out by
+hitting a 429 and sleeping. `RestScheduler.call` instead tracks each
+budget locally (at most `requests` calls in any `per_seconds` window) and
+holds a call back until it fits, so nothing is sent just to be rejected.
+
+Held-back calls are served by priority, then in order: INTERACTIVE (a reply
+someone is waiting on) ahead of BACKGROUND (role resets from presence
+changes, reminders). Priority applies within a route and again at the shared
+global budget, so a backlog of background calls spread over many routes
+can't hold up a reply. Background calls may also only use
+`background_share` of the global budget, so a burst of them can't use up a
+whole window just before a reply needs it.
+
+A call made with a `key` is de-duplicated: while one is queued or in flight,
+the same call on the same route gets its result instead of being sent again.
+
+Every call is timed as ('rest', route) and the time it spent waiting for
+budget as ('rest_wait', route).
+'''
+
+import asyncio
+from collections import deque
+import heapq
+import itertools
+
+from metrics import registry as metrics
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+
+class _Budget:
+    '''at most `requests` calls in any `per_seconds` window'''
+
+    def __init__(self, requests, per_seconds):
+        self.requests = requests
+        self.per_seconds = per_seconds
+        self.sent = deque()  # [loop time] of each call in the current window
+
+    def delay(self, now, requests=None):
+        '''seconds until another call fits (in `requests` of the budget, if given), 0 if one fits now'''
+        requests = self.requests if requests is None else requests
+        while self.sent and self.sent[0][0] <= now - self.per_seconds:
+            self.sent.popleft()
+        if len(self.sent) < requests:
+            return 0.0
+        return self.sent[len(self.sent) - requests][0] + self.per_seconds - now
+
+    def take(self, now):
+        '''count a call against the budget; the returned cell holds its time, to be corrected once it's really sent'''
+        cell = [now]
+        self.sent.append(cell)
+        return cell
+
+
+class _Request:
+
+    __slots__ = ('route', 'fun', 'future', 'queued_at', 'cells')
+
+    def __init__(self, route, fun, future, queued_at):
+        self.route = route
+        self.fun = fun
+        self.future = future
+        self.queued_at = queued_at
+        self.cells = []  # its entries in the budgets it was counted against
+
+
+class _Bucket:
+
+    def __init__(self, budget):
+        self.budget = budget  # None for unlimited
+        self.queue = []       # heap of (priority, seq, _Request)
+        self.task = None
+
+
+class RestScheduler:
+
+    def __init__(self, global_budget=None, budgets=None, default_budget=None, background_share=0.8):
+        self._seq = itertools.count()
+        self._inflight = {}  # (route, key) -> future
+        self.configure(global_budget, budgets, default_budget, background_share)
+
+        self.requested = 0     # calls asked for
+        self.deduplicated = 0  # calls answered by one already queued or in flight
+        self.sent = 0          # calls actually made
+
+    def configure(self, global_budget=None, budgets=None, default_budget=None, background_share=0.8):
+        '''set budgets as [requests, per_seconds], per route in `budgets`; None means unlimited
+
+        Only call this while nothing is queued, e.g. before the bot connects.
+        '''
+        self.global_budget = _Budget(*global_budget) if global_budget else None
+        self.background_requests = max(1, int(global_budget[0] * background_share)) if global_budget else None
+        self.budgets = dict(budgets or {})
+        self.default_budget = default_budget
+        self.buckets = {}          # (route, major) -> _Bucket
+        self._global_waiters = []  # heap of (priority, seq, future)
+        self._global_task = None
+        self._global_wakeup = None
+
+    def call(self, route, fun, priority=INTERACTIVE, major=None, key=None):
+        '''queue the REST call `fun()` on `route`; the returned future resolves to its result
+
+        `major` is what Discord partitions the route's limit by: the channel
+        ID for messages and reactions, the guild ID for member edits.
+        '''
+        self.requested += 1
+        if key is not None:
+            future = self._inflight.get((route, key))
+            if future is not None:
+                self.deduplicated += 1
+                # one caller giving up mustn't cancel it for the rest
+                return asyncio.shield(future)
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        if key is not None:
+            self._inflight[(route, key)] = future
+            future.add_done_callback(lambda f: self._inflight.pop((route, key), None))
+
+        bucket = self.buckets.get((route, major))
+        if bucket is None:
+            if len(self.buckets) > 1000:
+                self._prune(loop.time())
+            budget = self.budgets.get(route, self.default_budget)
+            bucket = self.buckets[(route, major)] = _Bucket(_Budget(*budget) if budget else None)
+        heapq.heappush(bucket.queue, (priority, next(self._seq), _Request(route, fun, future, loop.time())))
+        if bucket.task is None:
+            bucket.task = loop.create_task(self._drain(bucket))
+        return asyncio.shield(future) if key is not None else future
+
+    def stats(self):
+        return {
+            'queued': sum(len(bucket.queue) for bucket in self.buckets.values()),
+            'waiting_for_global': len(self._global_waiters),
+            'requested': self.requested,
+            'deduplicated': self.deduplicated,
+            'sent': self.sent,
+        }
+
+    def _prune(self, now):
+        # an idle bucket whose window has passed holds nothing worth keeping
+        self.buckets = {k: b for k, b in self.buckets.items()
+                        if b.task is not None or (b.budget is not None and b.budget.delay(now) > 0)}
+
+    async def _drain(self, bucket):
+        loop = asyncio.get_event_loop()
+        try:
+            while bucket.queue:
+                if bucket.budget is not None:
+                    delay = bucket.budget.delay(loop.time())
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                        # something more urgent may have been queued meanwhile
+                        continue
+                priority, seq, request = heapq.heappop(bucket.queue)
+                if request.future.done():
+                    # the caller gave up while it was queued
+                    continue
+                cell = await self._global_token(priority)
+                if cell is not None:
+                    request.cells.append(cell)
+                now = loop.time()
+                if bucket.budget is not None:
+                    request.cells.append(bucket.budget.take(now))
+                metrics.observe('rest_wait', request.route, now - request.queued_at)
+                self.sent += 1
+                loop.create_task(self._send(request))
+        finally:
+            bucket.task = None
+
+    def _global_delay(self, priority, now):
+        requests = None if priority == INTERACTIVE else self.background_requests
+        return self.global_budget.delay(now, requests)
+
+    async def _global_token(self, priority):
+        if self.global_budget is None:
+            return None
+        loop = asyncio.get_event_loop()
+        waiters = self._global_waiters
+        if (not waiters or priority < waiters[0][0]) and self._global_delay(priority, loop.time()) == 0:
+            return self.global_budget.take(loop.time())
+        future = loop.create_future()
+        heapq.heappush(waiters, (priority, next(self._seq), future))
+        if self._global_task is None:
+            self._global_wakeup = asyncio.Event()
+            self._global_task = loop.create_task(self._release_global())
+        elif waiters[0][2] is future:
+            # the releaser may be sleeping for a lower priority's delay
+            self._global_wakeup.set()
+        return await future
+
+    async def _release_global(self):
+        loop = asyncio.get_event_loop()
+        try:
+            while self._global_waiters:
+                priority, seq, future = self._global_waiters[0]
+                delay = self._global_delay(priority, loop.time())
+                if delay > 0:
+                    self._global_wakeup.clear()
+                    try:
+                        await asyncio.wait_for(self._global_wakeup.wait(), delay)
+                    except asyncio.TimeoutError:
+                        pass
+                    continue
+                heapq.heappop(self._global_waiters)
+                if not future.done():
+                    future.set_result(self.global_budget.take(loop.time()))
+        finally:
+            self._global_task = None
+
+    async def _send(self, request):
+        # the call goes out now, not when it was dispatched; a busy loop can make those differ
+        now = asyncio.get_event_loop().time()
+        for cell in request.cells:
+            cell[0] = now
+        try:
+            with metrics.timer('rest', request.route):
+                result = await request.fun()
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+        else:
+            if not request.future.done():
+                request.future.set_result(result)
@@ -0,0 +1,171 @@
+'''Coalescing queue for member role changes.
+
+Role adds and removes are queued per member instead of being sent straight
+to Discord. Everything queued for a member before the worker reaches them
+is merged into a single member edit (later requests win over earlier ones
+for the same role), and an edit that would leave the member's roles as
+they are is dropped entirely. The worker drains the queue through a token
+bucket, serving interactive requests before background ones, and the edits
+themselves go through the REST scheduler with the same priority.
+
+Member objects can lag behind edits we just sent until the gateway echoes
+them back, so for `settle_seconds` after an edit the roles we sent are used
+as the member's current roles.
+'''
+
+import asyncio
+from collections import deque
+import logging
+
+from rest_scheduler import BACKGROUND, INTERACTIVE
+
+log = logging.getLogger(__name__)
+
+
+class _PendingEdit:
+
+    def __init__(self, member):
+        self.member = member
+        self.changes = {}  # role id -> (role, True to add / False to remove)
+        self.futures = []
+        self.interactive = False
+
+
+class RoleQueue:
+
+    def __init__(self, rest, rate_per_second=1.0, burst=5, settle_seconds=5):
+        self.rest = rest
+        self.rate_per_second = rate_per_second
+        self.burst = burst
+        self.settle_seconds = settle_seconds
+        self.pending = {}  # member id -> _PendingEdit
+        self._sent = {}    # member id -> (time, roles) of the last edit sent
+        self._interactive = deque()
+        self._background = deque()
+        self._tokens = burst
+        self._refilled = None
+        self._wakeup = None
+        self._worker = None
+
+        self.requested = 0   # role changes asked for
+        self.cancelled = 0   # changes overridden by a later opposite change before being sent
+        self.noops = 0       # member edits skipped because nothing would change
+        self.edits = 0       # member edits actually sent
+
+    def submit(self, member, add=(), remove=(), interactive=False):
+        '''queue role changes for `member`; the returned future resolves once they are applied'''
+        self._start()
+        edit = self.pending.get(member.id)
+        if edit is None:
+            edit = self.pending[member.id] = _PendingEdit(member)
+            (self._interactive if interactive else self._background).append(member.id)
+        elif interactive and not edit.interactive:
+            # jump the queue; the stale background entry is skipped when reached
+            self._interactive.append(member.id)
+        edit.member = member
+        edit.interactive = edit.interactive or interactive
+        for roles, adding in ((remove, False), (add, True)):
+            for role in roles:
+                if role is None:
+                    continue
+                self.requested += 1
+                previous = edit.changes.get(role.id)
+                if previous is not None and previous[1] != adding:
+                    self.cancelled += 1
+                edit.changes[role.id] = (role, adding)
+        future = asyncio.get_event_loop().create_future()
+        edit.futures.append(future)
+        self._wakeup.set()
+        return future
+
+    @property
+    def depth(self):
+        return len(self.pending)
+
+    def stats(self):
+        return {
+            'depth': self.depth,
+            'requested': self.requested,
+            'cancelled': self.cancelled,
+            'noops': self.noops,
+            'edits': self.edits,
+            # role changes asked for per member edit sent; higher means more coalescing
+            'coalescing_ratio': self.requested / self.edits if self.edits else 0.0,
+        }
+
+    def close(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            self._worker = None
+
+    def _start(self):
+        if self._worker is None:
+            loop = asyncio.get_event_loop()
+            self._wakeup = asyncio.Event()
+            self._refilled = loop.time()
+            self._worker = loop.create_task(self._run())
+
+    def _next(self):
+        for queue, interactive in ((self._interactive, True), (self._background, False)):
+            while queue:
+                member_id = queue.popleft()
+                edit = self.pending.get(member_id)
+                if edit is not None and edit.interactive == interactive:
+                    del self.pending[member_id]
+                    return edit
+        return None
+
+    async def _take_token(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            now = loop.time()
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate_per_second)
+            self._refilled = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate_per_second)
+
+    async def _run(self):
+        while True:
+            edit = self._next()
+            if edit is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            try:
+                await self._apply(edit)
+            except Exception as e:
+                log.exception('role edit for member %s failed', edit.member.id)
+                for future in edit.futures:
+                    if not future.done():
+                        future.set_exception(e)
+                        # already logged; don't warn again for callers that never await it
+                        future.exception()
+            else:
+                for future in edit.futures:
+                    if not future.done():
+                        future.set_result(None)
+
+    async def _apply(self, edit):
+        now = asyncio.get_event_loop().time()
+        sent = self._sent.get(edit.member.id)
+        if sent is not None and now - sent[0] < self.settle_seconds:
+            current = sent[1]
+        else:
+            self._sent.pop(edit.member.id, None)
+            # roles[0] is @everyone, which can't be sent back in an edit
+            current = edit.member.roles[1:]
+        current_ids = {role.id for role in current}
+        roles = [role for role in current if edit.changes.get(role.id, (role, True))[1]]
+        roles += [role for role, adding in edit.changes.values() if adding and role.id not in current_ids]
+        if {role.id for role in roles} == current_ids:
+            self.noops += 1
+            return
+        await self._take_token()
+        self.edits += 1
+        await self.rest.call('member_edit', lambda: edit.member.edit(roles=roles),
+                             INTERACTIVE if edit.interactive else BACKGROUND, edit.member.guild.id)
+        self._sent[edit.member.id] = (asyncio.get_event_loop().time(), roles)
+        if len(self._sent) > 1000:
+            self._sent = {k: v for k, v in self._sent.items() if now - v[0] < self.settle_seconds}